@@ -1,14 +1,45 @@
 # app.py - Backend Flask dla SignalMap
 import os
+import math
 import time
 import threading
 import signal
-from datetime import datetime, timedelta
+import sys
+import logging
+import random
+import json
+import uuid
+import base64
+import hashlib
+import queue
+import tempfile
+import socket
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
+import itertools
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from typing import Optional
-from flask import Flask, jsonify, request
+from urllib.parse import urlencode
+from flask import Flask, Response, g, has_request_context, jsonify, make_response, request, stream_with_context
 from flask_cors import CORS
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
+from psycopg2.pool import ThreadedConnectionPool
+import numpy as np
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+try:
+    import orjson
+except ImportError:  # bez orjson serializacja przez json ze standardowej biblioteki (wolniej)
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # formaty Arrow i Parquet są opcjonalne
+    pa = None
 
 # Konfiguracja z zmiennych środowiskowych (CSI secrets z Key Vault)
 HOST = os.getenv("PGHOST", "localhost")
@@ -18,6 +49,107 @@ PWD = os.getenv("PGPASSWORD", "")
 PORT = int(os.getenv("PGPORT", "5432"))
 SSLM = os.getenv("PGSSLMODE", "require")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))
+BTS_REFRESH_INTERVAL = int(os.getenv("BTS_REFRESH_INTERVAL", "300"))
+BTS_FULL_REFRESH = int(os.getenv("BTS_FULL_REFRESH", "21600"))
+# Maksymalna odległość pomiar-BTS (haversine). Dawny próg 0.15 stopnia liczony euklidesowo w stopniach był elipsą:
+# 16.7 km N-S, ale ~10.3 km W-E na szerokości Polski - okrąg 16.7 km dopasowuje więc więcej pomiarów (match_bts)
+MATCH_MAX_KM = float(os.getenv("MATCH_MAX_KM", "16.7"))
+# Domyślny silnik dopasowania BTS w /api/telemetry-with-bts: python (indeks w pamięci), db (LATERAL + KNN w PostGIS)
+# albo stored (related_bts_id zapisany przez fa-worker)
+BTS_MATCH_ENGINE = os.getenv("BTS_MATCH_ENGINE", "python")
+# Liczba wierszy pobieranych naraz z kursora w trybie strumieniowym
+STREAM_CHUNK = int(os.getenv("STREAM_CHUNK", "2000"))
+# Cache odpowiedzi: maksymalny wiek wpisu (0 wyłącza cache) i łączny rozmiar
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Eksport Parquet: wiersze na grupę oraz rozmiar bufora w pamięci, powyżej którego plik trafia na dysk
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "50000"))
+EXPORT_SPOOL_BYTES = int(os.getenv("EXPORT_SPOOL_BYTES", str(32 * 1024 * 1024)))
+# Eksport CSV: ile sekund czekać na zakończenie COPY po anulowaniu (rozłączenie klienta)
+EXPORT_CANCEL_WAIT = float(os.getenv("EXPORT_CANCEL_WAIT", "5"))
+# Co ile sekund dopisywać nowe pomiary do agregatów godzinowych (refresh_rollups() w bazie)
+ROLLUP_INTERVAL = int(os.getenv("ROLLUP_INTERVAL", "60"))
+# Ile dni trzymać w bazie kafle heatmapy okien kończących się w przeszłości (evict_heatmap_tiles() w bazie)
+HEATMAP_CACHE_DAYS = int(os.getenv("HEATMAP_CACHE_DAYS", "7"))
+# Utrzymanie partycji telemetry/speed_test (maintain_partitions() w bazie): co ile sekund, ile miesięcy naprzód,
+# retencja w pełnych miesiącach (0 = bez retencji) i czy stare partycje archiwizować (schemat archive) zamiast usuwać
+PARTITION_INTERVAL = int(os.getenv("PARTITION_INTERVAL", "3600"))
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "0"))
+RETENTION_ARCHIVE = os.getenv("RETENTION_ARCHIVE", "1") not in ("0", "false")
+# Pula połączeń: rozmiar, maks. czas oczekiwania na wolne połączenie [s] oraz czas bezczynności,
+# po którym połączenie jest sprawdzane (SELECT 1) przed wydaniem
+POOL_MIN = int(os.getenv("POOL_MIN", "2"))
+POOL_MAX = int(os.getenv("POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.getenv("POOL_TIMEOUT", "10"))
+POOL_CHECK_IDLE = float(os.getenv("POOL_CHECK_IDLE", "30"))
+# Ograniczenia zapytań: statement_timeout [ms] (domyślny na połączeniach puli, dłuższy dla eksportu),
+# maks. szacowany koszt planu (EXPLAIN, 0 wyłącza), zakresy parametrów limit/minutes
+# oraz co ile sekund sprawdzać, czy klient czekający na zapytanie nie zamknął połączenia
+STATEMENT_TIMEOUT_MS = int(os.getenv("STATEMENT_TIMEOUT_MS", "15000"))
+EXPORT_STATEMENT_TIMEOUT_MS = int(os.getenv("EXPORT_STATEMENT_TIMEOUT_MS", "600000"))
+QUERY_MAX_COST = float(os.getenv("QUERY_MAX_COST", "500000"))
+QUERY_MAX_LIMIT = int(os.getenv("QUERY_MAX_LIMIT", "200000"))
+QUERY_MAX_MINUTES = int(os.getenv("QUERY_MAX_MINUTES", str(90 * 24 * 60)))
+DISCONNECT_POLL = float(os.getenv("DISCONNECT_POLL", "0.5"))
+# Maks. liczba przygotowanych zapytań (PREPARE) na połączenie; 0 wyłącza przygotowywanie
+PREPARED_MAX = int(os.getenv("PREPARED_MAX", "64"))
+# Tryb przyrostowy (since_id/since_received_at): pomijane są wiersze młodsze niż DELTA_LAG sekund.
+# received_at to początek transakcji fa-worker, więc wiersz może stać się widoczny dopiero po commicie -
+# opóźnienie musi być dłuższe niż najdłuższa transakcja zapisu (jak min_age w refresh_rollups)
+DELTA_LAG = int(os.getenv("DELTA_LAG", "15"))
+# Logi: poziom (DEBUG/INFO/WARNING/ERROR), format (json dla AKS, text lokalnie)
+# oraz odsetek zapisywanych logów DEBUG w gorących pętlach (np. dopasowanie BTS)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.001"))
+
+
+class RequestIdFilter(logging.Filter):
+    """Dopisuje do rekordu request_id bieżącego zapytania HTTP ("-" poza zapytaniem)"""
+
+    def filter(self, record):
+        record.request_id = g.get("request_id", "-") if has_request_context() else "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Jeden obiekt JSON na linię (Azure Monitor / Container Insights)"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "requestId": record.request_id,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(RequestIdFilter())
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] [%(request_id)s] %(message)s"))
+    root = logging.getLogger("signalmap")
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+
+
+configure_logging()
+log = logging.getLogger("signalmap")
+api_log = logging.getLogger("signalmap.api")
+sql_log = logging.getLogger("signalmap.sql")
+pool_log = logging.getLogger("signalmap.pool")
+cache_log = logging.getLogger("signalmap.cache")
+bts_log = logging.getLogger("signalmap.bts")
+match_log = logging.getLogger("signalmap.match")
 
 app = Flask(__name__)
 # CORS wyłączony - frontend i backend w tej samej domenie
@@ -26,19 +158,574 @@ app = Flask(__name__)
 
 _last_ok: Optional[datetime] = None
 _stop = threading.Event()
-_pool: Optional[SimpleConnectionPool] = None
+
+# Metryki Prometheus; pod gunicornem zbierane ze wszystkich workerów (PROMETHEUS_MULTIPROC_DIR)
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+REQUEST_SECONDS = Histogram("signalmap_request_seconds", "Całkowity czas obsługi zapytania (do końca strumienia)",
+                            ["endpoint", "status"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("signalmap_stage_seconds", "Czas etapu obsługi zapytania: db_execute, db_fetch, "
+                          "db_plan, to_dict, bts_match, render, serialize", ["endpoint", "stage"], buckets=LATENCY_BUCKETS)
+RESPONSE_ROWS = Histogram("signalmap_response_rows", "Liczba rekordów w odpowiedzi", ["endpoint"],
+                          buckets=(0, 10, 100, 1000, 10000, 50000, 100000, 500000, 1000000))
+BTS_MATCHES = Counter("signalmap_bts_matches_total", "Pomiary z dopasowaną / bez dopasowanej stacji BTS", ["result"])
+POOL_IN_USE = Gauge("signalmap_db_pool_in_use", "Połączenia z bazą wydane z puli", multiprocess_mode="livesum")
+POOL_SIZE = Gauge("signalmap_db_pool_max", "Maksymalna liczba połączeń w puli", multiprocess_mode="livesum")
+POOL_CHECKOUTS = Counter("signalmap_db_pool_checkouts_total", "Wydania połączeń z puli")
+POOL_WAIT_SECONDS = Histogram("signalmap_db_pool_wait_seconds", "Czas oczekiwania na wolne połączenie",
+                              buckets=(.001, .005, .01, .05, .1, .5, 1, 2.5, 5, 10))
+POOL_TIMEOUTS = Counter("signalmap_db_pool_timeouts_total", "Przekroczenia czasu oczekiwania na połączenie")
+POOL_HEALTH_FAILURES = Counter("signalmap_db_pool_health_failures_total", "Połączenia odrzucone przy sprawdzeniu")
+POOL_RECLAIMED = Counter("signalmap_db_pool_reclaimed_total", "Odzyskane niezwrócone połączenia")
+QUERY_GUARD = Counter("signalmap_query_guard_total", "Zapytania przerwane przez ograniczenia: cost (EXPLAIN), "
+                      "timeout (statement_timeout), disconnect (klient rozłączony)", ["endpoint", "reason"])
+HEATMAP_TILES = Counter("signalmap_heatmap_tiles_total", "Kafle heatmapy: z bufora w bazie (hit) / renderowane (miss)",
+                        ["result"])
+
+
+def metrics_endpoint() -> str:
+    """Etykieta endpointu: reguła routingu (np. /api/tiles/<layer>/...), bez wartości parametrów"""
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Mierzy etap obsługi zapytania. Czasy sumowane są w obrębie zapytania (także po porcjach
+    strumienia) i zapisywane do signalmap_stage_seconds po jego zakończeniu.
+    Czas etapów zagnieżdżonych (np. bts_match w to_dict) nie jest doliczany do etapu nadrzędnego.
+    """
+    if not has_request_context():
+        yield
+        return
+    stack = g.setdefault("stage_stack", [])
+    stack.append(0.0)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        stages = g.setdefault("stages", {})
+        stages[name] = stages.get(name, 0.0) + elapsed - nested
+
+
+def count_rows(n: int):
+    """Dolicza rekordy zwrócone w odpowiedzi (signalmap_response_rows)"""
+    if has_request_context():
+        g.rows = g.get("rows", 0) + n
+
+
+def _json_default(v):
+    """Typy spoza JSON: daty jako ISO 8601 (jak isoformat()), Decimal jako liczba"""
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return float(v)
+    raise TypeError(f"Object of type {type(v).__name__} is not JSON serializable")
+
+
+def dumps_json(obj) -> bytes:
+    """
+    Serializacja JSON odpowiedzi API. orjson serializuje datetime, krotki i liczby bez
+    pośrednich obiektów Pythona, więc wiersze z bazy nie wymagają wcześniejszej konwersji.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_json_default).encode()
+
+
+def api_json(**payload):
+    """Odpowiedź JSON (dumps_json) z pomiarem czasu serializacji"""
+    with stage("serialize"):
+        return Response(dumps_json(payload), mimetype="application/json")
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # X-Request-ID z ingressu albo nowy - łączy logi SQL, dopasowania i odpowiedzi jednego zapytania
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+
+
+@app.after_request
+def remember_status(resp):
+    g.status = resp.status_code
+    resp.headers["X-Request-ID"] = g.get("request_id", "")
+    minutes = request.args.get("minutes", "")
+    if minutes.isdigit() and int(minutes) > QUERY_MAX_MINUTES:
+        resp.headers["X-Minutes-Applied"] = str(QUERY_MAX_MINUTES)
+    return resp
+
+
+@app.teardown_request
+def observe_request(exc):
+    """Zapisuje metryki zapytania; przy odpowiedziach strumieniowych wywoływane po wysłaniu całości"""
+    if "request_start" not in g or g.get("streaming"):
+        return
+    endpoint = metrics_endpoint()
+    status = 500 if exc is not None else g.get("status", 500)
+    elapsed = time.perf_counter() - g.request_start
+    REQUEST_SECONDS.labels(endpoint, str(status)).observe(elapsed)
+    # Sondy i scrape metryk tylko na poziomie DEBUG
+    level = logging.DEBUG if endpoint in ("/healthz", "/ready", "/metrics") else logging.INFO
+    api_log.log(level, "%s %s %s %.1f ms", request.method, request.full_path.rstrip("?"), status, elapsed * 1000)
+    for name, seconds in g.get("stages", {}).items():
+        STAGE_SECONDS.labels(endpoint, name).observe(seconds)
+    if "rows" in g:
+        RESPONSE_ROWS.labels(endpoint).observe(g.rows)
+
+
+@app.route("/metrics")
+def metrics():
+    """Endpoint /metrics w formacie Prometheus"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+class PoolTimeout(Exception):
+    """Brak wolnego połączenia w puli w czasie POOL_TIMEOUT"""
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Połączenie pamiętające zapytania przygotowane w jego sesji (tekst SQL -> nazwa, kolejność LRU)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = OrderedDict()
+
+
+def prepare(cur, sql: str) -> Optional[str]:
+    """
+    Nazwa zapytania przygotowanego na połączeniu kursora; przy pierwszym użyciu PREPARE
+    (parametry %s zamienione na $1..$n, typy wnioskowane przez serwer). Zapytania o stałym tekście
+    nie są potem ponownie parsowane, a plan może zostać zapamiętany (plan ogólny po 5 wykonaniach).
+    Najmniej używane zapytania ponad PREPARED_MAX są zwalniane (DEALLOCATE).
+    None - połączenie bez obsługi przygotowanych zapytań.
+    """
+    cache = getattr(cur.connection, "prepared", None)
+    if cache is None or PREPARED_MAX <= 0:
+        return None
+    name = cache.get(sql)
+    if name is not None:
+        cache.move_to_end(sql)
+        return name
+    if len(cache) >= PREPARED_MAX:
+        _, old = cache.popitem(last=False)
+        cur.execute(f"DEALLOCATE {old}")
+    parts = sql.split("%s")
+    body = "".join(f"{part}${i}" for i, part in enumerate(parts[:-1], 1)) + parts[-1]
+    name = "q_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+    cur.execute(f"PREPARE {name} AS {body}")
+    cache[sql] = name
+    return name
+
+
+def execute_prepared(cur, sql: str, params=(), explain: bool = False):
+    """
+    cur.execute(sql, params) jako EXECUTE zapytania przygotowanego na tym połączeniu (prepare()).
+    explain=True: EXPLAIN (FORMAT JSON) zamiast wykonania - plan liczony dla przygotowanego zapytania.
+    Kursory nazwane (strumień, eksport) nie obsługują EXECUTE i wykonują zapytania zwykłym trybem.
+    """
+    prefix = "EXPLAIN (FORMAT JSON) " if explain else ""
+    name = prepare(cur, sql)
+    if name is None:
+        return cur.execute(prefix + sql, tuple(params))
+    args = f" ({', '.join(['%s'] * len(params))})" if params else ""
+    return cur.execute(f"{prefix}EXECUTE {name}{args}", tuple(params))
+
+
+class DbPool:
+    """
+    Pula połączeń bezpieczna dla wątków (ThreadedConnectionPool) z ograniczonym czasem oczekiwania
+    na wolne połączenie, sprawdzaniem połączenia przy wydaniu i odzyskiwaniem niezwróconych połączeń.
+    Każde wydane połączenie ma "dzierżawę" (wątek i czas pobrania), z której liczone są metryki.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, **dsn):
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._leases = {}      # id(conn) -> (conn, monotonic pobrania, wątek)
+        self._idle_since = {}  # id(conn) -> monotonic ostatniego zwrotu
+        self.maxconn = maxconn
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.health_failures = 0
+        self.reclaimed = 0
+        POOL_SIZE.set(maxconn)
+
+    def getconn(self, timeout: Optional[float] = None):
+        """Wydaje sprawdzone połączenie; czeka najwyżej timeout (domyślnie POOL_TIMEOUT) sekund"""
+        timeout = POOL_TIMEOUT if timeout is None else timeout
+        t0 = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.timeouts += 1
+            POOL_TIMEOUTS.inc()
+            raise PoolTimeout(f"no free DB connection within {timeout:g}s ({self.maxconn} in use)")
+        waited = time.monotonic() - t0
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self._leases[id(conn)] = (conn, time.monotonic(), threading.current_thread())
+        POOL_CHECKOUTS.inc()
+        POOL_WAIT_SECONDS.observe(waited)
+        POOL_IN_USE.inc()
+        return conn
+
+    def _checkout(self):
+        """Pobiera połączenie z puli; zamknięte lub niedziałające po dłuższej bezczynności wymienia na nowe"""
+        for _ in range(self.maxconn + 1):
+            conn = self._pool.getconn()
+            with self._lock:
+                idle_since = self._idle_since.pop(id(conn), None)
+            idle = time.monotonic() - idle_since if idle_since is not None else 0
+            if not conn.closed and (idle < POOL_CHECK_IDLE or self._ping(conn)):
+                return conn
+            with self._lock:
+                self.health_failures += 1
+            POOL_HEALTH_FAILURES.inc()
+            pool_log.warning("Połączenie nie odpowiada - zamykam i otwieram nowe")
+            self._pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("no healthy DB connection available")
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def is_leased(self, conn) -> bool:
+        lease = self._leases.get(id(conn))
+        return lease is not None and lease[0] is conn
+
+    def putconn(self, conn, close: bool = False):
+        """Zwraca połączenie; ponowny zwrot (np. po odzyskaniu jako wyciek) jest ignorowany"""
+        with self._lock:
+            if not self.is_leased(conn):
+                return
+            del self._leases[id(conn)]
+        POOL_IN_USE.dec()
+        close = close or bool(conn.closed)
+        try:
+            self._pool.putconn(conn, close=close)
+            if not close:
+                with self._lock:
+                    self._idle_since[id(conn)] = time.monotonic()
+        except psycopg2.Error:
+            # rollback przy zwrocie się nie udał - połączenie nie nadaje się do ponownego użycia
+            self._pool.putconn(conn, close=True)
+        finally:
+            self._slots.release()
+
+    def reclaim(self, conn, owner: str):
+        """Zamyka i zwalnia połączenie, którego właściciel go nie oddał"""
+        if not self.is_leased(conn):
+            return
+        with self._lock:
+            self.reclaimed += 1
+        POOL_RECLAIMED.inc()
+        pool_log.warning("Odzyskano niezwrócone połączenie (%s)", owner)
+        self.putconn(conn, close=True)
+
+    def reap(self):
+        """Odzyskuje połączenia wątków, które zakończyły się bez ich zwrotu"""
+        with self._lock:
+            dead = [(conn, thread.name) for conn, _, thread in self._leases.values() if not thread.is_alive()]
+        for conn, name in dead:
+            self.reclaim(conn, f"wątek {name}")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            held = [now - since for _, since, _ in self._leases.values()]
+            return {
+                "max": self.maxconn,
+                "inUse": len(held),
+                "idle": len(self._pool._pool),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "waitMsTotal": round(self.wait_total * 1000, 1),
+                "waitMsMax": round(self.wait_max * 1000, 1),
+                "waitMsAvg": round(self.wait_total * 1000 / self.checkouts, 2) if self.checkouts else 0,
+                "healthCheckFailures": self.health_failures,
+                "leakedReclaimed": self.reclaimed,
+                "longestHeldMs": round(max(held) * 1000, 1) if held else 0,
+            }
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool: Optional[DbPool] = None
 
 
 def get_conn():
-    """Pobiera połączenie z puli"""
+    """
+    Pobiera połączenie z puli. W obsłudze zapytania HTTP połączenie jest zapamiętywane
+    i odzyskiwane po zakończeniu zapytania, jeśli nie zostało zwrócone.
+    """
     assert _pool is not None, "DB pool not initialized"
-    return _pool.getconn()
+    conn = _pool.getconn()
+    if has_request_context():
+        g.setdefault("db_conns", []).append(conn)
+    return conn
 
 
-def put_conn(conn):
-    """Zwraca połączenie do puli"""
+def put_conn(conn, close: bool = False):
+    """Zwraca połączenie do puli (close=True zamyka je, np. po przerwanym COPY)"""
     if _pool and conn:
-        _pool.putconn(conn)
+        # Zwrócone połączenie nie należy już do zapytania - po zwrocie może je wypożyczyć inny wątek,
+        # a odzyskanie w teardown zamknęłoby mu je w trakcie pracy
+        if has_request_context():
+            conns = g.get("db_conns") or []
+            for i, c in enumerate(conns):
+                if c is conn:
+                    del conns[i]
+                    break
+        _pool.putconn(conn, close=close)
+
+
+# statement_timeout [ms] endpointów innych niż domyślny STATEMENT_TIMEOUT_MS (reguła routingu -> limit)
+ENDPOINT_TIMEOUTS_MS = {
+    "/api/export/<dataset>": EXPORT_STATEMENT_TIMEOUT_MS,
+    "/api/heatmap/<metric>/<int:z>/<int:x>/<int:y>.<fmt>": 30000,
+    "/api/stats": 5000,
+}
+
+
+def set_statement_timeout(conn, timeout_ms: Optional[int] = None):
+    """
+    SET LOCAL statement_timeout na czas bieżącej transakcji (potem wraca domyślny z puli).
+    Bez timeout_ms: limit endpointu z ENDPOINT_TIMEOUTS_MS, jeśli jest; 0 wyłącza limit.
+    """
+    if timeout_ms is None and has_request_context():
+        timeout_ms = ENDPOINT_TIMEOUTS_MS.get(metrics_endpoint())
+    if timeout_ms is not None:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+
+
+class DisconnectWatcher:
+    """
+    Anuluje zapytanie SQL (conn.cancel()), gdy klient HTTP zamknie połączenie, zanim zapytanie się skończy.
+    Jeden wątek tła co DISCONNECT_POLL s sprawdza gniazda zapytań czekających na bazę:
+    recv(MSG_PEEK) zwracające 0 bajtów oznacza, że druga strona zamknęła połączenie.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._watched = {}  # token -> [gniazdo, połączenie z bazą, anulowane]
+        self._tokens = itertools.count()
+        self._thread = None
+        self.cancelled = 0
+
+    def watch(self, sock, conn) -> int:
+        with self._lock:
+            token = next(self._tokens)
+            self._watched[token] = [sock, conn, False]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return token
+
+    def unwatch(self, token: int) -> bool:
+        """Kończy obserwację; True, jeśli zapytanie zostało anulowane z powodu rozłączenia klienta"""
+        with self._lock:
+            return self._watched.pop(token)[2]
+
+    @staticmethod
+    def _closed(sock) -> bool:
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def _run(self):
+        while not _stop.wait(self.interval):
+            with self._lock:
+                for entry in self._watched.values():
+                    if not entry[2] and self._closed(entry[0]):
+                        entry[2] = True
+                        self.cancelled += 1
+                        try:
+                            entry[1].cancel()
+                        except Exception as e:
+                            pool_log.warning("Nie udało się anulować zapytania: %s", e)
+
+
+_disconnects = DisconnectWatcher(DISCONNECT_POLL)
+
+
+@contextmanager
+def cancel_on_disconnect(conn):
+    """Na czas bloku: anulowanie zapytań na conn po rozłączeniu klienta (g.client_gone = True)"""
+    sock = None
+    if has_request_context():
+        # gunicorn i serwer deweloperski werkzeug udostępniają gniazdo klienta w environ
+        sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    if sock is None or DISCONNECT_POLL <= 0:
+        yield
+        return
+    token = _disconnects.watch(sock, conn)
+    try:
+        yield
+    finally:
+        if _disconnects.unwatch(token):
+            g.client_gone = True
+
+
+@contextmanager
+def db_conn(timeout_ms: Optional[int] = None):
+    """
+    Połączenie z puli na czas bloku with (commit/rollback transakcji), zwracane w każdej ścieżce.
+    W zapytaniu HTTP: statement_timeout endpointu (set_statement_timeout) i anulowanie po rozłączeniu klienta.
+    """
+    conn = get_conn()
+    try:
+        with conn, cancel_on_disconnect(conn):
+            set_statement_timeout(conn, timeout_ms)
+            yield conn
+    finally:
+        # Po anulowaniu połączenie nie wraca do puli - spóźnione anulowanie mogłoby trafić w kolejne zapytanie
+        put_conn(conn, close=has_request_context() and bool(g.get("client_gone")))
+
+
+class QueryTooExpensive(Exception):
+    """Szacowany koszt planu zapytania przekracza QUERY_MAX_COST"""
+
+    def __init__(self, cost: float, max_cost: float):
+        super().__init__(f"estimated query cost {cost:.0f} exceeds limit {max_cost:.0f}; narrow the time range "
+                         f"or filters, or use aggregated data (/api/telemetry/cells, /api/stats)")
+        self.cost = cost
+        self.max_cost = max_cost
+
+
+def check_query_cost(cur, sql: str, params, max_cost: Optional[float] = None) -> Optional[float]:
+    """
+    Szacowany koszt zapytania z EXPLAIN (plan bez wykonania). Zapytania droższe niż max_cost
+    (domyślnie QUERY_MAX_COST) są odrzucane przed uruchomieniem (QueryTooExpensive).
+    """
+    max_cost = QUERY_MAX_COST if max_cost is None else max_cost
+    if max_cost <= 0:
+        return None
+    with stage("db_plan"):
+        execute_prepared(cur, sql, params, explain=True)
+        plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    cost = plan[0]["Plan"]["Total Cost"]
+    if cost > max_cost:
+        raise QueryTooExpensive(cost, max_cost)
+    return cost
+
+
+def db_error(endpoint: str, e: Exception):
+    """
+    Odpowiedź na błąd obsługi zapytania: 422 - za drogie zapytanie, 503 - przekroczony statement_timeout
+    albo brak wolnego połączenia, 499 - klient się rozłączył (zapytanie anulowane), 500 - pozostałe.
+    """
+    label = metrics_endpoint()
+    if isinstance(e, QueryTooExpensive):
+        QUERY_GUARD.labels(label, "cost").inc()
+        api_log.warning("%s: odrzucone, koszt planu %.0f > %.0f", endpoint, e.cost, e.max_cost)
+        return jsonify(error=str(e), cost=round(e.cost), maxCost=round(e.max_cost)), 422
+    if isinstance(e, psycopg2.extensions.QueryCanceledError):
+        if g.get("client_gone"):
+            QUERY_GUARD.labels(label, "disconnect").inc()
+            api_log.info("%s: klient rozłączony, zapytanie anulowane", endpoint)
+            return jsonify(error="client closed request"), 499
+        QUERY_GUARD.labels(label, "timeout").inc()
+        api_log.warning("%s: przekroczony limit czasu zapytania: %s", endpoint, e)
+        return jsonify(error="query timed out; narrow the time range or filters"), 503
+    if isinstance(e, PoolTimeout):
+        api_log.warning("%s: %s", endpoint, e)
+        return jsonify(error=str(e)), 503
+    api_log.exception("%s: %s", endpoint, e)
+    return jsonify(error=str(e)), 500
+
+
+def int_arg(name: str, default: int, lo: int, hi: int) -> int:
+    """Parametr całkowity z zakresu [lo, hi]; ValueError (odpowiedź 400) dla nie-liczby lub wartości spoza zakresu"""
+    raw = request.args.get(name)
+    if raw is None or raw == "":
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if not lo <= value <= hi:
+        raise ValueError(f"{name} must be between {lo} and {hi}")
+    return value
+
+
+def minutes_arg(default: Optional[int]) -> Optional[int]:
+    """
+    Okno czasowe minutes: wartości ponad QUERY_MAX_MINUTES są przycinane do limitu (nagłówek
+    X-Minutes-Applied, remember_status), zamiast odrzucać zapytania klientów z dłuższym oknem
+    """
+    raw = request.args.get("minutes", "")
+    if raw.isdigit() and int(raw) > QUERY_MAX_MINUTES:
+        return QUERY_MAX_MINUTES
+    return int_arg("minutes", default, 1, QUERY_MAX_MINUTES)
+
+
+def stream_response(body, mimetype: str) -> Response:
+    """
+    Odpowiedź strumieniowa z kontekstem zapytania. Teardown wywoływany jest też przy zwróceniu
+    Response, zanim strumień ruszy - g.streaming odkłada metryki, log i odzyskiwanie połączeń
+    do wywołania po wysłaniu całości.
+    """
+    g.streaming = True
+
+    def run():
+        try:
+            yield from body
+        finally:
+            g.streaming = False
+
+    return Response(stream_with_context(run()), mimetype=mimetype)
+
+
+@app.teardown_request
+def reclaim_request_conns(exc):
+    """Odzyskuje połączenia niezwrócone przez obsługę zapytania (także po zakończeniu strumienia)"""
+    if _pool is None or g.get("streaming"):
+        return
+    for conn in g.pop("db_conns", ()):
+        _pool.reclaim(conn, request.path)
+
+
+@app.route("/api/db/pool")
+def api_db_pool():
+    """
+    Endpoint /api/db/pool
+    Metryki puli połączeń: wydania, czas oczekiwania, połączenia w użyciu, odzyskane wycieki.
+    """
+    if _pool is None:
+        return jsonify(error="DB pool not initialized"), 503
+    return jsonify(_pool.stats())
 
 
 def poll_loop():
@@ -46,14 +733,13 @@ def poll_loop():
     global _last_ok
     while not _stop.is_set():
         try:
-            conn = get_conn()
-            with conn, conn.cursor() as cur:
+            with db_conn() as conn, conn.cursor() as cur:
                 cur.execute("SELECT 1;")
                 cur.fetchone()
-            put_conn(conn)
             _last_ok = datetime.utcnow()
         except Exception as e:
-            print(f"[POLL] error: {e}", flush=True)
+            log.warning("Test połączenia z bazą nieudany: %s", e)
+        _pool.reap()
         _stop.wait(POLL_INTERVAL)
 
 
@@ -66,12 +752,396 @@ def healthz():
 @app.route("/ready")
 def ready():
     """Readiness probe"""
+    if _stop.is_set():
+        # Trwa zamykanie - nie kieruj już ruchu do tej instancji
+        return jsonify(ready=False, draining=True), 503
     if _last_ok and _last_ok > datetime.utcnow() - timedelta(minutes=2):
         return jsonify(ready=True, last_ok=_last_ok.isoformat() + "Z"), 200
     return jsonify(ready=False, last_ok=_last_ok.isoformat() + "Z" if _last_ok else None), 503
 
 
+def telemetry_item(r) -> dict:
+    """
+    Wiersz telemetrii (kolumny jak w /api/telemetry) -> słownik w formacie API.
+    Wartości bez konwersji: signal (SMALLINT) i ST_X/ST_Y (float8) mają już typy Pythona,
+    a send_time zamienia na ISO 8601 dumps_json.
+    """
+    return {
+        "id": r[0],
+        "operator": r[1],
+        "networkType": r[2],
+        "signal": r[3],
+        "latitude": r[4],
+        "longitude": r[5],
+        "sendTime": r[6],
+        "position": [r[5], r[4]],
+        "rat": r[7],
+        "nrMode": r[8],
+        "band": r[9],
+        "arfcn": r[10],
+        "rsrp": r[11],
+        "rsrq": r[12],
+        "sinr": r[13],
+        "rssi": r[14],
+        "timingAdvance": r[15],
+        "pci": r[16],
+        "eci": r[17],
+        "nci": r[18],
+        "cellId": r[19],
+        "enb": r[20],
+        "sectorId": r[21],
+        "tac": r[22],
+        "lac": r[23]
+    }
+
+
+def page_cursor(send_time: datetime, row_id: int) -> str:
+    """Nieprzezroczysty kursor kolejnej strony z (send_time, id) ostatniego zwróconego wiersza"""
+    raw = json.dumps({"t": send_time.isoformat(), "i": row_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def parse_page_cursor(token: str):
+    """Kursor z ?cursor= -> (send_time, id); ValueError dla niepoprawnego tokenu"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        data = json.loads(raw)
+        return datetime.fromisoformat(data["t"]), int(data["i"])
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+def parse_delta():
+    """
+    Tryb przyrostowy z ?since_id= / ?since_received_at=: zwraca (since_id, since_received_at) albo None.
+    Klient przekazuje oba pola znacznika "mark" z poprzedniej odpowiedzi (delta_filter).
+    Nie łączy się z kursorem stron ani trybem strumieniowym (ValueError).
+    """
+    since_id = request.args.get("since_id")
+    since_received_at = request.args.get("since_received_at")
+    if since_id is None and since_received_at is None:
+        return None
+    if request.args.get("cursor") or stream_format():
+        raise ValueError("since_id/since_received_at cannot be combined with cursor or stream")
+    return (int(since_id) if since_id is not None else None), since_received_at
+
+
+def delta_filter(table: str, delta) -> tuple:
+    """
+    Warunek trybu przyrostowego: wiersze po znaczniku w kolejności (received_at, id), bez wierszy
+    młodszych niż DELTA_LAG. Cała partia fa-worker ma to samo received_at, więc sam received_at > znacznik
+    gubiłby resztę partii przy stronie kończącej się w jej środku, a samo id > znacznik - wiersze
+    z wcześniejszym id zatwierdzone później. Bez since_received_at znacznik brany jest z wiersza since_id
+    (gdy tego wiersza już nie ma - wszystkie wiersze). Zwraca (sql, params).
+    """
+    since_id, since_received_at = delta
+    if since_received_at is not None:
+        key, params = "(%s::timestamptz, %s::bigint)", [since_received_at, since_id or 0]
+    else:
+        key = f"(COALESCE((SELECT received_at FROM {table} WHERE id = %s), '-infinity'), %s::bigint)"
+        params = [since_id, since_id]
+    params.append(f"{DELTA_LAG} seconds")
+    return f" AND (received_at, id) > {key} AND received_at < now() - %s::interval", params
+
+
+def delta_mark(rows, delta, received_col: int) -> dict:
+    """Nowy znacznik dla klienta: id i received_at ostatniego zwróconego wiersza (albo poprzedni znacznik)"""
+    if not rows:
+        return {"sinceId": delta[0], "sinceReceivedAt": delta[1]}
+    last = rows[-1]
+    return {"sinceId": last[0], "sinceReceivedAt": last[received_col].isoformat()}
+
+
+def stream_format() -> Optional[str]:
+    """Tryb strumieniowy z parametru ?stream=: None, "json" lub "ndjson" """
+    value = (request.args.get("stream") or "").lower()
+    if value in ("", "0", "false"):
+        return None
+    if value in ("1", "true", "json"):
+        return "json"
+    if value == "ndjson":
+        return "ndjson"
+    raise ValueError(f"invalid stream value: {value}")
+
+
+def row_shape() -> str:
+    """
+    Parametr shape: "items" (lista obiektów, domyślnie) albo "rows" - nazwy pól raz w "fields",
+    a wiersze jako tablice prosto z bazy (bez słownika na wiersz, mniejsza odpowiedź).
+    """
+    shape = request.args.get("shape", "items")
+    if shape not in ("items", "rows"):
+        raise ValueError(f"invalid shape value: {shape}")
+    if shape == "rows" and stream_format():
+        raise ValueError("shape=rows cannot be combined with stream")
+    return shape
+
+
+def stream_query(endpoint: str, sql: str, params, to_items, fmt: str, limit: Optional[int] = None, next_of=None,
+                 trailer=None):
+    """
+    Odpowiedź strumieniowa: wiersze czytane kursorem po stronie serwera (named cursor + fetchmany)
+    i wysyłane porcjami po STREAM_CHUNK, więc pamięć nie rośnie razem z limit.
+    to_items(rows) zamienia porcję wierszy na listę słowników.
+    fmt = "json" -> {"items": [...], "next": ...}, fmt = "ndjson" -> jeden obiekt JSON na linię,
+    a na końcu linia {"next": ...}.
+    Gdy strona jest pełna (limit wierszy), "next" = next_of(ostatni wiersz), w przeciwnym razie null.
+    trailer() zwraca dodatkowe pola obiektu końcowego (np. tabelę "bts" przy bts=ref).
+    Koszt zapytania sprawdzany jest przed wysłaniem nagłówków (check_query_cost), więc odrzucenie
+    to zwykła odpowiedź 422, a nie ucięty strumień.
+    """
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql, params)
+    except Exception as e:
+        return db_error(endpoint, e)
+
+    def generate():
+        conn = get_conn()
+        count = 0
+        last = None
+        try:
+            with conn, cancel_on_disconnect(conn), conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                set_statement_timeout(conn)
+                with stage("db_execute"):
+                    cur.execute(sql, tuple(params))
+                if fmt == "json":
+                    yield b'{"items":['
+                while True:
+                    with stage("db_fetch"):
+                        rows = cur.fetchmany(STREAM_CHUNK)
+                    if not rows:
+                        break
+                    with stage("to_dict"):
+                        chunk = to_items(rows)
+                    with stage("serialize"):
+                        if fmt == "ndjson":
+                            body = b"\n".join(dumps_json(i) for i in chunk) + b"\n"
+                        else:
+                            # Porcja jako tablica JSON bez nawiasów - elementy listy "items"
+                            body = (b"," if count else b"") + dumps_json(chunk)[1:-1]
+                    yield body
+                    count += len(rows)
+                    count_rows(len(rows))
+                    last = rows[-1]
+                next_cursor = next_of(last) if next_of and limit and count >= limit else None
+                tail = dict(trailer() if trailer else {}, next=next_cursor)
+                if fmt == "json":
+                    yield b"]," + dumps_json(tail)[1:]
+                else:
+                    yield dumps_json(tail) + b"\n"
+            api_log.debug("%s: wysłano strumieniowo %d rekordów", endpoint, count)
+        except Exception as e:
+            # Nagłówki już wysłane - klient dostaje ucięty JSON albo linię z błędem (NDJSON)
+            api_log.exception("%s (stream): %s", endpoint, e)
+            if fmt == "ndjson":
+                yield dumps_json({"error": str(e)}) + b"\n"
+        finally:
+            put_conn(conn, close=bool(g.get("client_gone")))
+
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    return stream_response(generate(), mimetype)
+
+
+class ResponseCache:
+    """
+    Cache gotowych odpowiedzi (LRU ograniczone sumarycznym rozmiarem w bajtach).
+    Wpis jest ważny tylko dla ETagu, pod którym został zapisany - ETag zmienia się
+    razem z wersją danych i co CACHE_TTL sekund, więc nieaktualne wpisy po prostu
+    przestają trafiać i wypadają z LRU.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # klucz -> (etag, body, mimetype)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key: str, etag: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, etag: str, body: bytes, mimetype: str):
+        if len(body) > self.max_bytes // 4:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (etag, body, mimetype)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[1])
+
+
+_cache = ResponseCache(CACHE_MAX_BYTES)
+
+
+def data_version(tables) -> tuple:
+    """Znacznik wersji danych: max(id) podanych tabel (jedno tanie zapytanie po kluczu głównym)"""
+    sql = "SELECT " + ", ".join(f"(SELECT max(id) FROM {t})" for t in tables)
+    with db_conn() as conn, conn.cursor() as cur:
+        execute_prepared(cur, sql)
+        return cur.fetchone()
+
+
+def cached_response(*tables, bts: bool = False):
+    """
+    Dekorator endpointu: odpowiedź z cache + ETag/If-None-Match (304).
+    Klucz to ścieżka + posortowane parametry zapytania, ETag to skrót klucza, wersji
+    danych (max(id) tabel, opcjonalnie wersja indeksu BTS) i bieżącego okna CACHE_TTL.
+    Odpowiedzi strumieniowe omijają cache, podobnie tryb przyrostowy (since_id/since_received_at) - jego wynik
+    zależy też od now() - DELTA_LAG, więc przy tym samym max(id) kolejna odpowiedź może mieć więcej wierszy.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if CACHE_TTL <= 0 or (request.args.get("stream") or "0").lower() not in ("0", "false"):
+                return view(*args, **kwargs)
+            if "since_id" in request.args or "since_received_at" in request.args:
+                return view(*args, **kwargs)
+
+            key = request.path + "?" + urlencode(sorted(request.args.items(multi=True))) + "|" + (binary_format() or "json")
+            try:
+                version = data_version(tables)
+            except Exception as e:
+                cache_log.warning("Błąd sprawdzania wersji danych: %s", e)
+                return view(*args, **kwargs)
+            if bts:
+                snap = _bts_index.snapshot
+                version += (snap.version if snap else None,)
+
+            bucket = int(time.time() // CACHE_TTL)
+            etag = hashlib.sha1(f"{key}|{version}|{bucket}".encode()).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                _cache.not_modified += 1
+                resp = Response(status=304)
+            else:
+                entry = _cache.get(key, etag)
+                if entry is not None:
+                    resp = Response(entry[1], mimetype=entry[2])
+                else:
+                    resp = make_response(view(*args, **kwargs))
+                    if resp.status_code != 200 or resp.is_streamed:
+                        return resp
+                    _cache.put(key, etag, resp.get_data(), resp.mimetype)
+
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "no-cache"
+            resp.vary.add("Accept")
+            return resp
+        return wrapper
+    return decorator
+
+
+# Kolumnowy format binarny /api/telemetry: nazwa (jak klucz w JSON) i typ kolumny w kolejności SELECT.
+# "dict" = kolumna tekstowa kodowana słownikowo, "timestamp" = milisekundy od epoki (int64).
+TELEMETRY_COLUMNS = [
+    ("id", "int64"), ("operator", "dict"), ("networkType", "dict"), ("signal", "int16"),
+    ("latitude", "float64"), ("longitude", "float64"), ("sendTime", "timestamp"),
+    ("rat", "dict"), ("nrMode", "dict"), ("band", "dict"), ("arfcn", "int32"),
+    ("rsrp", "int32"), ("rsrq", "int32"), ("sinr", "int32"), ("rssi", "int32"),
+    ("timingAdvance", "int32"), ("pci", "int32"), ("eci", "int64"), ("nci", "int64"),
+    ("cellId", "int64"), ("enb", "int32"), ("sectorId", "int32"), ("tac", "int32"), ("lac", "int32"),
+]
+TELEMETRY_FIELDS = [name for name, _ in TELEMETRY_COLUMNS]
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+COLUMNS_MIMETYPE = "application/vnd.signalmap.columns"
+
+
+def to_columns(rows, spec):
+    """
+    Transpozycja wierszy do kolumn NumPy: lista (nazwa, typ, wartości, słownik).
+    Dla kolumn "dict" wartości to kody int32 (-1 = NULL), dla całkowitych NULL to minimum typu.
+    """
+    n = len(rows)
+    columns = []
+    for (name, kind), values in zip(spec, zip(*rows) if rows else [()] * len(spec)):
+        dictionary = None
+        if kind == "dict":
+            codes = {}
+            arr = np.fromiter((-1 if v is None else codes.setdefault(v, len(codes)) for v in values), dtype=np.int32, count=n)
+            dictionary = list(codes)
+        elif kind == "timestamp":
+            arr = np.fromiter((round(v.timestamp() * 1000) for v in values), dtype=np.int64, count=n)
+        elif kind == "float64":
+            arr = np.fromiter((np.nan if v is None else v for v in values), dtype=np.float64, count=n)
+        else:
+            null = np.iinfo(kind).min
+            arr = np.fromiter((null if v is None else v for v in values), dtype=kind, count=n)
+        columns.append((name, kind, arr, dictionary))
+    return columns
+
+
+def encode_columns(columns) -> bytes:
+    """
+    Format application/vnd.signalmap.columns: "SMC1", uint32 LE długość nagłówka, nagłówek JSON,
+    a po nim bufory kolumn (little-endian, każdy wyrównany do 8 bajtów, więc po stronie JS
+    można je czytać bezpośrednio jako TypedArray). Nagłówek opisuje offset, typ, wartość NULL
+    i słownik każdej kolumny; offsety liczone są od początku sekcji buforów.
+    """
+    meta, chunks, offset = [], [], 0
+    for name, kind, arr, dictionary in columns:
+        data = arr.astype(arr.dtype.newbyteorder("<"), copy=False).tobytes()
+        entry = {"name": name, "type": str(arr.dtype), "offset": offset, "length": len(arr)}
+        if kind == "dict":
+            entry["dictionary"] = dictionary
+            entry["null"] = -1
+        elif kind == "timestamp":
+            entry["unit"] = "ms"
+        elif kind != "float64":
+            entry["null"] = int(np.iinfo(arr.dtype).min)
+        meta.append(entry)
+        pad = -len(data) % 8
+        chunks.append(data + b"\0" * pad)
+        offset += len(data) + pad
+
+    header = json.dumps({"rows": len(columns[0][2]) if columns else 0, "columns": meta}, separators=(",", ":")).encode()
+    header += b" " * (-(len(header) + 8) % 8)
+    return b"SMC1" + len(header).to_bytes(4, "little") + header + b"".join(chunks)
+
+
+def encode_arrow(columns) -> bytes:
+    """Strumień Arrow IPC z jedną paczką rekordów (kolumny "dict" jako DictionaryArray)"""
+    arrays, names = [], []
+    for name, kind, arr, dictionary in columns:
+        if kind == "dict":
+            a = pa.DictionaryArray.from_arrays(pa.array(arr, mask=arr < 0), pa.array(dictionary, type=pa.string()))
+        elif kind == "timestamp":
+            a = pa.array(arr, type=pa.timestamp("ms", tz="UTC"))
+        elif kind == "float64":
+            a = pa.array(arr)
+        else:
+            a = pa.array(arr, mask=arr == np.iinfo(arr.dtype).min)
+        arrays.append(a)
+        names.append(name)
+
+    batch = pa.RecordBatch.from_arrays(arrays, names=names)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def binary_format() -> Optional[str]:
+    """Negocjacja formatu po nagłówku Accept: None (JSON), ARROW_MIMETYPE lub COLUMNS_MIMETYPE"""
+    best = request.accept_mimetypes.best_match(["application/json", COLUMNS_MIMETYPE, ARROW_MIMETYPE])
+    return best if best in (COLUMNS_MIMETYPE, ARROW_MIMETYPE) else None
+
+
 @app.route("/api/telemetry")
+@cached_response("telemetry")
 def api_telemetry():
     """
     Endpoint zwracający pełne dane telemetryczne.
@@ -79,10 +1149,26 @@ def api_telemetry():
       - minutes (int, default 1440): dane z ostatnich X minut (domyślnie 24h)
       - limit (int, default 100000): max liczba rekordów
       - operator (str, optional): filtruj po operatorze
+      - cursor (str, optional): kursor kolejnej strony ("next" z poprzedniej odpowiedzi)
+      - stream (json|ndjson, optional): odpowiedź strumieniowa (kursor po stronie serwera)
+      - shape (items|rows, default items): rows - "fields" raz, wiersze jako tablice (bez stream)
+    Nagłówek Accept: application/vnd.apache.arrow.stream (Arrow IPC, wymaga pyarrow) lub
+    application/vnd.signalmap.columns zwraca dane kolumnowo (TELEMETRY_COLUMNS, bez pola position),
+    kursor kolejnej strony jest wtedy w nagłówku X-Next-Cursor.
     """
-    minutes = int(request.args.get("minutes", "1440"))
-    limit = int(request.args.get("limit", "100000"))
     operator_filter = request.args.get("operator")
+    try:
+        minutes = minutes_arg(1440)
+        limit = int_arg("limit", 100000, 1, QUERY_MAX_LIMIT)
+        fmt = stream_format()
+        shape = row_shape()
+        after = parse_page_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    binary = binary_format()
+    if binary == ARROW_MIMETYPE and pa is None:
+        return jsonify(error="Arrow format is not available on this server"), 406
 
     sql = """
 SELECT
@@ -111,7 +1197,7 @@ SELECT
   tac,
   lac
 FROM telemetry
-WHERE send_time >= now() - interval %s
+WHERE send_time >= now() - %s::interval
     """
     params = [f"{minutes} minutes"]
 
@@ -119,48 +1205,53 @@ WHERE send_time >= now() - interval %s
         sql += " AND operator = %s"
         params.append(operator_filter)
 
-    sql += " ORDER BY send_time DESC LIMIT %s"
+    # Paginacja po kluczu (send_time, id) - bez OFFSET, zakres indeksu telemetry_send_time_id_idx
+    if after:
+        sql += " AND (send_time, id) < (%s, %s)"
+        params.extend(after)
+
+    sql += " ORDER BY send_time DESC, id DESC LIMIT %s"
     params.append(limit)
 
+    next_of = lambda r: page_cursor(r[6], r[0])
+
+    if fmt and not binary:
+        return stream_query("/api/telemetry", sql, params, lambda rows: [telemetry_item(r) for r in rows], fmt, limit, next_of)
+
     items = []
+    next_cursor = None
     try:
-        conn = get_conn()
-        with conn, conn.cursor() as cur:
-            cur.execute(sql, tuple(params))
-            for r in cur.fetchall():
-                items.append({
-                    "id": r[0],
-                    "operator": r[1],
-                    "networkType": r[2],
-                    "signal": int(r[3]),
-                    "latitude": float(r[4]),
-                    "longitude": float(r[5]),
-                    "sendTime": r[6].isoformat(),
-                    "position": [float(r[5]), float(r[4])],
-                    "rat": r[7],
-                    "nrMode": r[8],
-                    "band": r[9],
-                    "arfcn": r[10],
-                    "rsrp": r[11],
-                    "rsrq": r[12],
-                    "sinr": r[13],
-                    "rssi": r[14],
-                    "timingAdvance": r[15],
-                    "pci": r[16],
-                    "eci": r[17],
-                    "nci": r[18],
-                    "cellId": r[19],
-                    "enb": r[20],
-                    "sectorId": r[21],
-                    "tac": r[22],
-                    "lac": r[23]
-                })
-        put_conn(conn)
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql, params)
+            with stage("db_execute"):
+                execute_prepared(cur, sql, tuple(params))
+            with stage("db_fetch"):
+                rows = cur.fetchall()
+        count_rows(len(rows))
+
+        if len(rows) >= limit > 0:
+            next_cursor = next_of(rows[-1])
+
+        if binary:
+            with stage("to_dict"):
+                columns = to_columns(rows, TELEMETRY_COLUMNS)
+            with stage("serialize"):
+                body = encode_arrow(columns) if binary == ARROW_MIMETYPE else encode_columns(columns)
+            resp = Response(body, mimetype=binary)
+            if next_cursor:
+                resp.headers["X-Next-Cursor"] = next_cursor
+            return resp
+
+        if shape == "rows":
+            return api_json(fields=TELEMETRY_FIELDS, rows=rows, next=next_cursor)
+
+        with stage("to_dict"):
+            for r in rows:
+                items.append(telemetry_item(r))
     except Exception as e:
-        print(f"[API ERROR] /api/telemetry: {e}", flush=True)
-        return jsonify(error=str(e)), 500
+        return db_error("/api/telemetry", e)
     
-    return jsonify(items=items)
+    return api_json(items=items, next=next_cursor)
 
 
 @app.route("/api/bts")
@@ -171,7 +1262,10 @@ def api_bts():
       - operator (str, optional): filtruj po operatorze (siec_id)
       - limit (int, default 1000): max liczba rekordów
     """
-    limit = int(request.args.get("limit", "1000"))
+    try:
+        limit = int_arg("limit", 1000, 1, QUERY_MAX_LIMIT)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
     operator_filter = request.args.get("operator")
     
     sql = """
@@ -210,10 +1304,14 @@ SELECT
     
     items = []
     try:
-        conn = get_conn()
-        with conn, conn.cursor() as cur:
-            cur.execute(sql, tuple(params))
-            for r in cur.fetchall():
+        with db_conn() as conn, conn.cursor() as cur:
+            with stage("db_execute"):
+                execute_prepared(cur, sql, tuple(params))
+            with stage("db_fetch"):
+                rows = cur.fetchall()
+        count_rows(len(rows))
+        with stage("to_dict"):
+            for r in rows:
                 items.append({
                     "id": r[0],
                     "siecId": r[1],          
@@ -236,15 +1334,30 @@ SELECT
                     "rnc": r[18],
                     "carrier": r[19]
                 })
-        put_conn(conn)
     except Exception as e:
-        print(f"[API ERROR] /api/bts: {e}", flush=True)
-        return jsonify(error=str(e)), 500
+        return db_error("/api/bts", e)
     
-    return jsonify(items=items)
+    return api_json(items=items)
+
+
+def speedtest_item(r) -> dict:
+    """Wiersz speed_test (kolumny jak w /api/speedtest) -> słownik w formacie API"""
+    return {
+        "id": r[0],
+        "operator": r[2] if r[2] else "Nieznany",
+        "downloadSpeed": float(r[3]) if r[3] else 0,
+        "uploadSpeed": float(r[4]) if r[4] else 0,
+        "ping": float(r[5]) if r[5] else 0,
+        "jitter": float(r[6]) if r[6] else None,
+        "latitude": float(r[7]) if r[7] else None,
+        "longitude": float(r[8]) if r[8] else None,
+        "timestamp": r[9].isoformat() if r[9] else None,
+        "position": [float(r[8]), float(r[7])] if r[7] and r[8] else None
+    }
 
 
 @app.route("/api/speedtest")
+@cached_response("speed_test")
 def api_speedtest():
     """
     Endpoint zwracający dane speedtestów z tabeli speed_test.
@@ -255,13 +1368,23 @@ def api_speedtest():
       - short_code (str, optional): filtruj po short_code (identyfikator urządzenia)
       - start_date (str, optional): początek zakresu czasowego (ISO format)
       - end_date (str, optional): koniec zakresu czasowego (ISO format)
+      - cursor (str, optional): kursor kolejnej strony ("next" z poprzedniej odpowiedzi)
+      - since_id / since_received_at (optional): tylko rekordy zapisane po znaczniku "mark"
+        z poprzedniej odpowiedzi - oba pola (tryb przyrostowy, bez domyślnego okna 30 dni, z opóźnieniem DELTA_LAG)
+      - stream (json|ndjson, optional): odpowiedź strumieniowa (kursor po stronie serwera)
     """
-    limit = int(request.args.get("limit", "5000"))
-    minutes = request.args.get("minutes")
     operator_filter = request.args.get("operator")
     short_code_filter = request.args.get("short_code")
     start_date = request.args.get("start_date")
     end_date = request.args.get("end_date")
+    try:
+        limit = int_arg("limit", 5000, 1, QUERY_MAX_LIMIT)
+        minutes = minutes_arg(None)
+        fmt = stream_format()
+        after = parse_page_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+        delta = parse_delta()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
     sql = """
 SELECT
@@ -274,7 +1397,8 @@ SELECT
   jitter_ms,
   ST_Y(position::geometry) AS latitude,
   ST_X(position::geometry) AS longitude,
-  send_time        
+  send_time,
+  received_at
 FROM speed_test    
 WHERE position IS NOT NULL
     """
@@ -285,9 +1409,9 @@ WHERE position IS NOT NULL
         sql += " AND send_time >= %s"
         params.append(start_date)
     elif minutes:
-        sql += " AND send_time >= now() - interval %s"
+        sql += " AND send_time >= now() - %s::interval"
         params.append(f"{minutes} minutes")
-    else:
+    elif not delta:
         # domyslnie pobiera ostatnie 30 dni
         sql += " AND send_time >= now() - interval '30 days'"
 
@@ -305,58 +1429,575 @@ WHERE position IS NOT NULL
         sql += " AND short_code = %s"
         params.append(short_code_filter)
 
-    sql += " ORDER BY send_time DESC LIMIT %s"
-    params.append(limit)
+    if delta:
+        # Tryb przyrostowy: tylko wiersze zapisane po znaczniku klienta
+        where, where_params = delta_filter("speed_test", delta)
+        sql += where + " ORDER BY received_at, id LIMIT %s"
+        params.extend(where_params + [limit])
+    else:
+        # Paginacja po kluczu (send_time, id) - bez OFFSET
+        if after:
+            sql += " AND (send_time, id) < (%s, %s)"
+            params.extend(after)
+
+        sql += " ORDER BY send_time DESC, id DESC LIMIT %s"
+        params.append(limit)
+
+    next_of = lambda r: page_cursor(r[9], r[0])
+
+    if fmt:
+        return stream_query("/api/speedtest", sql, params, lambda rows: [speedtest_item(r) for r in rows], fmt, limit, next_of)
 
     items = []
+    next_cursor = None
     try:
-        conn = get_conn()
-        with conn, conn.cursor() as cur:
-            cur.execute(sql, tuple(params))
-            rows = cur.fetchall()
-            print(f"[API] Znaleziono {len(rows)} speedtestów", flush=True)
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql, params)
+            with stage("db_execute"):
+                execute_prepared(cur, sql, tuple(params))
+            with stage("db_fetch"):
+                rows = cur.fetchall()
+            sql_log.debug("Pobrano %d speedtestów", len(rows))
+            count_rows(len(rows))
             
-            for r in rows:
-                items.append({
-                    "id": r[0],
-                    "operator": r[2] if r[2] else "Nieznany",
-                    "downloadSpeed": float(r[3]) if r[3] else 0,
-                    "uploadSpeed": float(r[4]) if r[4] else 0,
-                    "ping": float(r[5]) if r[5] else 0,
-                    "jitter": float(r[6]) if r[6] else None,
-                    "latitude": float(r[7]) if r[7] else None,
-                    "longitude": float(r[8]) if r[8] else None,
-                    "timestamp": r[9].isoformat() if r[9] else None,
-                    "position": [float(r[8]), float(r[7])] if r[7] and r[8] else None
-                })
-        put_conn(conn)
+            with stage("to_dict"):
+                for r in rows:
+                    items.append(speedtest_item(r))
+            if delta:
+                mark = delta_mark(rows, delta, 10)
+            elif len(rows) >= limit > 0:
+                next_cursor = next_of(rows[-1])
         
-        print(f"[API] Zwracam {len(items)} speedtestów", flush=True)
+        api_log.debug("Zwracam %d speedtestów", len(items))
         
     except Exception as e:
-        print(f"[API ERROR] /api/speedtest: {e}", flush=True)
-        return jsonify(error=str(e)), 500
-    
-    return jsonify(items=items)
+        return db_error("/api/speedtest", e)
+
+    if delta:
+        return api_json(items=items, mark=mark, more=len(items) >= limit)
+    return api_json(items=items, next=next_cursor)
+
+
+# Kolumny bts w kolejności używanej przez indeks BTS i bts_entry()
+BTS_COLUMNS = """
+  id, operator, voivodeship, town, location,
+  network_type, band, duplex, btsid, enbi, comments,
+  lat, lon, updated_at, station_id, rnc, carrier, lac"""
+
+
+def bts_entry(r) -> dict:
+    """Wiersz bts (BTS_COLUMNS) -> słownik relatedBts w formacie API"""
+    return {
+        "id": r[0],
+        "siecId": r[1],
+        "wojewodztwoId": r[2],
+        "miejscowosc": r[3],
+        "lokalizacja": r[4],
+        "standard": r[5],
+        "pasmo": r[6],
+        "duplex": r[7],
+        "btsid": r[8],
+        "enbi": r[9],
+        "uwagi": r[10],
+        "lat": float(r[11]) if r[11] else None,
+        "lon": float(r[12]) if r[12] else None,
+        "aktualizacja": r[13].isoformat() if r[13] else None,
+        "stationId": r[14],
+        "rnc": r[15],
+        "carrier": r[16],
+        "lac": r[17]
+    }
+
+
+class BtsSnapshot:
+    """
+    Niezmienny zrzut tabeli bts przygotowany do dopasowywania pomiarów.
+    Współrzędne i LAC trzymane są w tablicach NumPy indeksowanych pozycją wiersza,
+    słowniki kluczy (enbi, (rnc, btsid), btsid) wskazują na krotki pozycji.
+    LAC = 0 oznacza brak LAC (tak jak wcześniej wartość falsy wyłączała filtr).
+    """
+
+    def __init__(self, rows, version: int = 0):
+        self.version = version
+        self.rows = rows
+        self.lat = np.fromiter((float(r[11]) for r in rows), dtype=np.float64, count=len(rows))
+        self.lon = np.fromiter((float(r[12]) for r in rows), dtype=np.float64, count=len(rows))
+        self.lac = np.fromiter((r[17] or 0 for r in rows), dtype=np.int64, count=len(rows))
+
+        by_enb, by_umts, by_gsm = {}, {}, {}
+        for i, r in enumerate(rows):
+            btsid, enbi, rnc = r[8], r[9], r[15]
+            if enbi is not None:
+                by_enb.setdefault(enbi, []).append(i)
+            if rnc is not None and btsid is not None:
+                by_umts.setdefault((rnc, btsid), []).append(i)
+            if btsid is not None:
+                by_gsm.setdefault(btsid, []).append(i)
+
+        self.by_enb = {k: tuple(v) for k, v in by_enb.items()}
+        self.by_umts = {k: tuple(v) for k, v in by_umts.items()}
+        self.by_gsm = {k: tuple(v) for k, v in by_gsm.items()}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def memory_bytes(self) -> int:
+        """Przybliżony rozmiar zrzutu w pamięci (tablice, słowniki kluczy, wiersze)"""
+        total = self.lat.nbytes + self.lon.nbytes + self.lac.nbytes
+        total += sys.getsizeof(self.rows)
+        for r in self.rows:
+            total += sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r if v is not None)
+        for d in (self.by_enb, self.by_umts, self.by_gsm):
+            total += sys.getsizeof(d) + sum(sys.getsizeof(v) for v in d.values())
+        return total
+
+
+# Stacje zmienione w zakresie (change_id od, do] dziennika bts_changes z aktualnym wierszem bts (NULL = usunięta)
+BTS_CHANGED_SQL = """
+SELECT c.bts_id, {columns}
+FROM (SELECT DISTINCT bts_id FROM bts_changes WHERE change_id > %s AND change_id <= %s) c
+LEFT JOIN bts b ON b.id = c.bts_id""".format(columns=", ".join("b." + c.strip() for c in BTS_COLUMNS.split(",")))
+
+
+class BtsIndex:
+    """
+    Indeks BTS w pamięci procesu, odświeżany w tle przez bts_refresh_loop().
+    Pełne przeładowanie przy starcie i co BTS_FULL_REFRESH sekund (wykrywa usunięcia),
+    pomiędzy nimi przyrostowo po updated_at i po dzienniku bts_changes (import_bts.py,
+    także usunięcia). Każde odświeżenie publikuje nowy BtsSnapshot, więc zapytania czytają indeks bez blokad.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._snapshot: Optional[BtsSnapshot] = None
+        self._high_water = None
+        self._change_id = 0
+        self._last_full = 0.0
+        self._stats = {
+            "refreshes": 0,
+            "lastRefreshKind": None,
+            "lastRefreshMs": None,
+            "lastRefreshRows": 0,
+            "lastRefreshAt": None,
+            "memoryBytes": 0,
+        }
+
+    @property
+    def snapshot(self) -> Optional[BtsSnapshot]:
+        return self._snapshot
+
+    def refresh(self, full: bool = False) -> BtsSnapshot:
+        """Odświeża indeks z bazy i zwraca aktualny zrzut"""
+        with self._lock:
+            t0 = time.perf_counter()
+            full = (full or self._snapshot is None or self._high_water is None
+                    or time.monotonic() - self._last_full >= BTS_FULL_REFRESH)
+
+            if full:
+                sql = f"SELECT {BTS_COLUMNS} FROM bts WHERE lat IS NOT NULL AND lon IS NOT NULL"
+                params = ()
+            else:
+                # updated_at to DATE - pobieramy ponownie cały ostatni dzień
+                sql = f"SELECT {BTS_COLUMNS} FROM bts WHERE updated_at >= %s"
+                params = (self._high_water,)
+
+            with db_conn() as conn, conn.cursor() as cur:
+                # Znacznik dziennika przed odczytem tabeli - zmiana zapisana w trakcie trafi do następnego odświeżenia
+                execute_prepared(cur, "SELECT COALESCE(max(change_id), 0) FROM bts_changes")
+                change_id = cur.fetchone()[0]
+                execute_prepared(cur, sql, params)
+                rows = cur.fetchall()
+                logged = []
+                if not full and change_id > self._change_id:
+                    # Stacje z dziennika importu; brak wiersza w bts = stacja usunięta
+                    execute_prepared(cur, BTS_CHANGED_SQL, (self._change_id, change_id))
+                    logged = cur.fetchall()
+
+            changed = full
+            if full:
+                self._rows = {r[0]: r for r in rows}
+                self._last_full = time.monotonic()
+            else:
+                for bts_id, *r in logged:
+                    if r[0] is None or r[11] is None or r[12] is None:
+                        changed = self._rows.pop(bts_id, None) is not None or changed
+                    elif self._rows.get(bts_id) != tuple(r):
+                        self._rows[bts_id] = tuple(r)
+                        changed = True
+                for r in rows:
+                    if r[11] is None or r[12] is None:
+                        changed = self._rows.pop(r[0], None) is not None or changed
+                    elif self._rows.get(r[0]) != r:
+                        self._rows[r[0]] = r
+                        changed = True
+            self._change_id = change_id
+
+            dates = [r[13] for r in rows if r[13] is not None]
+            if dates:
+                self._high_water = max(max(dates), self._high_water or dates[0])
+
+            if changed:
+                version = self._snapshot.version + 1 if self._snapshot else 1
+                self._snapshot = BtsSnapshot(list(self._rows.values()), version)
+                self._stats["memoryBytes"] = self._snapshot.memory_bytes()
+
+            self._stats.update(
+                refreshes=self._stats["refreshes"] + 1,
+                lastRefreshKind="full" if full else "incremental",
+                lastRefreshMs=round((time.perf_counter() - t0) * 1000, 1),
+                lastRefreshRows=len(rows),
+                lastRefreshAt=datetime.utcnow().isoformat() + "Z",
+            )
+            return self._snapshot
+
+    def stats(self) -> dict:
+        snap = self._snapshot
+        return dict(
+            self._stats,
+            loaded=snap is not None,
+            version=snap.version if snap else None,
+            count=len(snap) if snap else 0,
+            enbKeys=len(snap.by_enb) if snap else 0,
+            umtsKeys=len(snap.by_umts) if snap else 0,
+            gsmKeys=len(snap.by_gsm) if snap else 0,
+            highWater=self._high_water.isoformat() if self._high_water else None,
+            changeId=self._change_id,
+        )
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Odległość po kole wielkim w km (działa na skalarach i tablicach NumPy)"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def nearest_bts(lat, lon, lac, groups, snap: BtsSnapshot, max_km: float = MATCH_MAX_KM):
+    """
+    Wybór najbliższego kandydata BTS dla wielu pomiarów naraz.
+    lat/lon/lac to tablice pomiarów, groups[i] to niepusta krotka pozycji kandydatów w snap.
+    Kandydat odpada, gdy oba LAC są znane i różne albo odległość >= max_km.
+    Przy równej odległości wygrywa kandydat wcześniejszy na liście (jak w dawnej pętli).
+    Zwraca tablicę pozycji w snap, -1 = brak dopasowania.
+    """
+    n = len(groups)
+    result = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return result
+
+    # Pary (pomiar, kandydat) ułożone kolejno pomiarami
+    counts = np.fromiter(map(len, groups), dtype=np.int64, count=n)
+    total = int(counts.sum())
+    meas = np.repeat(np.arange(n), counts)
+    cand = np.fromiter(itertools.chain.from_iterable(groups), dtype=np.int64, count=total)
+
+    dist = haversine_km(lat[meas], lon[meas], snap.lat[cand], snap.lon[cand])
+    mlac, blac = lac[meas], snap.lac[cand]
+    ok = (dist < max_km) & ((mlac == 0) | (blac == 0) | (mlac == blac))
+    dist = np.where(ok, dist, np.inf)
+
+    # Pierwsza para w każdej grupie po posortowaniu (pomiar, odległość, kolejność)
+    order = np.lexsort((np.arange(total), dist, meas))
+    first = order[np.r_[True, meas[order][1:] != meas[order][:-1]]]
+    first = first[np.isfinite(dist[first])]
+    result[meas[first]] = cand[first]
+    return result
+
+
+# Pola pomiaru używane przy dopasowaniu: klucze słownika telemetry_item() albo indeksy wiersza z bazy
+MATCH_KEYS = ("enb", "cellId", "networkType", "lac", "latitude", "longitude")
+MATCH_ROW_KEYS = (20, 19, 2, 23, 4, 5)
+
+
+def match_bts(items, snap: BtsSnapshot, keys=MATCH_KEYS):
+    """
+    Dopasowanie BTS do pomiarów (krok 3 /api/telemetry-with-bts), kolejno:
+      - LTE/4G: po eNB; jeśli eNB jest w indeksie, pomiar nie przechodzi do kolejnych reguł
+      - UMTS/3G: cell_id = RNC * 65536 + CID, btsid = CID bez ostatniej cyfry
+      - GSM/2G: btsid = cell_id bez ostatniej cyfry (gdy UMTS nic nie znalazł)
+    items to słowniki (MATCH_KEYS) albo wiersze z bazy (keys=MATCH_ROW_KEYS).
+    Zwraca tablicę pozycji w snap dla każdego pomiaru (-1 = brak dopasowania).
+
+    Zmiana względem dawnej pętli (nie tylko szybkość): odległość to haversine w km z progiem MATCH_MAX_KM,
+    a nie odległość euklidesowa w stopniach < 0.15. Dawny próg w kierunku W-E sięgał tylko ~10.3 km
+    (stopień długości jest krótszy), więc przy domyślnym 16.7 km dopasowanych jest wyraźnie więcej pomiarów
+    (na danych z bench_bts_match.py ok. 1.6 raza - stosunek pól okręgu i dawnej elipsy), a przy kilku
+    kandydatach w zasięgu najbliższa bywa inna stacja. Te same reguły stosują match=db, fa-worker i rematch_bts.py.
+    """
+    k_enb, k_cell, k_nt, k_lac, k_lat, k_lon = keys
+    by_enb, by_umts, by_gsm = snap.by_enb, snap.by_umts, snap.by_gsm
+    rules = ([], []), ([], []), ([], [])  # (indeksy pomiarów, grupy kandydatów) dla LTE, UMTS, GSM
+    # Poziom sprawdzany raz na wywołanie - przy wyłączonym DEBUG pętla nie dotyka loggera
+    debug_gsm = match_log.isEnabledFor(logging.DEBUG)
+
+    for i, it in enumerate(items):
+        enb = it[k_enb]
+        if enb:
+            g = by_enb.get(enb)
+            if g is not None:
+                rules[0][0].append(i)
+                rules[0][1].append(g)
+                continue
+
+        cell_val = it[k_cell]
+        if cell_val is None:
+            continue
+        nt = (it[k_nt] or "").lower()
+
+        if "3g" in nt:
+            rnc_val = int(cell_val) // 65536
+            cid_val = int(cell_val) - rnc_val * 65536
+            # btsid w tabeli bts jest tekstem, więc klucz też musi być stringiem
+            g = by_umts.get((rnc_val, str(cid_val // 10)))
+            if g is not None:
+                rules[1][0].append(i)
+                rules[1][1].append(g)
+
+        if "gsm" in nt or "2g" in nt:
+            btsid_val = int(cell_val) // 10
+            if debug_gsm and random.random() < LOG_SAMPLE_RATE:
+                match_log.debug("GSM: cell_id=%s -> btsid=%s, lac=%s", cell_val, btsid_val, it[k_lac])
+            g = by_gsm.get(str(btsid_val))
+            if g is not None:
+                rules[2][0].append(i)
+                rules[2][1].append(g)
+
+    result = np.full(len(items), -1, dtype=np.int64)
+    for idx, groups in rules:
+        if not idx:
+            continue
+        lat = np.array([items[i][k_lat] for i in idx], dtype=np.float64)
+        lon = np.array([items[i][k_lon] for i in idx], dtype=np.float64)
+        lac = np.array([items[i][k_lac] or 0 for i in idx], dtype=np.int64)
+        best = nearest_bts(lat, lon, lac, groups, snap)
+        idx = np.asarray(idx, dtype=np.int64)
+        # Reguła GSM tylko dla pomiarów, których nie dopasowała reguła UMTS
+        take = (best >= 0) & (result[idx] < 0)
+        result[idx[take]] = best[take]
+    return result
+
+
+_bts_index = BtsIndex()
+
+
+def bts_refresh_loop():
+    """Wątek odświeżający indeks BTS"""
+    while not _stop.wait(BTS_REFRESH_INTERVAL):
+        try:
+            _bts_index.refresh()
+        except Exception as e:
+            bts_log.error("Odświeżanie indeksu BTS nieudane: %s", e)
+
+
+@app.route("/api/bts/index")
+def api_bts_index():
+    """Stan indeksu BTS: liczba stacji, rozmiar w pamięci, czas ostatniego odświeżenia"""
+    return jsonify(_bts_index.stats())
+
+
+def current_bts_snapshot() -> BtsSnapshot:
+    """Aktualny zrzut indeksu BTS; jeśli indeks nie jest jeszcze załadowany (np. start poda), ładuje go synchronicznie"""
+    snap = _bts_index.snapshot
+    if snap is None:
+        snap = _bts_index.refresh(full=True)
+    return snap
+
+
+def attach_bts(items, snap: BtsSnapshot, entries: dict, ref: bool = False) -> int:
+    """
+    Dopisuje relatedBts do pomiarów (krok 3 /api/telemetry-with-bts); przy ref=True tylko
+    btsRef = id stacji, a same stacje trafiają raz do tabeli "bts" odpowiedzi.
+    entries to cache pozycja -> słownik BTS, współdzielony między porcjami jednej odpowiedzi.
+    Zwraca liczbę dopasowanych pomiarów.
+    """
+    matched = 0
+    with stage("bts_match"):
+        for item, pos in zip(items, match_bts(items, snap).tolist()):
+            if pos >= 0:
+                entry = entries.get(pos)
+                if entry is None:
+                    entry = entries[pos] = bts_entry(snap.rows[pos])
+                if ref:
+                    item["btsRef"] = entry["id"]
+                else:
+                    item["relatedBts"] = entry
+                matched += 1
+    BTS_MATCHES.labels("matched").inc(matched)
+    BTS_MATCHES.labels("unmatched").inc(len(items) - matched)
+    return matched
+
+
+def bts_ref_column(rows, snap: BtsSnapshot, entries: dict) -> list:
+    """Dopasowanie dla shape=rows: lista id BTS równoległa do wierszy (None = brak dopasowania)"""
+    refs = []
+    with stage("bts_match"):
+        for pos in match_bts(rows, snap, MATCH_ROW_KEYS).tolist():
+            if pos < 0:
+                refs.append(None)
+                continue
+            entry = entries.get(pos)
+            if entry is None:
+                entry = entries[pos] = bts_entry(snap.rows[pos])
+            refs.append(entry["id"])
+    matched = len(refs) - refs.count(None)
+    BTS_MATCHES.labels("matched").inc(matched)
+    BTS_MATCHES.labels("unmatched").inc(len(refs) - matched)
+    return refs
+
+
+# Dopasowanie po stronie bazy: te same reguły co match_bts, najbliższy kandydat przez sortowanie KNN (<->)
+# po bts.geog. Kandydat odpada przy różnych znanych LAC albo odległości >= MATCH_MAX_KM (ST_DWithin na sferze,
+# jak haversine_km). Reguły UMTS/GSM tylko gdy eNB pomiaru nie ma w tabeli bts; GSM tylko gdy UMTS nic nie dał.
+# Przy równej odległości wygrywa mniejsze id (w trybie python - kolejność w indeksie).
+BTS_MATCH_LAC = "(COALESCE(t.lac, 0) = 0 OR COALESCE(c.lac, 0) = 0 OR c.lac = t.lac)"
+BTS_MATCH_SQL = """
+SELECT t.*, {bts_columns}
+FROM ({telemetry}) t
+CROSS JOIN LATERAL (SELECT ST_SetSRID(ST_MakePoint(t.longitude, t.latitude), 4326)::geography AS geog) p
+LEFT JOIN LATERAL (
+  SELECT EXISTS (SELECT 1 FROM bts x WHERE x.enbi = t.enb AND x.geog IS NOT NULL) AS known
+) enb ON t.enb <> 0
+LEFT JOIN LATERAL (
+  SELECT c.id FROM bts c
+  WHERE enb.known AND c.enbi = t.enb AND c.geog IS NOT NULL AND {lac}
+    AND ST_DWithin(c.geog, p.geog, %s, false)
+  ORDER BY c.geog <-> p.geog, c.id LIMIT 1
+) lte ON true
+LEFT JOIN LATERAL (
+  SELECT c.id FROM bts c
+  WHERE enb.known IS NOT TRUE AND strpos(lower(t.network_type), '3g') > 0
+    AND c.rnc = t.cell_id / 65536 AND c.btsid = (mod(t.cell_id, 65536) / 10)::text
+    AND c.geog IS NOT NULL AND {lac} AND ST_DWithin(c.geog, p.geog, %s, false)
+  ORDER BY c.geog <-> p.geog, c.id LIMIT 1
+) umts ON true
+LEFT JOIN LATERAL (
+  SELECT c.id FROM bts c
+  WHERE enb.known IS NOT TRUE AND umts.id IS NULL
+    AND (strpos(lower(t.network_type), 'gsm') > 0 OR strpos(lower(t.network_type), '2g') > 0)
+    AND c.btsid = (t.cell_id / 10)::text
+    AND c.geog IS NOT NULL AND {lac} AND ST_DWithin(c.geog, p.geog, %s, false)
+  ORDER BY c.geog <-> p.geog, c.id LIMIT 1
+) gsm ON true
+LEFT JOIN bts b ON b.id = COALESCE(lte.id, umts.id, gsm.id)
+ORDER BY {order}
+"""
+# match=stored: stacja dopasowana przy zapisie (telemetry.related_bts_id, fa-worker) - zwykłe złączenie.
+# Kolumny bts pod aliasami bts_*, żeby niekwalifikowane nazwy w WHERE/ORDER BY (id, lac...) wskazywały telemetrię.
+BTS_STORED_JOIN = """
+LEFT JOIN (SELECT {bts_columns} FROM bts b) m ON m.bts_id = telemetry.related_bts_id""".format(
+    bts_columns=", ".join(f"b.{c.strip()} AS bts_{c.strip()}" for c in BTS_COLUMNS.split(",")))
+# Liczba kolumn telemetrii w wierszu zapytania /api/telemetry-with-bts (TELEMETRY_FIELDS + received_at)
+BTS_MATCH_OFFSET = 25
+
+
+def bts_match_engine() -> str:
+    """
+    Parametr match: "python" (krok 3 w aplikacji, indeks w pamięci), "db" (dopasowanie w zapytaniu)
+    albo "stored" (related_bts_id zapisany przy ingestii)
+    """
+    engine = request.args.get("match", BTS_MATCH_ENGINE)
+    if engine not in ("python", "db", "stored"):
+        raise ValueError(f"invalid match value: {engine}")
+    return engine
+
+
+def bts_match_query(sql: str, params: list, order: str, max_km: float = MATCH_MAX_KM):
+    """
+    Owija zapytanie telemetrii (kolumny jak w /api/telemetry-with-bts, z ORDER BY i LIMIT)
+    w BTS_MATCH_SQL: każdy wiersz dostaje na końcu kolumny BTS_COLUMNS dopasowanej stacji (NULL = brak).
+    order to ORDER BY zapytania wewnętrznego - powtarzany na zewnątrz, bo złączenia go nie gwarantują.
+    Zwraca (sql, params).
+    """
+    bts_columns = ", ".join("b." + c.strip() for c in BTS_COLUMNS.split(","))
+    outer_order = ", ".join("t." + o.strip() for o in order.split(","))
+    wrapped = BTS_MATCH_SQL.format(bts_columns=bts_columns, telemetry=sql, lac=BTS_MATCH_LAC, order=outer_order)
+    return wrapped, list(params) + [max_km * 1000] * 3
+
+
+def attach_bts_rows(items, rows, entries: dict, ref: bool = False) -> int:
+    """
+    Odpowiednik attach_bts dla match=db/stored: stacja przychodzi w wierszu (kolumny od BTS_MATCH_OFFSET).
+    entries to cache id -> słownik BTS, współdzielony między porcjami jednej odpowiedzi.
+    """
+    matched = 0
+    with stage("bts_match"):
+        for item, r in zip(items, rows):
+            bts_id = r[BTS_MATCH_OFFSET]
+            if bts_id is None:
+                continue
+            entry = entries.get(bts_id)
+            if entry is None:
+                entry = entries[bts_id] = bts_entry(r[BTS_MATCH_OFFSET:])
+            if ref:
+                item["btsRef"] = bts_id
+            else:
+                item["relatedBts"] = entry
+            matched += 1
+    BTS_MATCHES.labels("matched").inc(matched)
+    BTS_MATCHES.labels("unmatched").inc(len(items) - matched)
+    return matched
+
+
+def bts_ref_column_rows(rows, entries: dict) -> list:
+    """Odpowiednik bts_ref_column dla match=db/stored: id stacji z wierszy (None = brak dopasowania)"""
+    refs = []
+    for r in rows:
+        bts_id = r[BTS_MATCH_OFFSET]
+        if bts_id is not None and bts_id not in entries:
+            entries[bts_id] = bts_entry(r[BTS_MATCH_OFFSET:])
+        refs.append(bts_id)
+    matched = len(refs) - refs.count(None)
+    BTS_MATCHES.labels("matched").inc(matched)
+    BTS_MATCHES.labels("unmatched").inc(len(refs) - matched)
+    return refs
 
 
 @app.route("/api/telemetry-with-bts")
+@cached_response("telemetry", bts=True)
 def api_telemetry_with_bts():
-    minutes = int(request.args.get("minutes", "1440"))
-    limit = int(request.args.get("limit", "100000"))
+    """
+    Endpoint zwracający telemetrię z dopasowaną stacją BTS (relatedBts).
+    Query params:
+      - minutes (int, default 1440): dane z ostatnich X minut
+      - limit (int, default 100000): max liczba rekordów
+      - short_code (str, optional): filtruj po short_code
+      - start_date / end_date (str, optional): zakres czasowy (ISO format), start_date ma pierwszeństwo przed minutes
+      - cursor (str, optional): kursor kolejnej strony ("next" z poprzedniej odpowiedzi)
+      - since_id / since_received_at (optional): tylko rekordy zapisane po znaczniku "mark"
+        z poprzedniej odpowiedzi - oba pola (tryb przyrostowy, bez domyślnego okna minutes, z opóźnieniem DELTA_LAG)
+      - stream (json|ndjson, optional): odpowiedź strumieniowa (kursor po stronie serwera)
+      - bts (inline|ref, default inline): ref - stacje raz w tabeli "bts", pomiary mają tylko btsRef (id)
+      - shape (items|rows, default items): rows - "fields" raz, wiersze jako tablice, kolumna "btsRefs"
+        równoległa do wierszy i tabela "bts" (bez stream)
+      - match (python|db|stored, default BTS_MATCH_ENGINE): db - dopasowanie BTS w zapytaniu (LATERAL + KNN po bts.geog),
+        stored - stacja dopasowana przy zapisie (related_bts_id); w obu wiersze wracają z bazy z dołączoną stacją
+    """
     short_code_filter = request.args.get("short_code")
     start_date = request.args.get("start_date")
     end_date = request.args.get("end_date")
+    bts_ref = request.args.get("bts", "inline") == "ref"
+    try:
+        minutes = minutes_arg(1440)
+        limit = int_arg("limit", 100000, 1, QUERY_MAX_LIMIT)
+        fmt = stream_format()
+        shape = row_shape()
+        after = parse_page_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+        delta = parse_delta()
+        if request.args.get("bts", "inline") not in ("inline", "ref"):
+            raise ValueError(f"invalid bts value: {request.args['bts']}")
+        engine = bts_match_engine()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
     items = []
-    enb_list = set()
-    umts_pairs = set()   # (rnc, btsid_from_cell)
-    gsm_btsids = set()
+    next_cursor = None
     conn = None
 
     try:
-        conn = get_conn()
-
         # ========================================
         # KROK 1: Pobieranie danych telemetrycznych
         # ========================================
@@ -366,18 +2007,19 @@ SELECT
   ST_Y(position::geometry) AS latitude,
   ST_X(position::geometry) AS longitude,
   send_time, rat, nr_mode, band, arfcn, rsrp, rsrq, sinr, rssi, timing_advance,
-  pci, eci, nci, cell_id, enb, sector_id, tac, lac
-FROM telemetry
+  pci, eci, nci, cell_id, enb, sector_id, tac, lac, received_at{stored_columns}
+FROM telemetry{stored_join}
 WHERE 1=1
-        """
+        """.format(stored_columns=", m.*" if engine == "stored" else "",
+                   stored_join=BTS_STORED_JOIN if engine == "stored" else "")
         params = []
 
-        # Filtr czasu: start_date > minutes (fallback)
+        # Filtr czasu: start_date > minutes (fallback); w trybie przyrostowym tylko jawny start_date
         if start_date:
             sql_telemetry += " AND send_time >= %s"
             params.append(start_date)
-        else:
-            sql_telemetry += " AND send_time >= now() - interval %s"
+        elif not delta:
+            sql_telemetry += " AND send_time >= now() - %s::interval"
             params.append(f"{minutes} minutes")
 
         if end_date:
@@ -389,302 +2031,1147 @@ WHERE 1=1
             sql_telemetry += " AND short_code = %s"
             params.append(short_code_filter)
 
-        sql_telemetry += " ORDER BY send_time DESC LIMIT %s"
+        if delta:
+            # Tryb przyrostowy: tylko wiersze zapisane po znaczniku klienta
+            where, where_params = delta_filter("telemetry", delta)
+            sql_telemetry += where
+            params.extend(where_params)
+            order = "received_at, id"
+        else:
+            # Paginacja po kluczu (send_time, id) - bez OFFSET
+            if after:
+                sql_telemetry += " AND (send_time, id) < (%s, %s)"
+                params.extend(after)
+            order = "send_time DESC, id DESC"
+
+        sql_telemetry += f" ORDER BY {order} LIMIT %s"
         params.append(limit)
-        
-        print(f"[SQL] Wykonuję zapytanie telemetry z {len(params)} parametrami", flush=True)
-        
-        with conn.cursor() as cur:
-            cur.execute(sql_telemetry, tuple(params))
-            rows = cur.fetchall()
-            print(f"[SQL] Pobrano {len(rows)} rekordów telemetrii", flush=True)
-            
-            for r in rows:
-                item = {
-                    "id": r[0],
-                    "operator": r[1],
-                    "networkType": r[2],
-                    "signal": int(r[3]),
-                    "latitude": float(r[4]),
-                    "longitude": float(r[5]),
-                    "sendTime": r[6].isoformat(),
-                    "position": [float(r[5]), float(r[4])],
-                    "rat": r[7],
-                    "nrMode": r[8],
-                    "band": r[9],
-                    "arfcn": r[10],
-                    "rsrp": r[11],
-                    "rsrq": r[12],
-                    "sinr": r[13],
-                    "rssi": r[14],
-                    "timingAdvance": r[15],
-                    "pci": r[16],
-                    "eci": r[17],
-                    "nci": r[18],
-                    "cellId": r[19],
-                    "enb": r[20],
-                    "sectorId": r[21],
-                    "tac": r[22],
-                    "lac": r[23]
-                }
-                items.append(item)
-
-                nt = (item["networkType"] or "").lower()
-                cell_id_val = item["cellId"]
-
-                if item["enb"]:  # LTE/4G
-                    enb_list.add(item["enb"])
-
-                # UMTS/3G: cell_id = RNC * 65536 + CID; btsid = CID without last digit
-                if any(k in nt for k in ["3g"]):
-                    if cell_id_val is not None:
-                        try:
-                            rnc_val = int(cell_id_val) // 65536
-                            cid_val = int(cell_id_val) - rnc_val * 65536
-                            btsid_val = cid_val // 10  # drop last digit
-                            umts_pairs.add((rnc_val, btsid_val))
-                        except Exception:
-                            pass
-
-                # GSM/2G: btsid = cell_id without last digit
-                if any(k in nt for k in ["gsm", "2g"]):
-                    if cell_id_val is not None:
-                        try:
-                            btsid_val = int(cell_id_val) // 10
-                            gsm_btsids.add(btsid_val)
-                            print(f"[DEBUG] GSM: cell_id={cell_id_val} -> btsid={btsid_val}, lac={item.get('lac')}", flush=True)
-                        except Exception as e:
-                            print(f"[DEBUG] GSM error: {e}", flush=True)
-        
-        print(f"[DEBUG] Zebrano: enb={len(enb_list)}, umts_pairs={len(umts_pairs)}, gsm_btsids={len(gsm_btsids)}", flush=True)
-        print(f"[DEBUG] gsm_btsids={list(gsm_btsids)[:10]}", flush=True)
-        
+        next_of = lambda r: page_cursor(r[6], r[0])
+
+        if engine == "db":
+            # KROK 2 i 3 w bazie: kolumny dopasowanej stacji dołączone do każdego wiersza
+            sql_telemetry, params = bts_match_query(sql_telemetry, params, order)
+
         # ========================================
-        # KROK 2: Pobieranie BTS dla znalezionych enb
+        # KROK 2: Indeks BTS (w pamięci, bez zapytań do bazy)
         # ========================================
-        bts_by_enb = {}
-        bts_by_umts = {}  # key: (rnc, btsid)
-        bts_by_gsm = {}   # key: btsid
-
-        where_parts = []
-        bts_params = []
-
-        if enb_list:
-            enb_list_tuple = tuple(enb_list)
-            placeholders_enb = ','.join(['%s'] * len(enb_list_tuple))
-            where_parts.append(f"enbi IN ({placeholders_enb})")
-            bts_params.extend(enb_list_tuple)
-
-        if umts_pairs:
-            pair_clauses = []
-            for rnc_val, btsid_val in umts_pairs:
-                pair_clauses.append("(rnc = %s AND btsid = %s)")
-                bts_params.extend([rnc_val, str(btsid_val)])
-            where_parts.append('(' + ' OR '.join(pair_clauses) + ')')
-
-        if gsm_btsids:
-            gsm_tuple = tuple(str(btsid) for btsid in gsm_btsids)
-            placeholders_gsm = ','.join(['%s'] * len(gsm_tuple))
-            where_parts.append(f"btsid IN ({placeholders_gsm})")
-            bts_params.extend(gsm_tuple)
-
-        if where_parts:
-            sql_bts = f"""
-SELECT
-  id, operator, voivodeship, town, location,
-  network_type, band, duplex, btsid, enbi, comments,
-  lat, lon, updated_at, station_id, rnc, carrier, lac
-FROM bts
-WHERE ({' OR '.join(where_parts)})
-  AND lat IS NOT NULL
-  AND lon IS NOT NULL
-            """
-            
-            print(f"[SQL] Wykonuję zapytanie BTS dla filtrów: enb={len(enb_list)}, umts_pairs={len(umts_pairs)}, gsm={len(gsm_btsids)}", flush=True)
-            
-            with conn.cursor() as cur:
-                cur.execute(sql_bts, tuple(bts_params))
+        if engine == "python":
+            snap = current_bts_snapshot()
+            bts_log.debug("Indeks BTS v%s: bts=%d, enb=%d, umts=%d, gsm=%d", snap.version, len(snap), len(snap.by_enb), len(snap.by_umts), len(snap.by_gsm))
+
+        entries = {}
+
+        if fmt:
+            # Tryb strumieniowy: kroki 1 i 3 wykonywane porcjami
+            def to_items(rows):
+                chunk = [telemetry_item(r) for r in rows]
+                if engine != "python":
+                    attach_bts_rows(chunk, rows, entries, ref=bts_ref)
+                else:
+                    attach_bts(chunk, snap, entries, ref=bts_ref)
+                return chunk
+
+            trailer = (lambda: {"bts": list(entries.values())}) if bts_ref else None
+            return stream_query("/api/telemetry-with-bts", sql_telemetry, params, to_items, fmt, limit, next_of, trailer)
+
+        sql_log.debug("Wykonuję zapytanie telemetry z %d parametrami", len(params))
+
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql_telemetry, params)
+            with stage("db_execute"):
+                execute_prepared(cur, sql_telemetry, tuple(params))
+            with stage("db_fetch"):
                 rows = cur.fetchall()
-                print(f"[SQL] Pobrano {len(rows)} stacji BTS", flush=True)
-                
-                for r in rows:
-                    entry = {
-                        "id": r[0],
-                        "siecId": r[1],
-                        "wojewodztwoId": r[2],
-                        "miejscowosc": r[3],
-                        "lokalizacja": r[4],
-                        "standard": r[5],
-                        "pasmo": r[6],
-                        "duplex": r[7],
-                        "btsid": r[8],
-                        "enbi": r[9],
-                        "uwagi": r[10],
-                        "lat": float(r[11]) if r[11] else None,
-                        "lon": float(r[12]) if r[12] else None,
-                        "aktualizacja": r[13].isoformat() if r[13] else None,
-                        "stationId": r[14],
-                        "rnc": r[15],
-                        "carrier": r[16],
-                        "lac": r[17]
-                    }
+        sql_log.debug("Pobrano %d rekordów telemetrii", len(rows))
+        count_rows(len(rows))
+        count = len(rows)
 
-                    if entry["enbi"] is not None:
-                        bts_by_enb.setdefault(entry["enbi"], []).append(entry)
+        if delta:
+            mark = delta_mark(rows, delta, 24)
+        elif count >= limit > 0:
+            next_cursor = next_of(rows[-1])
 
-                    if entry["rnc"] is not None and entry["btsid"] is not None:
-                        bts_by_umts.setdefault((entry["rnc"], entry["btsid"]), []).append(entry)
-
-                    if entry["btsid"] is not None:
-                        bts_by_gsm.setdefault(entry["btsid"], []).append(entry)
-        
-        print(f"[DEBUG] bts_by_gsm keys: {list(bts_by_gsm.keys())[:10]}", flush=True)
-        print(f"[DEBUG] bts_by_enb={len(bts_by_enb)}, bts_by_umts={len(bts_by_umts)}, bts_by_gsm={len(bts_by_gsm)}", flush=True)
-        
         # ========================================
         # KROK 3: Dopasowanie BTS do pomiarów
         # ========================================
-        for item in items:
-            nt = (item["networkType"] or "").lower()
-
-            def pick_best(candidates):
-                best = None
-                best_dist = float('inf')
-                for bts in candidates:
-                    if item["lac"] and bts.get("lac") and item["lac"] != bts["lac"]:
-                        continue
-                    if bts.get("lat") is not None and bts.get("lon") is not None:
-                        dist = ((item["latitude"] - bts["lat"])**2 + (item["longitude"] - bts["lon"])**2)**0.5
-                        if dist < 0.15 and dist < best_dist:
-                            best_dist = dist
-                            best = bts
-                return best
-
-            # LTE/4G: dopasowanie po eNB
-            if item["enb"] and item["enb"] in bts_by_enb:
-                cand = bts_by_enb[item["enb"]]
-                best = pick_best(cand)
-                if best:
-                    item["relatedBts"] = best
+        if shape == "rows" and engine != "python":
+            refs = bts_ref_column_rows(rows, entries)
+            matched_count = count - refs.count(None)
+            payload = {"fields": TELEMETRY_FIELDS + ["receivedAt"], "rows": [r[:BTS_MATCH_OFFSET] for r in rows],
+                       "btsRefs": refs, "bts": list(entries.values())}
+        elif shape == "rows":
+            # Wiersze z bazy trafiają do odpowiedzi bez zamiany na słowniki
+            refs = bts_ref_column(rows, snap, entries)
+            matched_count = count - refs.count(None)
+            payload = {"fields": TELEMETRY_FIELDS + ["receivedAt"], "rows": rows, "btsRefs": refs,
+                       "bts": list(entries.values())}
+        else:
+            with stage("to_dict"):
+                items = [telemetry_item(r) for r in rows]
+            if engine != "python":
+                matched_count = attach_bts_rows(items, rows, entries, ref=bts_ref)
+            else:
+                matched_count = attach_bts(items, snap, entries, ref=bts_ref)
+            del rows
+            payload = {"items": items}
+            if bts_ref:
+                payload["bts"] = list(entries.values())
+
+        match_log.debug("Dopasowane: %d, bez BTS: %d", matched_count, count - matched_count)
+        api_log.debug("Zwrócono %d pomiarów, %d unikalnych BTS", count, len(entries))
+        
+    except Exception as e:
+        return db_error("/api/telemetry-with-bts", e)
+
+    if delta:
+        return api_json(**payload, mark=mark, more=count >= limit)
+    return api_json(**payload, next=next_cursor)
+
+
+# Statystyki z agregatów godzinowych: rozmiar komórki siatki jak w refresh_rollups() (0.01 stopnia)
+ROLLUP_CELL = 100
+
+
+def rollup_loop():
+    """
+    Wątek dopisujący nowe pomiary do agregatów godzinowych (przy zaległościach kilka porcji pod rząd),
+    usuwający z bufora kafle heatmapy, na które te pomiary wpływają, oraz kafle starsze niż HEATMAP_CACHE_DAYS,
+    i co PARTITION_INTERVAL tworzący przyszłe partycje miesięczne oraz stosujący retencję.
+    """
+    last_partitions = 0.0
+    while not _stop.wait(ROLLUP_INTERVAL):
+        total = 0
+        try:
+            while not _stop.is_set():
+                with db_conn(timeout_ms=0) as conn, conn.cursor() as cur:
+                    cur.execute("SELECT refresh_rollups()")
+                    n = cur.fetchone()[0]
+                # -1: odświeża inny worker, 0: brak nowych pomiarów
+                if n <= 0:
+                    break
+                total += n
+            if total:
+                log.info("Agregaty godzinowe: dopisano %d pomiarów", total)
+        except Exception as e:
+            log.error("Odświeżanie agregatów nieudane: %s", e)
+
+        try:
+            with db_conn(timeout_ms=0) as conn, conn.cursor() as cur:
+                cur.execute("SELECT invalidate_heatmap_tiles()")
+                n = cur.fetchone()[0]
+                cur.execute("SELECT evict_heatmap_tiles(%s)", (HEATMAP_CACHE_DAYS,))
+                evicted = cur.fetchone()[0]
+            if n > 0:
+                log.info("Heatmapa: unieważniono %d kafli", n)
+            if evicted > 0:
+                log.info("Heatmapa: usunięto %d kafli starszych niż %d dni", evicted, HEATMAP_CACHE_DAYS)
+        except Exception as e:
+            log.error("Unieważnianie kafli heatmapy nieudane: %s", e)
+
+        if time.monotonic() - last_partitions >= PARTITION_INTERVAL:
+            try:
+                with db_conn(timeout_ms=0) as conn, conn.cursor() as cur:
+                    cur.execute("SELECT action, partition_name FROM maintain_partitions(%s, %s, %s)",
+                                (PARTITION_MONTHS_AHEAD, RETENTION_MONTHS, RETENTION_ARCHIVE))
+                    for action, name in cur.fetchall():
+                        log.info("Partycje: %s %s", action, name)
+                last_partitions = time.monotonic()
+            except Exception as e:
+                log.error("Utrzymanie partycji nieudane: %s", e)
+
+
+def rollup_filters(time_col: str = "hour"):
+    """
+    Warunki WHERE dla tabel *_rollup_hourly z parametrów zapytania (start_date/end_date/minutes, bbox).
+    Zakres czasu zaokrąglany do pełnych godzin. Zwraca (sql, params); ValueError przy złym bbox.
+    """
+    sql, params = f"{time_col} >= date_trunc('hour', ", []
+    if request.args.get("start_date"):
+        sql += "%s::timestamptz)"
+        params.append(request.args["start_date"])
+    elif request.args.get("minutes"):
+        sql += "now() - %s::interval)"
+        params.append(f"{minutes_arg(None)} minutes")
+    else:
+        sql += "now() - interval '30 days')"
+
+    if request.args.get("end_date"):
+        sql += f" AND {time_col} <= %s::timestamptz"
+        params.append(request.args["end_date"])
+
+    if request.args.get("bbox"):
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(v) for v in request.args["bbox"].split(","))
+        except ValueError:
+            raise ValueError("bbox must be minLon,minLat,maxLon,maxLat")
+        sql += " AND cell_x BETWEEN %s AND %s AND cell_y BETWEEN %s AND %s"
+        params.extend([math.floor(min_lon * ROLLUP_CELL), math.floor(max_lon * ROLLUP_CELL),
+                       math.floor(min_lat * ROLLUP_CELL), math.floor(max_lat * ROLLUP_CELL)])
+    return sql, params
+
+
+def stat_summary(n, total, lo, hi) -> dict:
+    return {"mean": round(total / n, 2) if n else None, "min": lo, "max": hi}
+
+
+@app.route("/api/stats")
+def api_stats():
+    """
+    Endpoint zwracający podsumowania dla dashboardu z agregatów godzinowych
+    (telemetry_rollup_hourly, speed_test_rollup_hourly) - czas zapytania nie zależy od liczby pomiarów.
+    Granulacja: pełne godziny i komórki 0.01 stopnia; pomiary z ostatniej minuty mogą jeszcze nie być ujęte.
+    Query params:
+      - minutes (int, optional): dane z ostatnich X minut (domyślnie 30 dni)
+      - start_date / end_date (str, optional): zakres czasowy (ISO format), start_date ma pierwszeństwo przed minutes
+      - operator (str, optional): filtruj po operatorze (znormalizowanym)
+      - network_type (str, optional): filtruj po technologii (tylko telemetria)
+      - bbox (minLon,minLat,maxLon,maxLat, optional): tylko komórki siatki w prostokącie
+    """
+    operator_filter = request.args.get("operator")
+    network_type_filter = request.args.get("network_type")
+    try:
+        where, params = rollup_filters()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    tel_where, tel_params = where, list(params)
+    st_where, st_params = where, list(params)
+    if operator_filter:
+        tel_where += " AND operator = %s"
+        tel_params.append(operator_filter)
+        st_where += " AND operator = %s"
+        st_params.append(operator_filter)
+    if network_type_filter:
+        tel_where += " AND network_type = %s"
+        tel_params.append(network_type_filter)
+
+    # Jeden przebieg po agregatach: suma, po operatorze, po technologii i operator x technologia
+    tel_sql = f"""
+SELECT
+  GROUPING(operator, network_type) AS grp,
+  operator,
+  network_type,
+  sum(n),
+  sum(signal_sum), min(signal_min), max(signal_max),
+  sum(rsrp_n), sum(rsrp_sum), min(rsrp_min), max(rsrp_max),
+  sum(sinr_n), sum(sinr_sum), min(sinr_min), max(sinr_max)
+FROM telemetry_rollup_hourly
+WHERE {tel_where}
+GROUP BY GROUPING SETS ((), (operator), (network_type), (operator, network_type))
+ORDER BY grp, operator, network_type
+"""
+    st_sql = f"""
+SELECT
+  GROUPING(operator) AS grp,
+  operator,
+  sum(n),
+  sum(download_sum), sum(upload_sum), sum(latency_sum), sum(jitter_sum)
+FROM speed_test_rollup_hourly
+WHERE {st_where}
+GROUP BY GROUPING SETS ((), (operator))
+ORDER BY grp, operator
+"""
+
+    telemetry = {"total": None, "byOperator": [], "byNetworkType": [], "byOperatorNetwork": []}
+    speedtest = {"total": None, "byOperator": []}
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            with stage("db_execute"):
+                execute_prepared(cur, tel_sql, tel_params)
+                tel_rows = cur.fetchall()
+                execute_prepared(cur, st_sql, st_params)
+                st_rows = cur.fetchall()
+                execute_prepared(cur, "SELECT name, updated_at FROM rollup_state")
+                updated = dict(cur.fetchall())
+    except Exception as e:
+        return db_error("/api/stats", e)
+
+    with stage("to_dict"):
+        # GROUPING(): 0 - operator i technologia, 1 - sam operator, 2 - sama technologia, 3 - suma
+        buckets = {0: "byOperatorNetwork", 1: "byOperator", 2: "byNetworkType"}
+        for r in tel_rows:
+            n = int(r[3] or 0)
+            entry = {
+                "count": n,
+                "signal": stat_summary(n, r[4], r[5], r[6]),
+                "rsrp": stat_summary(r[7], r[8], r[9], r[10]),
+                "sinr": stat_summary(r[11], r[12], r[13], r[14]),
+            }
+            if r[0] == 3:
+                telemetry["total"] = entry
                 continue
+            if r[0] in (0, 1):
+                entry["operator"] = r[1]
+            if r[0] in (0, 2):
+                entry["networkType"] = r[2]
+            telemetry[buckets[r[0]]].append(entry)
+
+        for r in st_rows:
+            n = int(r[2] or 0)
+            entry = {
+                "count": n,
+                "downloadMbps": round(float(r[3]) / n, 2) if n else None,
+                "uploadMbps": round(float(r[4]) / n, 2) if n else None,
+                "latencyMs": round(float(r[5]) / n, 1) if n else None,
+                "jitterMs": round(float(r[6]) / n, 1) if n else None,
+            }
+            if r[0] == 1:
+                speedtest["total"] = entry
+            else:
+                entry["operator"] = r[1]
+                speedtest["byOperator"].append(entry)
+
+    count_rows(len(tel_rows) + len(st_rows))
+    return api_json(telemetry=telemetry, speedtest=speedtest,
+                    updatedAt={"telemetry": updated.get("telemetry"), "speedtest": updated.get("speed_test")})
+
+
+# Eksport: kolumny (wyrażenie SQL, nagłówek jak w eksporcie z dashboardu, typ dla Parquet)
+EXPORTS = {
+    "telemetry": {
+        "table": "telemetry",
+        "columns": [
+            ("id", "id", "int64"),
+            ("operator", "operator", "string"),
+            ("network_type", "networkType", "string"),
+            ("nr_mode", "nrMode", "string"),
+            ("signal", "signal", "int16"),
+            ("rsrp", "rsrp", "int32"),
+            ("rsrq", "rsrq", "int32"),
+            ("sinr", "sinr", "int32"),
+            ("rssi", "rssi", "int32"),
+            ("rat", "rat", "string"),
+            ("band", "band", "string"),
+            ("arfcn", "arfcn", "int32"),
+            ("pci", "pci", "int32"),
+            ("eci", "eci", "int64"),
+            ("nci", "nci", "int64"),
+            ("enb", "enb", "int32"),
+            ("cell_id", "cellId", "int64"),
+            ("sector_id", "sectorId", "int32"),
+            ("timing_advance", "timingAdvance", "int32"),
+            ("tac", "tac", "int32"),
+            ("lac", "lac", "int32"),
+            ("ST_Y(position::geometry)", "latitude", "float64"),
+            ("ST_X(position::geometry)", "longitude", "float64"),
+            ("send_time", "sendTime", "timestamp"),
+        ],
+    },
+    "speedtest": {
+        "table": "speed_test",
+        "columns": [
+            ("id", "id", "int64"),
+            ("operator", "operator", "string"),
+            ("download_mbps", "downloadSpeed", "float64"),
+            ("upload_mbps", "uploadSpeed", "float64"),
+            ("latency_ms", "ping", "int64"),
+            ("jitter_ms", "jitter", "int64"),
+            ("ST_Y(position::geometry)", "latitude", "float64"),
+            ("ST_X(position::geometry)", "longitude", "float64"),
+            ("send_time", "timestamp", "timestamp"),
+        ],
+    },
+}
+
+
+class _CopyQueueWriter:
+    """
+    Plikopodobny cel dla copy_expert: porcje z COPY TO STDOUT trafiają do ograniczonej kolejki,
+    z której czyta generator odpowiedzi (przeciwciśnienie - COPY czeka na wolnego klienta).
+    """
 
-            # UMTS/3G: cell_id -> RNC + CID, btsid = CID bez ostatniej cyfry
-            if any(k in nt for k in ["3g"]):
-                cell_val = item.get("cellId")
-                if cell_val is not None:
-                    try:
-                        rnc_val = int(cell_val) // 65536
-                        cid_val = int(cell_val) - rnc_val * 65536
-                        btsid_val = cid_val // 10
-                        key = (rnc_val, str(btsid_val))
-                        if key in bts_by_umts:
-                            best = pick_best(bts_by_umts[key])
-                            if best:
-                                item["relatedBts"] = best
-                                continue
-                    except Exception:
-                        pass
-
-            # GSM/2G: btsid = cell_id bez ostatniej cyfry
-            if any(k in nt for k in ["gsm", "2g"]):
-                cell_val = item.get("cellId")
-                if cell_val is not None:
-                    try:
-                        btsid_val = int(cell_val) // 10
-                        # Klucz w słowniku używa str(btsid), więc tutaj też musi być string
-                        if str(btsid_val) in bts_by_gsm:
-                            best = pick_best(bts_by_gsm[str(btsid_val)])
-                            if best:
-                                item["relatedBts"] = best
-                                continue
-                    except Exception:
-                        pass
-        
-        put_conn(conn)
-        
-        matched_count = sum(1 for item in items if "relatedBts" in item)
-        unmatched_count = len(items) - matched_count
-
-        unique_bts_ids = set()
-        for lst in bts_by_enb.values():
-            for e in lst:
-                unique_bts_ids.add(e["id"])
-        for lst in bts_by_umts.values():
-            for e in lst:
-                unique_bts_ids.add(e["id"])
-        for lst in bts_by_gsm.values():
-            for e in lst:
-                unique_bts_ids.add(e["id"])
-
-        print(f"[API] Dopasowane: {matched_count}, Bez BTS: {unmatched_count}")
-        print(f"[API] Zwrócono {len(items)} pomiarów, {len(unique_bts_ids)} unikalnych BTS, {matched_count} dopasowań", flush=True)
-        
+    def __init__(self, q: queue.Queue, cancelled: threading.Event):
+        self.q = q
+        self.cancelled = cancelled
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise IOError("export cancelled")
+            try:
+                self.q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self.put(bytes(data))
+
+
+def stream_copy_csv(endpoint: str, copy_sql: str):
+    """
+    Generator CSV: COPY ... TO STDOUT wykonywany w osobnym wątku i przekazywany porcjami do klienta.
+    Błąd przed pierwszą porcją - wyjątek przed wysłaniem nagłówków (500); po niej - wiersz "# ERROR: ..."
+    na końcu pliku i zerwane połączenie zamiast poprawnie zakończonej odpowiedzi 200.
+    """
+    conn = get_conn()
+    q = queue.Queue(maxsize=64)
+    cancelled = threading.Event()
+    writer = _CopyQueueWriter(q, cancelled)
+    errors = []
+
+    def run():
+        try:
+            set_statement_timeout(conn, EXPORT_STATEMENT_TIMEOUT_MS)
+            with conn.cursor() as cur:
+                cur.copy_expert(copy_sql, writer)
+            conn.commit()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                writer.put(None)
+            except IOError:
+                pass
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    finished = False
+    try:
+        # Pierwsza porcja przed nagłówkami odpowiedzi: COPY, który nie zwrócił nic, kończy się błędem 500
+        chunk = q.get()
+        if chunk is None and errors:
+            api_log.error("%s: %s", endpoint, errors[0])
+            raise errors[0]
+        # BOM UTF-8 dla Excela, jak w eksporcie z dashboardu
+        yield "\ufeff".encode()
+        while chunk is not None:
+            yield chunk
+            chunk = q.get()
+        finished = True
+        if errors:
+            # Błąd po wysłaniu części pliku: znacznik na końcu i zerwanie odpowiedzi (bez końcowej porcji
+            # chunked), żeby przeglądarka i klienci HTTP nie uznali uciętego pliku za kompletny
+            api_log.error("%s: %s", endpoint, errors[0])
+            yield f"\n# ERROR: export incomplete: {errors[0]}\n".encode()
+            raise errors[0]
+    finally:
+        cancelled.set()
+        if not finished:
+            # Klient się rozłączył - COPY czekający na kolejną porcję z bazy przerywany od razu,
+            # zamiast trzymać wątek i połączenie do końca zapytania
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                pass
+        t.join(EXPORT_CANCEL_WAIT)
+        # Połączenie po przerwanym COPY nie wraca do puli
+        put_conn(conn, close=not finished or bool(errors) or t.is_alive())
+
+
+def stream_parquet(endpoint: str, sql: str, params, spec):
+    """
+    Generator Parquet: wiersze z kursora po stronie serwera zapisywane grupami po EXPORT_BATCH
+    do pliku tymczasowego (Parquet wymaga stopki, więc nie da się go wysyłać w trakcie zapisu),
+    potem plik wysyłany porcjami.
+    """
+    types = {"int16": pa.int16(), "int32": pa.int32(), "int64": pa.int64(), "float64": pa.float64(),
+             "string": pa.string(), "timestamp": pa.timestamp("us", tz="UTC")}
+    schema = pa.schema([(name, types[kind]) for _, name, kind in spec])
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as spool:
+        conn = get_conn()
+        try:
+            with conn, conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+                set_statement_timeout(conn, EXPORT_STATEMENT_TIMEOUT_MS)
+                cur.execute(sql, tuple(params))
+                with pq.ParquetWriter(spool, schema) as writer:
+                    while True:
+                        rows = cur.fetchmany(EXPORT_BATCH)
+                        if not rows:
+                            break
+                        arrays = [pa.array(col, type=f.type) for col, f in zip(zip(*rows), schema)]
+                        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        except Exception as e:
+            api_log.exception("%s: %s", endpoint, e)
+            raise
+        finally:
+            put_conn(conn)
+
+        spool.seek(0)
+        while True:
+            chunk = spool.read(1 << 16)
+            if not chunk:
+                break
+            yield chunk
+
+
+@app.route("/api/export/<dataset>")
+def api_export(dataset):
+    """
+    Eksport pełnych danych (telemetry lub speedtest) strumieniowo, w stałej pamięci.
+    Query params:
+      - format (csv|parquet, default csv): CSV przez COPY ... TO STDOUT, Parquet wymaga pyarrow
+      - start_date / end_date (str, optional): zakres czasowy (ISO format)
+      - minutes (int, optional): dane z ostatnich X minut, gdy brak start_date (domyślnie 30 dni)
+      - operator (str, optional): filtruj po operatorze
+      - short_code (str, optional): filtruj po short_code
+    """
+    cfg = EXPORTS.get(dataset)
+    if cfg is None:
+        return jsonify(error=f"unknown dataset: {dataset}"), 404
+
+    fmt = request.args.get("format", "csv").lower()
+    if fmt not in ("csv", "parquet"):
+        return jsonify(error=f"invalid format: {fmt}"), 400
+    if fmt == "parquet" and pa is None:
+        return jsonify(error="Parquet export is not available on this server"), 406
+
+    try:
+        minutes = minutes_arg(None)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    operator_filter = request.args.get("operator")
+    short_code_filter = request.args.get("short_code")
+    start_date = request.args.get("start_date")
+    end_date = request.args.get("end_date")
+
+    columns = ", ".join(f'{expr} AS "{name}"' for expr, name, _ in cfg["columns"])
+    sql = f"SELECT {columns} FROM {cfg['table']} WHERE position IS NOT NULL"
+    params = []
+
+    if start_date:
+        sql += " AND send_time >= %s"
+        params.append(start_date)
+    elif minutes:
+        sql += " AND send_time >= now() - %s::interval"
+        params.append(f"{minutes} minutes")
+    else:
+        sql += " AND send_time >= now() - interval '30 days'"
+
+    if end_date:
+        sql += " AND send_time <= %s"
+        params.append(end_date)
+
+    if operator_filter:
+        sql += " AND operator = %s"
+        params.append(operator_filter)
+
+    if short_code_filter:
+        sql += " AND short_code = %s"
+        params.append(short_code_filter)
+
+    sql += " ORDER BY send_time, id"
+
+    endpoint = f"/api/export/{dataset}"
+    filename = f"{dataset}_{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.{fmt}"
+
+    if fmt == "parquet":
+        body = stream_parquet(endpoint, sql, params, cfg["columns"])
+        mimetype = "application/vnd.apache.parquet"
+    else:
+        try:
+            with db_conn() as conn, conn.cursor() as cur:
+                copy_sql = cur.mogrify(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true, DELIMITER ';')", tuple(params)).decode()
+        except Exception as e:
+            return db_error(endpoint, e)
+        body = stream_copy_csv(endpoint, copy_sql)
+        mimetype = "text/csv"
+
+    resp = stream_response(body, mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return resp
+
+
+# Połowa obwodu Ziemi w Web Mercator (EPSG:3857)
+MERCATOR_HALF = 20037508.342789244
+
+
+def tile_bounds_3857(z: int, x: int, y: int):
+    """Granice kafla z/x/y (schemat XYZ) w metrach EPSG:3857: (minx, miny, maxx, maxy)"""
+    size = 2 * MERCATOR_HALF / (1 << z)
+    minx = -MERCATOR_HALF + x * size
+    maxy = MERCATOR_HALF - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def mercator_to_lonlat(mx: float, my: float):
+    """Konwersja punktu EPSG:3857 -> (lon, lat) w stopniach"""
+    lon = mx / MERCATOR_HALF * 180.0
+    lat = math.degrees(2 * math.atan(math.exp(my / MERCATOR_HALF * math.pi)) - math.pi / 2)
+    return lon, lat
+
+
+@app.route("/api/telemetry/tiles/<int:z>/<int:x>/<int:y>")
+@cached_response("telemetry")
+def api_telemetry_tiles(z, x, y):
+    """
+    Endpoint zwracający telemetrię zagregowaną do siatki komórek w obrębie kafla z/x/y.
+    Rozmiar odpowiedzi zależy od liczby niepustych komórek, a nie od liczby pomiarów.
+    Query params:
+      - grid (int, default 64): liczba komórek na bok kafla (1-256)
+      - minutes (int, default 1440): dane z ostatnich X minut
+      - start_date / end_date (str, optional): zakres czasowy (ISO format), start_date ma pierwszeństwo przed minutes
+      - operator (str, optional): filtruj po operatorze
+      - short_code (str, optional): filtruj po short_code
+    """
+    if not (0 <= z <= 22) or not (0 <= x < (1 << z)) or not (0 <= y < (1 << z)):
+        return jsonify(error="invalid tile coordinates"), 400
+
+    try:
+        grid = int_arg("grid", 64, 1, 256)
+        minutes = minutes_arg(1440)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    operator_filter = request.args.get("operator")
+    short_code_filter = request.args.get("short_code")
+    start_date = request.args.get("start_date")
+    end_date = request.args.get("end_date")
+
+    minx, miny, maxx, maxy = tile_bounds_3857(z, x, y)
+    cell = (maxx - minx) / grid
+
+    # Filtr przestrzenny na geography korzysta z indeksu telemetry_position_gix,
+    # dokładne przycięcie do kafla i binowanie odbywa się już w EPSG:3857
+    sql = """
+SELECT
+  LEAST(floor((ST_X(p) - %s) / %s)::int, %s) AS cx,
+  LEAST(floor((%s - ST_Y(p)) / %s)::int, %s) AS cy,
+  op,
+  network_type,
+  count(*),
+  sum(signal),
+  min(signal),
+  max(signal),
+  avg(rsrp),
+  min(rsrp),
+  max(rsrp),
+  avg(sinr),
+  min(sinr),
+  max(sinr)
+FROM (
+  SELECT
+    ST_Transform(position::geometry, 3857) AS p,
+    COALESCE(operator_norm4, operator) AS op,
+    network_type, signal, rsrp, sinr
+  FROM telemetry
+  WHERE position IS NOT NULL
+    """
+    params = [minx, cell, grid - 1, maxy, cell, grid - 1]
+
+    # Dla z < 2 kafel obejmuje pół globu i nie da się go wyrazić jako poligon geography -
+    # wtedy tylko przycięcie w EPSG:3857 niżej (jak w api_vector_tile)
+    if z >= 2:
+        sql += " AND position && ST_Transform(ST_MakeEnvelope(%s, %s, %s, %s, 3857), 4326)::geography"
+        params.extend([minx, miny, maxx, maxy])
+
+    if start_date:
+        sql += " AND send_time >= %s"
+        params.append(start_date)
+    else:
+        sql += " AND send_time >= now() - %s::interval"
+        params.append(f"{minutes} minutes")
+
+    if end_date:
+        sql += " AND send_time <= %s"
+        params.append(end_date)
+
+    if operator_filter:
+        sql += " AND operator = %s"
+        params.append(operator_filter)
+
+    if short_code_filter:
+        sql += " AND short_code = %s"
+        params.append(short_code_filter)
+
+    sql += """
+) t
+WHERE p && ST_MakeEnvelope(%s, %s, %s, %s, 3857)
+GROUP BY 1, 2, 3, 4
+    """
+    params.extend([minx, miny, maxx, maxy])
+
+    def summary(mean, lo, hi):
+        if mean is None:
+            return None
+        return {"mean": round(float(mean), 1), "min": lo, "max": hi}
+
+    cells = {}
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql, params)
+            with stage("db_execute"):
+                execute_prepared(cur, sql, tuple(params))
+            for r in cur.fetchall():
+                key = (r[0], r[1])
+                c = cells.get(key)
+                if c is None:
+                    cx, cy = r[0], r[1]
+                    lon, lat = mercator_to_lonlat(minx + (cx + 0.5) * cell, maxy - (cy + 0.5) * cell)
+                    c = cells[key] = {
+                        "x": cx,
+                        "y": cy,
+                        "lat": round(lat, 6),
+                        "lon": round(lon, 6),
+                        "count": 0,
+                        "_sum": 0,
+                        "signal": {"min": r[6], "max": r[7]},
+                        "groups": []
+                    }
+                c["count"] += r[4]
+                c["_sum"] += r[5]
+                c["signal"]["min"] = min(c["signal"]["min"], r[6])
+                c["signal"]["max"] = max(c["signal"]["max"], r[7])
+                c["groups"].append({
+                    "operator": r[2],
+                    "networkType": r[3],
+                    "count": r[4],
+                    "signal": round(r[5] / r[4], 1),
+                    "rsrp": summary(r[8], r[9], r[10]),
+                    "sinr": summary(r[11], r[12], r[13])
+                })
     except Exception as e:
-        print(f"[API ERROR] /api/telemetry-with-bts: {e}", flush=True)
-        import traceback
-        traceback.print_exc()
-        return jsonify(error=str(e)), 500
-    
-    return jsonify(items=items)
+        return db_error("/api/telemetry/tiles", e)
+
+    for c in cells.values():
+        c["signal"]["mean"] = round(c.pop("_sum") / c["count"], 1)
+
+    sw = mercator_to_lonlat(minx, miny)
+    ne = mercator_to_lonlat(maxx, maxy)
+    return api_json(
+        tile={"z": z, "x": x, "y": y, "grid": grid, "bounds": [sw[0], sw[1], ne[0], ne[1]]},
+        cells=list(cells.values())
+    )
+
+
+# Komórki geohash zapisywane przez fa-worker (kolumny geohash5/6/7 w telemetry i speed_test)
+GEOHASH_PRECISIONS = (5, 6, 7)
+GEOHASH_CHARS = set("0123456789bcdefghjkmnpqrstuvwxyz")
+
+
+@app.route("/api/telemetry/cells")
+@cached_response("telemetry")
+def api_telemetry_cells():
+    """
+    Endpoint zwracający statystyki telemetrii w komórkach geohash (heatmapa, luki w zasięgu).
+    Grupowanie po indeksowanej kolumnie geohashN zamiast obliczeń ST_* dla każdego pomiaru.
+    Query params:
+      - precision (int, default 6): rozdzielczość komórki: 5 (~4.9 km), 6 (~1.2 km), 7 (~150 m)
+      - prefix (str, optional): tylko komórki w obrębie geohasha (np. "u3qc" - okolice Warszawy)
+      - minutes (int, default 1440): dane z ostatnich X minut
+      - start_date / end_date (str, optional): zakres czasowy (ISO format), start_date ma pierwszeństwo przed minutes
+      - operator (str, optional): filtruj po operatorze
+      - network_type (str, optional): filtruj po technologii
+    """
+    try:
+        precision = int_arg("precision", 6, min(GEOHASH_PRECISIONS), max(GEOHASH_PRECISIONS))
+        minutes = minutes_arg(1440)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    prefix = request.args.get("prefix", "").lower()
+    if len(prefix) > max(GEOHASH_PRECISIONS) or not set(prefix) <= GEOHASH_CHARS:
+        return jsonify(error="invalid geohash prefix"), 400
+    operator_filter = request.args.get("operator")
+    network_type_filter = request.args.get("network_type")
+    start_date = request.args.get("start_date")
+    end_date = request.args.get("end_date")
+
+    col = f"geohash{precision}"
+    sql = f"""
+SELECT
+  {col},
+  count(*),
+  avg(signal),
+  min(signal),
+  max(signal),
+  avg(rsrp),
+  avg(sinr)
+FROM telemetry
+WHERE {col} IS NOT NULL
+    """
+    params = []
+
+    if start_date:
+        sql += " AND send_time >= %s"
+        params.append(start_date)
+    else:
+        sql += " AND send_time >= now() - %s::interval"
+        params.append(f"{minutes} minutes")
+
+    if end_date:
+        sql += " AND send_time <= %s"
+        params.append(end_date)
+
+    # Prefiks na geohash7 (COLLATE "C") - zakres w indeksie B-tree
+    if prefix:
+        sql += " AND geohash7 LIKE %s"
+        params.append(prefix + "%")
+
+    if operator_filter:
+        sql += " AND operator = %s"
+        params.append(operator_filter)
+
+    if network_type_filter:
+        sql += " AND network_type = %s"
+        params.append(network_type_filter)
+
+    # Środek komórki liczony już po agregacji, raz na komórkę
+    sql = f"""
+SELECT c.*, ST_Y(ST_PointFromGeoHash(c.{col})), ST_X(ST_PointFromGeoHash(c.{col}))
+FROM ({sql} GROUP BY {col}) c
+ORDER BY 1
+    """
+
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql, params)
+            with stage("db_execute"):
+                execute_prepared(cur, sql, tuple(params))
+            with stage("db_fetch"):
+                rows = cur.fetchall()
+    except Exception as e:
+        return db_error("/api/telemetry/cells", e)
+
+    with stage("to_dict"):
+        cells = [{
+            "geohash": r[0],
+            "lat": round(r[7], 6),
+            "lon": round(r[8], 6),
+            "count": r[1],
+            "signal": {"mean": round(float(r[2]), 1), "min": r[3], "max": r[4]},
+            "rsrp": round(float(r[5]), 1) if r[5] is not None else None,
+            "sinr": round(float(r[6]), 1) if r[6] is not None else None,
+        } for r in rows]
+    count_rows(len(cells))
+    return api_json(precision=precision, prefix=prefix or None, cells=cells)
+
+
+# Heatmapa zasięgu: kafle interpolowane w bazie (postgis_raster) i buforowane w heatmap_tile_cache
+HEATMAP_TILE_PX = 256
+HEATMAP_MIN_ZOOM = 5
+HEATMAP_MAX_ZOOM = 15
+HEATMAP_MAX_DAYS = 90
+# Promień interpolacji (= margines kafla w invalidate_heatmap_tiles(): 16/256) i siatka uśredniania pomiarów [px]
+HEATMAP_RADIUS_PX = 16
+HEATMAP_SNAP_PX = 4
+HEATMAP_NODATA = -9999
+# Skale kolorów dla ST_ColorMap ("wartość R G B A", interpolowane), progi jak kolory sygnału na mapie
+HEATMAP_METRICS = {
+    "signal": "0 34 197 94 180\n-60 34 197 94 180\n-77 234 179 8 180\n-92 249 115 22 180\n"
+              "-110 239 68 68 180\n-150 239 68 68 180\nnv 0 0 0 0",
+    "rsrp": "-44 34 197 94 180\n-80 34 197 94 180\n-95 234 179 8 180\n-105 249 115 22 180\n"
+            "-115 239 68 68 180\n-140 239 68 68 180\nnv 0 0 0 0",
+    "sinr": "40 34 197 94 180\n20 34 197 94 180\n10 234 179 8 180\n3 249 115 22 180\n"
+            "-3 239 68 68 180\n-20 239 68 68 180\nnv 0 0 0 0",
+}
+HEATMAP_FORMATS = {"png": "image/png", "tif": "image/tiff"}
+
+
+@app.route("/api/heatmap/<metric>/<int:z>/<int:x>/<int:y>.<fmt>")
+def api_heatmap_tile(metric, z, x, y, fmt):
+    """
+    Endpoint zwracający kafel rastrowy heatmapy zasięgu (256x256, EPSG:3857) dla metryki signal, rsrp lub sinr.
+    Wartości interpolowane (odwrotność odległości) z pomiarów uśrednionych w siatce 4 px; poza promieniem
+    16 px od pomiarów kafel jest przezroczysty. png - kolorowy obraz do nałożenia na mapę,
+    tif - GeoTIFF float32 z surowymi wartościami. Kafel bez pomiarów: 204 No Content.
+    Kafle buforowane w heatmap_tile_cache; nowe pomiary usuwają z bufora tylko kafle, na które wpływają.
+    Query params:
+      - operator (str, optional): filtruj po operatorze
+      - days (int, default 30): okno czasowe w dniach (1-90), kończące się w end_date
+      - end_date (YYYY-MM-DD, optional): ostatni dzień okna (domyślnie dziś)
+    """
+    colormap = HEATMAP_METRICS.get(metric)
+    if colormap is None or fmt not in HEATMAP_FORMATS:
+        return jsonify(error=f"unknown heatmap: {metric}.{fmt}"), 404
+    if not (HEATMAP_MIN_ZOOM <= z <= HEATMAP_MAX_ZOOM) or not (0 <= x < (1 << z)) or not (0 <= y < (1 << z)):
+        return jsonify(error=f"invalid tile coordinates (zoom {HEATMAP_MIN_ZOOM}-{HEATMAP_MAX_ZOOM})"), 400
+    try:
+        days = int(request.args.get("days", "30"))
+        end_day = date.fromisoformat(request.args["end_date"][:10]) if request.args.get("end_date") \
+            else datetime.utcnow().date()
+    except ValueError:
+        return jsonify(error="days must be an integer and end_date YYYY-MM-DD"), 400
+    if not 1 <= days <= HEATMAP_MAX_DAYS:
+        return jsonify(error=f"days must be between 1 and {HEATMAP_MAX_DAYS}"), 400
+    operator_filter = request.args.get("operator") or ""
+
+    key = (operator_filter, metric, fmt, z, x, y, end_day, days)
+    minx, _, maxx, maxy = tile_bounds_3857(z, x, y)
+    px = (maxx - minx) / HEATMAP_TILE_PX
+
+    # Pomiary z kafla i marginesu promienia interpolacji, uśrednione w siatce - raster liczony
+    # z najwyżej kilku tysięcy punktów niezależnie od liczby pomiarów
+    where = f"""
+    position && ST_Transform(ST_TileEnvelope(%s, %s, %s, margin => %s), 4326)::geography
+    AND {metric} IS NOT NULL
+    AND send_time >= %s::date - %s::int
+    AND send_time < %s::date + 1
+    """
+    params = [z, x, y, HEATMAP_RADIUS_PX / HEATMAP_TILE_PX, end_day, days - 1, end_day]
+    if operator_filter:
+        where += " AND operator = %s"
+        params.append(operator_filter)
+
+    raster = f"""ST_InterpolateRaster(
+    ST_Collect(ST_MakePoint(ST_X(p), ST_Y(p), v)),
+    %s,
+    ST_AddBand(ST_MakeEmptyRaster({HEATMAP_TILE_PX}, {HEATMAP_TILE_PX}, %s, %s, %s, %s, 0, 0, 3857), '32BF'::text, %s, %s)
+  )"""
+    params.extend([
+        f"invdistnn:power=2.0:smoothing=0.0:radius={px * HEATMAP_RADIUS_PX:.3f}:max_points=12:nodata={HEATMAP_NODATA}",
+        minx, maxy, px, -px, HEATMAP_NODATA, HEATMAP_NODATA,
+    ])
+    if fmt == "png":
+        out = f"ST_AsPNG(ST_ColorMap({raster}, 1, %s, 'INTERPOLATE'))"
+        params.append(colormap)
+    else:
+        out = f"ST_AsTIFF({raster}, 'DEFLATE')"
+
+    sql = f"""
+WITH pts AS (
+  SELECT ST_SnapToGrid(ST_Transform(position::geometry, 3857), %s) AS p, avg({metric}) AS v
+  FROM telemetry
+  WHERE {where}
+  GROUP BY 1
+)
+SELECT count(*), CASE WHEN count(*) > 0 THEN {out} END
+FROM pts
+    """
+    params.insert(0, px * HEATMAP_SNAP_PX)
+
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            with stage("db_execute"):
+                execute_prepared(cur, """
+SELECT tile FROM heatmap_tile_cache
+WHERE operator = %s AND metric = %s AND format = %s AND z = %s AND x = %s AND y = %s AND end_day = %s AND days = %s
+                """, key)
+                row = cur.fetchone()
+            if row is not None:
+                HEATMAP_TILES.labels("hit").inc()
+                tile, result = row[0], "hit"
+            else:
+                HEATMAP_TILES.labels("miss").inc()
+                with stage("render"):
+                    execute_prepared(cur, sql, tuple(params))
+                    points, tile = cur.fetchone()
+                    if not points:
+                        tile = None
+                execute_prepared(cur, """
+INSERT INTO heatmap_tile_cache (operator, metric, format, z, x, y, end_day, days, tile, points)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (operator, metric, format, z, x, y, end_day, days)
+DO UPDATE SET tile = EXCLUDED.tile, points = EXCLUDED.points, generated_at = now()
+                """, key + (tile, points))
+                result = "miss"
+    except Exception as e:
+        return db_error(f"/api/heatmap/{metric}", e)
+
+    if tile is None:
+        resp = app.response_class(status=204)
+    else:
+        resp = app.response_class(bytes(tile), mimetype=HEATMAP_FORMATS[fmt])
+    resp.headers["Cache-Control"] = "public, max-age=60"
+    resp.headers["X-Heatmap-Cache"] = result
+    return resp
+
+
+# Warstwy kafli wektorowych: tabela, kolumna pozycji i atrybuty dołączane do obiektów
+MVT_LAYERS = {
+    "telemetry": {
+        "table": "telemetry",
+        "geog": "position",
+        "columns": "id, COALESCE(operator_norm4, operator) AS operator, network_type, signal, rsrp, sinr, enb",
+        "time_filter": True,
+    },
+    "speedtest": {
+        "table": "speed_test",
+        "geog": "position",
+        "columns": "id, operator, download_mbps, upload_mbps, latency_ms",
+        "time_filter": True,
+    },
+    "bts": {
+        "table": "bts",
+        "geog": "geog",
+        "columns": "id, operator, network_type, enbi, btsid, station_id",
+        "time_filter": False,
+    },
+}
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+
+
+@app.route("/api/tiles/<layer>/<int:z>/<int:x>/<int:y>.pbf")
+def api_vector_tile(layer, z, x, y):
+    """
+    Endpoint zwracający kafel wektorowy (Mapbox Vector Tile) dla warstwy telemetry, speedtest lub bts.
+    Query params:
+      - limit (int, default 50000): max liczba obiektów w kaflu
+      - minutes (int, default 1440): dane z ostatnich X minut (telemetry, speedtest)
+      - start_date / end_date (str, optional): zakres czasowy (ISO format) (telemetry, speedtest)
+      - short_code (str, optional): filtruj po short_code (telemetry, speedtest)
+      - operator (str, optional): filtruj po operatorze
+    """
+    cfg = MVT_LAYERS.get(layer)
+    if cfg is None:
+        return jsonify(error=f"unknown layer: {layer}"), 404
+    if not (0 <= z <= 22) or not (0 <= x < (1 << z)) or not (0 <= y < (1 << z)):
+        return jsonify(error="invalid tile coordinates"), 400
+
+    try:
+        limit = int_arg("limit", 50000, 1, QUERY_MAX_LIMIT)
+        minutes = minutes_arg(1440)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    operator_filter = request.args.get("operator")
+    short_code_filter = request.args.get("short_code")
+    start_date = request.args.get("start_date")
+    end_date = request.args.get("end_date")
+
+    margin = MVT_BUFFER / MVT_EXTENT
+    params = [z, x, y, MVT_EXTENT, MVT_BUFFER]
+
+    # Filtr kafla z marginesem po kolumnie geography warstwy (indeks GiST: telemetry/speed_test.position, bts.geog)
+    geog = cfg["geog"]
+    geom = f"ST_Transform({geog}::geometry, 3857)"
+    where = f"{geog} IS NOT NULL"
+    where_params = []
+    # Dla z < 2 kafel obejmuje pół globu i nie da się go wyrazić jako poligon geography
+    if z >= 2:
+        where += f" AND {geog} && ST_Transform(ST_TileEnvelope(%s, %s, %s, margin => %s), 4326)::geography"
+        where_params.extend([z, x, y, margin])
+
+    if cfg["time_filter"]:
+        if start_date:
+            where += " AND send_time >= %s"
+            where_params.append(start_date)
+        else:
+            where += " AND send_time >= now() - %s::interval"
+            where_params.append(f"{minutes} minutes")
+
+        if end_date:
+            where += " AND send_time <= %s"
+            where_params.append(end_date)
+
+        if short_code_filter:
+            where += " AND short_code = %s"
+            where_params.append(short_code_filter)
+
+    if operator_filter:
+        where += " AND operator = %s"
+        where_params.append(operator_filter)
+
+    order = " ORDER BY send_time DESC" if cfg["time_filter"] else ""
+
+    sql = f"""
+WITH mvtgeom AS (
+  SELECT
+    ST_AsMVTGeom({geom}, ST_TileEnvelope(%s, %s, %s), %s, %s, true) AS geom,
+    {cfg["columns"]}
+  FROM {cfg["table"]}
+  WHERE {where}{order}
+  LIMIT %s
+)
+SELECT ST_AsMVT(mvtgeom, %s, %s, 'geom')
+FROM mvtgeom
+WHERE geom IS NOT NULL
+    """
+    params.extend(where_params)
+    params.extend([limit, layer, MVT_EXTENT])
+
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            check_query_cost(cur, sql, params)
+            with stage("db_execute"):
+                execute_prepared(cur, sql, tuple(params))
+            row = cur.fetchone()
+    except Exception as e:
+        return db_error(f"/api/tiles/{layer}", e)
+
+    tile = bytes(row[0]) if row and row[0] is not None else b""
+    resp = app.response_class(tile, mimetype="application/vnd.mapbox-vector-tile")
+    resp.headers["Cache-Control"] = "public, max-age=60"
+    return resp
 
 
 def handle_term(signum, frame):
     """Obsługa SIGTERM/SIGINT dla graceful shutdown"""
-    print("[SHUTDOWN] Otrzymano sygnał, zatrzymuję...", flush=True)
+    log.info("Otrzymano sygnał, zatrzymuję...")
     _stop.set()
 
 
-def main():
+def shutdown():
+    """Zatrzymuje wątki tła i zamyka połączenia z bazą (koniec pracy procesu/workera)"""
+    _stop.set()
+    if _pool is not None:
+        _pool.closeall()
+        log.info("Connection pool zamknięty")
+
+
+def init_worker():
+    """
+    Inicjalizacja stanu procesu: pula połączeń, test połączenia, indeks BTS i wątki tła.
+    Wywoływana raz na proces - z main() (serwer deweloperski) albo w każdym workerze gunicorna
+    (gunicorn.conf.py), bo pula połączeń i wątki nie przeżywają fork().
+    """
     global _last_ok, _pool
     
-    print(f"[STARTUP] Łączenie z bazą: {USER}@{HOST}:{PORT}/{DB}", flush=True)
+    log.info("Łączenie z bazą: %s@%s:%s/%s", USER, HOST, PORT, DB)
     
     # Inicjalizacja connection pool
     try:
-        _pool = SimpleConnectionPool(
-            minconn=2,
-            maxconn=10,
+        _pool = DbPool(
+            minconn=POOL_MIN,
+            maxconn=POOL_MAX,
             host=HOST,
             dbname=DB,
             user=USER,
             password=PWD,
             port=PORT,
             sslmode=SSLM,
-            connect_timeout=10
+            connect_timeout=10,
+            connection_factory=PreparingConnection,
+            options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"
         )
-        print("[STARTUP] Connection pool utworzony", flush=True)
+        log.info("Connection pool utworzony")
     except Exception as e:
-        print(f"[STARTUP] BŁĄD: Nie można utworzyć connection pool: {e}", flush=True)
+        log.critical("Nie można utworzyć connection pool: %s", e)
         raise
 
     # Test połączenia przy starcie
     for attempt in range(10):
         try:
-            conn = get_conn()
-            with conn, conn.cursor() as cur:
+            with db_conn() as conn, conn.cursor() as cur:
                 cur.execute("SELECT 1;")
                 cur.fetchone()
-            put_conn(conn)
             _last_ok = datetime.utcnow()
-            print("[STARTUP] Test połączenia OK", flush=True)
+            log.info("Test połączenia OK")
             break
         except Exception as e:
-            print(f"[STARTUP] Próba {attempt + 1}/10 - błąd połączenia: {e}", flush=True)
+            log.warning("Próba %d/10 - błąd połączenia: %s", attempt + 1, e)
             time.sleep(3)
     else:
-        print("[STARTUP] OSTRZEŻENIE: Nie udało się połączyć z bazą po 10 próbach", flush=True)
+        log.error("Nie udało się połączyć z bazą po 10 próbach")
+
+    # Załaduj indeks BTS (przy błędzie zostanie załadowany przy pierwszym zapytaniu)
+    try:
+        snap = _bts_index.refresh(full=True)
+        log.info("Indeks BTS załadowany: %d stacji, %s ms", len(snap), _bts_index.stats()["lastRefreshMs"])
+    except Exception as e:
+        log.error("Nie udało się załadować indeksu BTS: %s", e)
 
     # Uruchom wątek monitorujący
     t = threading.Thread(target=poll_loop, daemon=True)
     t.start()
-    print("[STARTUP] Wątek monitorujący uruchomiony", flush=True)
+    log.info("Wątek monitorujący uruchomiony")
+
+    # Uruchom wątek odświeżający indeks BTS
+    threading.Thread(target=bts_refresh_loop, daemon=True).start()
+
+    # Uruchom wątek agregatów godzinowych (/api/stats)
+    threading.Thread(target=rollup_loop, daemon=True).start()
+
+
+def main():
+    """Serwer deweloperski Flask (jeden proces); produkcyjnie: gunicorn -c gunicorn.conf.py app:app"""
+    init_worker()
 
     # Obsługa sygnałów
     signal.signal(signal.SIGTERM, handle_term)
     signal.signal(signal.SIGINT, handle_term)
 
     # Start Flask
-    print("[STARTUP] Uruchamiam Flask na porcie 8080", flush=True)
+    log.info("Uruchamiam Flask na porcie 8080")
     app.run(host="0.0.0.0", port=8080, threaded=True)
 
 
@@ -0,0 +1,87 @@
+# bench_bts_db.py - dopasowanie BTS w /api/telemetry-with-bts: match=python (indeks w pamięci) vs match=db (LATERAL + KNN)
+#
+# Uruchomienie: python bench_bts_db.py [liczba_pomiarów ...]
+# Wymaga bazy (zmienne PG* jak dla app.py) ze schematem z schema.sql (kolumna bts.geog i indeksy).
+# Domyślnie 10k i 100k najnowszych pomiarów z ostatnich BENCH_MINUTES minut; czas obejmuje zapytanie,
+# pobranie wierszy, dopasowanie i budowę słowników odpowiedzi. Na końcu liczba pomiarów z różnym wynikiem
+# (różnice możliwe przy remisach odległości i zmianach tabeli bts między zapytaniami).
+import os
+import sys
+import time
+
+import psycopg2
+
+from app import (BTS_COLUMNS, BTS_MATCH_OFFSET, DB, HOST, PORT, PWD, SSLM, USER, BtsSnapshot,
+                 attach_bts, attach_bts_rows, bts_match_query, telemetry_item)
+
+BENCH_MINUTES = int(os.getenv("BENCH_MINUTES", "43200"))
+
+SQL_TELEMETRY = """
+SELECT
+  id, operator, network_type, signal,
+  ST_Y(position::geometry) AS latitude,
+  ST_X(position::geometry) AS longitude,
+  send_time, rat, nr_mode, band, arfcn, rsrp, rsrq, sinr, rssi, timing_advance,
+  pci, eci, nci, cell_id, enb, sector_id, tac, lac, received_at
+FROM telemetry
+WHERE send_time >= now() - %s::interval
+ORDER BY send_time DESC, id DESC LIMIT %s
+"""
+
+
+def run_python(cur, n: int):
+    """Ścieżka match=python: telemetria z bazy, indeks BTS (ładowanie liczone osobno), krok 3 w NumPy"""
+    t0 = time.perf_counter()
+    cur.execute(f"SELECT {BTS_COLUMNS} FROM bts WHERE lat IS NOT NULL AND lon IS NOT NULL")
+    snap = BtsSnapshot(cur.fetchall(), version=1)
+    t_index = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    cur.execute(SQL_TELEMETRY, (f"{BENCH_MINUTES} minutes", n))
+    rows = cur.fetchall()
+    t_db = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    items = [telemetry_item(r) for r in rows]
+    attach_bts(items, snap, {})
+    t_match = time.perf_counter() - t0
+    ids = [it["relatedBts"]["id"] if "relatedBts" in it else None for it in items]
+    return ids, t_index, t_db, t_match
+
+
+def run_db(cur, n: int):
+    """Ścieżka match=db: jedno zapytanie, stacja dołączona w wierszu"""
+    sql, params = bts_match_query(SQL_TELEMETRY.strip(), [f"{BENCH_MINUTES} minutes", n], "send_time DESC, id DESC")
+    t0 = time.perf_counter()
+    cur.execute(sql, tuple(params))
+    rows = cur.fetchall()
+    t_db = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    items = [telemetry_item(r) for r in rows]
+    attach_bts_rows(items, rows, {})
+    t_match = time.perf_counter() - t0
+    return [r[BTS_MATCH_OFFSET] for r in rows], t_db, t_match
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 100_000]
+    conn = psycopg2.connect(host=HOST, dbname=DB, user=USER, password=PWD, port=PORT, sslmode=SSLM)
+    conn.autocommit = True
+    print(f"{'pomiary':>10} {'indeks [s]':>11} {'py: baza':>9} {'py: dop.':>9} {'db: baza':>9} {'db: dop.':>9} "
+          f"{'py/db':>7} {'dopas. py':>10} {'dopas. db':>10} {'różne':>7}")
+
+    with conn.cursor() as cur:
+        for n in sizes:
+            py_ids, t_index, py_db, py_match = run_python(cur, n)
+            db_ids, db_db, db_match = run_db(cur, n)
+            diff = sum(1 for a, b in zip(py_ids, db_ids) if a != b) + abs(len(py_ids) - len(db_ids))
+            ratio = (py_db + py_match) / (db_db + db_match)
+            print(f"{len(py_ids):>10} {t_index:>11.3f} {py_db:>9.3f} {py_match:>9.3f} {db_db:>9.3f} {db_match:>9.3f} "
+                  f"{ratio:>6.1f}x {sum(1 for i in py_ids if i is not None):>10} "
+                  f"{sum(1 for i in db_ids if i is not None):>10} {diff:>7}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
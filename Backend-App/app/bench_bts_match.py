@@ -0,0 +1,110 @@
+# bench_bts_match.py - porównanie dopasowania BTS: dawna pętla Pythona vs match_bts (NumPy)
+#
+# Uruchomienie: python bench_bts_match.py [liczba_pomiarów ...]
+# Domyślnie 10k, 100k i 1M pomiarów na syntetycznym indeksie 60k stacji.
+# Liczby dopasowań różnią się z założenia: pętla ma dawny próg 0.15 stopnia (euklidesowo w stopniach, W-E ~10.3 km),
+# match_bts - okrąg MATCH_MAX_KM (haversine), więc dopasowuje ok. 1.6 raza więcej pomiarów (docstring match_bts).
+import random
+import sys
+import time
+from datetime import date
+
+from app import BtsSnapshot, match_bts
+
+BTS_COUNT = 60000
+
+
+def make_snapshot(rng: random.Random) -> BtsSnapshot:
+    """Syntetyczna tabela bts: LTE (enbi), UMTS (rnc, btsid) i GSM (btsid) w obrębie Polski"""
+    rows = []
+    for i in range(BTS_COUNT):
+        kind = i % 3
+        rows.append((
+            i, "Orange", None, None, None,
+            ("LTE", "UMTS", "GSM")[kind], 1800, "FDD",
+            str(rng.randrange(2000)) if kind else None,
+            rng.randrange(20000) if kind == 0 else None,
+            None,
+            round(rng.uniform(49.0, 54.8), 6), round(rng.uniform(14.1, 24.1), 6),
+            date(2025, 1, 1), i, rng.randrange(1, 60) if kind == 1 else None, None,
+            rng.choice((0, rng.randrange(1, 500))),
+        ))
+    return BtsSnapshot(rows, version=1)
+
+
+def make_items(rng: random.Random, n: int):
+    items = []
+    for _ in range(n):
+        kind = rng.randrange(3)
+        items.append({
+            "latitude": rng.uniform(49.0, 54.8),
+            "longitude": rng.uniform(14.1, 24.1),
+            "networkType": ("4G", "3G", "2G")[kind],
+            "enb": rng.randrange(20000) if kind == 0 else None,
+            "cellId": (rng.randrange(1, 60) * 65536 + rng.randrange(20000)) if kind == 1 else rng.randrange(20000),
+            "lac": rng.choice((None, rng.randrange(1, 500))),
+        })
+    return items
+
+
+def match_bts_loop(items, snap: BtsSnapshot):
+    """Dawny krok 3: pętla po kandydatach z odległością euklidesową w stopniach"""
+    lat, lon, lac = snap.lat.tolist(), snap.lon.tolist(), snap.lac.tolist()
+    result = []
+
+    for item in items:
+        nt = (item["networkType"] or "").lower()
+
+        def pick_best(candidates):
+            best = -1
+            best_dist = float('inf')
+            for i in candidates:
+                if item["lac"] and lac[i] and item["lac"] != lac[i]:
+                    continue
+                dist = ((item["latitude"] - lat[i])**2 + (item["longitude"] - lon[i])**2)**0.5
+                if dist < 0.15 and dist < best_dist:
+                    best_dist = dist
+                    best = i
+            return best
+
+        best = -1
+        if item["enb"] and item["enb"] in snap.by_enb:
+            result.append(pick_best(snap.by_enb[item["enb"]]))
+            continue
+        if "3g" in nt and item["cellId"] is not None:
+            rnc_val = int(item["cellId"]) // 65536
+            key = (rnc_val, str((int(item["cellId"]) - rnc_val * 65536) // 10))
+            if key in snap.by_umts:
+                best = pick_best(snap.by_umts[key])
+        if best < 0 and ("gsm" in nt or "2g" in nt) and item["cellId"] is not None:
+            key = str(int(item["cellId"]) // 10)
+            if key in snap.by_gsm:
+                best = pick_best(snap.by_gsm[key])
+        result.append(best)
+    return result
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    rng = random.Random(42)
+    snap = make_snapshot(rng)
+    print(f"Indeks: {len(snap)} stacji, {snap.memory_bytes() / 1e6:.1f} MB")
+    print(f"{'pomiary':>10} {'pętla [s]':>10} {'numpy [s]':>10} {'przysp.':>8} {'dopas. pętla':>13} {'dopas. numpy':>13}")
+
+    for n in sizes:
+        items = make_items(rng, n)
+        loop, t_loop = timed(match_bts_loop, items, snap)
+        vec, t_vec = timed(match_bts, items, snap)
+        matched_loop = sum(1 for p in loop if p >= 0)
+        matched_vec = int((vec >= 0).sum())
+        print(f"{n:>10} {t_loop:>10.3f} {t_vec:>10.3f} {t_loop / t_vec:>7.1f}x {matched_loop:>13} {matched_vec:>13}")
+
+
+if __name__ == "__main__":
+    main()
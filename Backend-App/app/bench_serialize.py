@@ -0,0 +1,116 @@
+# bench_serialize.py - budowa odpowiedzi /api/telemetry-with-bts: dawna ścieżka vs dumps_json / bts=ref / shape=rows
+#
+# Uruchomienie: python bench_serialize.py [liczba_pomiarów ...]
+# Domyślnie 100k pomiarów; czas obejmuje zamianę wierszy, dopasowanie BTS i serializację JSON.
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import jsonify
+
+from app import (TELEMETRY_FIELDS, app, attach_bts, bts_entry, bts_ref_column, dumps_json, match_bts,
+                 telemetry_item)
+from bench_bts_match import make_snapshot
+
+
+def make_rows(rng: random.Random, n: int, snap):
+    """
+    Wiersze jak z zapytania /api/telemetry-with-bts (24 kolumny + received_at).
+    Co drugi pomiar LTE leży kilka km od stacji o swoim eNB (dopasowany), reszta losowo.
+    """
+    lte = [r for r in snap.rows if r[9] is not None]
+    t0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(n):
+        kind = rng.randrange(3)
+        t = t0 + timedelta(seconds=i * 7, microseconds=rng.randrange(1000000))
+        lat, lon = rng.uniform(49.0, 54.8), rng.uniform(14.1, 24.1)
+        enb = rng.randrange(20000) if kind == 0 else None
+        if kind == 0 and i % 2:
+            bts = rng.choice(lte)
+            enb, lat, lon = bts[9], bts[11] + rng.uniform(-0.05, 0.05), bts[12] + rng.uniform(-0.05, 0.05)
+        rows.append((
+            i, rng.choice(("Orange", "Play", "T-Mobile", "Plus")), ("4G", "3G", "2G")[kind], rng.randrange(-120, -50),
+            lat, lon, t, ("LTE", "WCDMA", "GSM")[kind], None, "3", 1300, -100, -10, 5, -70, 1, 120, 123456, None,
+            (rng.randrange(1, 60) * 65536 + rng.randrange(20000)) if kind == 1 else rng.randrange(20000),
+            enb, 1, 100, None, t,
+        ))
+    return rows
+
+
+def telemetry_item_old(r) -> dict:
+    """Dawna zamiana wiersza: float()/int()/isoformat() dla każdej wartości"""
+    return {
+        "id": r[0], "operator": r[1], "networkType": r[2], "signal": int(r[3]),
+        "latitude": float(r[4]), "longitude": float(r[5]), "sendTime": r[6].isoformat(),
+        "position": [float(r[5]), float(r[4])],
+        "rat": r[7], "nrMode": r[8], "band": r[9], "arfcn": r[10], "rsrp": r[11], "rsrq": r[12], "sinr": r[13],
+        "rssi": r[14], "timingAdvance": r[15], "pci": r[16], "eci": r[17], "nci": r[18], "cellId": r[19],
+        "enb": r[20], "sectorId": r[21], "tac": r[22], "lac": r[23],
+    }
+
+
+def build_old(rows, snap):
+    items = [telemetry_item_old(r) for r in rows]
+    for item, pos in zip(items, match_bts(items, snap).tolist()):
+        if pos >= 0:
+            item["relatedBts"] = bts_entry(snap.rows[pos])
+    return jsonify(items=items, next=None).get_data()
+
+
+def build_items_inline(rows, snap):
+    items = [telemetry_item(r) for r in rows]
+    attach_bts(items, snap, {})
+    return dumps_json({"items": items, "next": None})
+
+
+def build_items_ref(rows, snap):
+    items = [telemetry_item(r) for r in rows]
+    entries = {}
+    attach_bts(items, snap, entries, ref=True)
+    return dumps_json({"items": items, "bts": list(entries.values()), "next": None})
+
+
+def build_rows(rows, snap):
+    entries = {}
+    refs = bts_ref_column(rows, snap, entries)
+    return dumps_json({"fields": TELEMETRY_FIELDS + ["receivedAt"], "rows": rows, "btsRefs": refs,
+                       "bts": list(entries.values()), "next": None})
+
+
+def timed(fn, *args, repeat: int = 3):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return out, best
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [100_000]
+    rng = random.Random(42)
+    snap = make_snapshot(rng)
+    variants = [
+        ("dawna (dict + jsonify, relatedBts)", build_old),
+        ("dumps_json, relatedBts", build_items_inline),
+        ("dumps_json, bts=ref", build_items_ref),
+        ("dumps_json, shape=rows", build_rows),
+    ]
+
+    with app.test_request_context():
+        for n in sizes:
+            rows = make_rows(rng, n, snap)
+            print(f"\n{n} pomiarów")
+            print(f"{'wariant':<36} {'czas [s]':>9} {'rozmiar [MB]':>13} {'przysp.':>8} {'rozmiar':>8}")
+            base_t = base_size = None
+            for name, fn in variants:
+                body, t = timed(fn, rows, snap)
+                if base_t is None:
+                    base_t, base_size = t, len(body)
+                print(f"{name:<36} {t:>9.3f} {len(body) / 1e6:>13.1f} {base_t / t:>7.1f}x {len(body) / base_size:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
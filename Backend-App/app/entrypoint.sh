@@ -17,4 +17,11 @@ done
 [ -f /appuser/kv/PGPASSWORD ] && export PGPASSWORD="$(cat /appuser/kv/PGPASSWORD)"
 [ -f /appuser/kv/PGSSLMODE ]  && export PGSSLMODE="$(cat /appuser/kv/PGSSLMODE)"
 
-exec python /appuser/app.py
+# SERVER_MODE=dev uruchamia serwer deweloperski Flask (jeden proces)
+if [ "${SERVER_MODE:-gunicorn}" = "dev" ]; then
+  exec python /appuser/app.py
+fi
+# Metryki Prometheus wspólne dla wszystkich workerów (katalog czyszczony przy starcie)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+exec gunicorn -c /appuser/gunicorn.conf.py --chdir /appuser app:app
@@ -0,0 +1,51 @@
+# gunicorn.conf.py - produkcyjne uruchomienie backendu (kilka procesów workerów)
+#
+# Uruchomienie: gunicorn -c gunicorn.conf.py app:app
+# Każdy worker ma własną pulę połączeń (POOL_MAX połączeń na workera), indeks BTS i cache odpowiedzi.
+import os
+import signal
+
+bind = f"0.0.0.0:{os.getenv('PORT_HTTP', '8080')}"
+# Liczba procesów - dopasuj do limitu CPU poda (os.cpu_count() w kontenerze widzi rdzenie całego węzła)
+workers = int(os.getenv("WEB_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Wątki na workera - zapytania czekające na bazę nie blokują pozostałych
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "4"))
+# Czas na dokończenie trwających zapytań po SIGTERM (poniżej terminationGracePeriodSeconds = 30 s)
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "25"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+keepalive = 5
+# Pula połączeń i wątki tła są tworzone w workerach, nie w procesie nadrzędnym
+preload_app = False
+accesslog = None
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    """Inicjalizacja workera po załadowaniu aplikacji; SIGTERM dodatkowo ustawia _stop (readiness 503)"""
+    import app
+
+    app.init_worker()
+
+    graceful_exit = signal.getsignal(signal.SIGTERM)
+
+    def on_term(signum, frame):
+        app.handle_term(signum, frame)
+        graceful_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, on_term)
+
+
+def worker_exit(server, worker):
+    """Po obsłużeniu trwających zapytań: zatrzymanie wątków tła i zamknięcie połączeń"""
+    import app
+
+    app.shutdown()
+
+
+def child_exit(server, worker):
+    """Usuwa metryki zakończonego workera z agregacji multiprocess (PROMETHEUS_MULTIPROC_DIR)"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
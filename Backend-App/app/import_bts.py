@@ -0,0 +1,189 @@
+# import_bts.py - import rejestru stacji BTS z eksportu CSV do tabeli bts
+#
+# Uruchomienie: python import_bts.py plik.csv [--delimiter ';'] [--encoding utf-8] [--max-delete 0.1] [--dry-run]
+# Zmienne PG* jak dla app.py. Nagłówki CSV: nazwy kolumn tabeli bts albo nazwy z eksportu rejestru
+# (siec_id, wojewodztwo_id, miejscowosc, lokalizacja, standard, pasmo, uwagi, LATIuke, LONGuke, aktualizacja, StationId...).
+#
+# Plik trafia przez COPY do tymczasowej tabeli tekstowej, jest rzutowany na typy bts i porównywany z bts po id.
+# W jednej transakcji wykonywane są tylko wstawienia, zmiany (wiersze różniące się którąkolwiek kolumną)
+# i usunięcia - niezmienione wiersze nie są przepisywane. Każda zmiana trafia do bts_changes,
+# a po zatwierdzeniu odbiorcy dostają NOTIFY bts_changed z podsumowaniem (JSON).
+# Gdy eksport usuwałby więcej niż --max-delete stacji (ułamek tabeli), import jest przerywany - zabezpieczenie
+# przed uciętym plikiem.
+import argparse
+import csv
+import json
+import sys
+import time
+
+import psycopg2
+
+from app import DB, HOST, PORT, PWD, SSLM, USER
+
+# Kolumny bts: (nazwa, typ, nagłówki CSV rozpoznawane bez względu na wielkość liter)
+BTS_IMPORT_COLUMNS = (
+    ("id", "bigint", ("id",)),
+    ("operator", "text", ("operator", "siec_id", "siec")),
+    ("voivodeship", "text", ("voivodeship", "wojewodztwo_id", "wojewodztwo")),
+    ("town", "text", ("town", "miejscowosc")),
+    ("location", "text", ("location", "lokalizacja")),
+    ("network_type", "text", ("network_type", "standard")),
+    ("band", "integer", ("band", "pasmo")),
+    ("duplex", "text", ("duplex",)),
+    ("lac", "integer", ("lac",)),
+    ("btsid", "text", ("btsid",)),
+    ("ecid", "bigint", ("ecid",)),
+    ("enbi", "integer", ("enbi",)),
+    ("clid", "integer", ("clid",)),
+    ("comments", "text", ("comments", "uwagi")),
+    ("lat", "numeric(9,6)", ("lat", "lati", "latiuke", "latitude")),
+    ("lon", "numeric(9,6)", ("lon", "long", "longuke", "longitude")),
+    ("updated_at", "date", ("updated_at", "aktualizacja")),
+    ("rnc", "integer", ("rnc",)),
+    ("carrier", "text", ("carrier",)),
+    ("station_id", "bigint", ("station_id", "stationid")),
+)
+REQUIRED = ("id", "operator")
+
+SQL_DIFF = """
+WITH deleted AS (
+  DELETE FROM bts b WHERE NOT EXISTS (SELECT 1 FROM bts_new n WHERE n.id = b.id)
+  RETURNING b.id, b.operator, b.enbi, b.rnc, b.btsid, b.lac
+), changed AS (
+  SELECT n.*, o.enbi AS old_enbi, o.rnc AS old_rnc, o.btsid AS old_btsid, o.lac AS old_lac
+  FROM bts_new n JOIN bts o ON o.id = n.id
+  WHERE ({old_columns}) IS DISTINCT FROM ({new_columns})
+), updated AS (
+  UPDATE bts b SET {assignments}
+  FROM changed n WHERE b.id = n.id
+  RETURNING b.id, b.operator, b.enbi, b.rnc, b.btsid, b.lac, n.old_enbi, n.old_rnc, n.old_btsid, n.old_lac
+), inserted AS (
+  INSERT INTO bts ({columns})
+  SELECT {columns} FROM bts_new n WHERE NOT EXISTS (SELECT 1 FROM bts b WHERE b.id = n.id)
+  RETURNING id, operator, enbi, rnc, btsid, lac
+), logged AS (
+  INSERT INTO bts_changes (op, bts_id, operator, enbi, rnc, btsid, lac, old_enbi, old_rnc, old_btsid, old_lac)
+  SELECT 'I', id, operator, enbi, rnc, btsid, lac, NULL, NULL, NULL, NULL FROM inserted
+  UNION ALL
+  SELECT 'U', id, operator, enbi, rnc, btsid, lac, old_enbi, old_rnc, old_btsid, old_lac FROM updated
+  UNION ALL
+  SELECT 'D', id, operator, NULL, NULL, NULL, NULL, enbi, rnc, btsid, lac FROM deleted
+  RETURNING op, change_id
+)
+SELECT count(*) FILTER (WHERE op = 'I'), count(*) FILTER (WHERE op = 'U'),
+       count(*) FILTER (WHERE op = 'D'), max(change_id)
+FROM logged
+"""
+
+
+def cast_expr(src: str, typ: str) -> str:
+    """Wartość tekstowa z CSV -> typ kolumny bts (pusty tekst = NULL, przecinek dziesiętny dozwolony)"""
+    value = f"NULLIF(btrim({src}), '')"
+    if typ == "text":
+        return value
+    if typ.startswith("numeric"):
+        value = f"replace({value}, ',', '.')"
+    return f"{value}::{typ}"
+
+
+def map_header(header: list) -> dict:
+    """Kolumna bts -> indeks kolumny CSV; brakujące kolumny wymagane to błąd"""
+    positions = {h.strip().lstrip("\ufeff").lower(): i for i, h in enumerate(header)}
+    mapping = {}
+    for name, _, aliases in BTS_IMPORT_COLUMNS:
+        for alias in aliases:
+            if alias in positions:
+                mapping[name] = positions[alias]
+                break
+    missing = [c for c in REQUIRED if c not in mapping]
+    if missing:
+        raise ValueError(f"CSV bez wymaganych kolumn: {', '.join(missing)} (nagłówki: {', '.join(header)})")
+    return mapping
+
+
+def copy_to_staging(cur, f, header: list, delimiter: str) -> int:
+    """COPY pliku (bez nagłówka) do bts_staging, rzutowanie do bts_new z kluczem głównym; zwraca liczbę wierszy"""
+    mapping = map_header(header)
+    cur.execute("CREATE TEMP TABLE bts_staging ({}) ON COMMIT DROP".format(
+        ", ".join(f"c{i} text" for i in range(len(header)))))
+    cur.copy_expert(f"COPY bts_staging FROM STDIN WITH (FORMAT csv, DELIMITER '{delimiter}')", f)
+
+    select = ", ".join(
+        f"{cast_expr(f'c{mapping[name]}', typ) if name in mapping else f'NULL::{typ}'} AS {name}"
+        for name, typ, _ in BTS_IMPORT_COLUMNS)
+    cur.execute(f"CREATE TEMP TABLE bts_new ON COMMIT DROP AS SELECT {select} FROM bts_staging")
+    # Zduplikowane albo puste id w eksporcie przerywają import
+    cur.execute("ALTER TABLE bts_new ADD PRIMARY KEY (id)")
+    cur.execute("ANALYZE bts_new")
+    cur.execute("SELECT count(*) FROM bts_new")
+    return cur.fetchone()[0]
+
+
+def apply_diff(cur) -> tuple:
+    """Wstawienia, zmiany i usunięcia w bts z wpisami w bts_changes; zwraca (I, U, D, ostatni change_id)"""
+    names = [name for name, _, _ in BTS_IMPORT_COLUMNS]
+    data = [n for n in names if n != "id"]
+    sql = SQL_DIFF.format(
+        old_columns=", ".join(f"o.{n}" for n in data),
+        new_columns=", ".join(f"n.{n}" for n in data),
+        assignments=", ".join(f"{n} = n.{n}" for n in data),
+        columns=", ".join(names),
+    )
+    cur.execute(sql)
+    return cur.fetchone()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import rejestru BTS z CSV (COPY + różnice względem bts)")
+    parser.add_argument("path", help="plik CSV z nagłówkiem ('-' = stdin)")
+    parser.add_argument("--delimiter", help="separator pól (domyślnie wykrywany z nagłówka: ';' albo ',')")
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--max-delete", type=float, default=0.1,
+                        help="maksymalny ułamek stacji usuwanych jednym importem (1 = bez limitu)")
+    parser.add_argument("--dry-run", action="store_true", help="policz zmiany i wycofaj transakcję")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    f = sys.stdin if args.path == "-" else open(args.path, encoding=args.encoding, newline="")
+    first = f.readline()
+    delimiter = args.delimiter or (";" if first.count(";") > first.count(",") else ",")
+    header = next(csv.reader([first], delimiter=delimiter))
+
+    conn = psycopg2.connect(host=HOST, dbname=DB, user=USER, password=PWD, port=PORT, sslmode=SSLM)
+    try:
+        with conn, conn.cursor() as cur:
+            staged = copy_to_staging(cur, f, header, delimiter)
+            t_copy = time.perf_counter() - t0
+            if staged == 0:
+                raise ValueError("pusty eksport - import przerwany")
+
+            cur.execute("SELECT count(*), count(*) FILTER (WHERE NOT EXISTS "
+                        "(SELECT 1 FROM bts_new n WHERE n.id = b.id)) FROM bts b")
+            current, to_delete = cur.fetchone()
+            if current and to_delete > args.max_delete * current:
+                raise ValueError(f"import usunąłby {to_delete} z {current} stacji (limit --max-delete {args.max_delete})")
+
+            inserted, updated, deleted, last_change = apply_diff(cur)
+            summary = {"rows": staged, "inserted": inserted, "updated": updated, "deleted": deleted,
+                       "lastChangeId": last_change}
+            if args.dry_run:
+                conn.rollback()
+            elif inserted or updated or deleted:
+                # Dostarczane odbiorcom LISTEN dopiero po zatwierdzeniu transakcji
+                cur.execute("SELECT pg_notify('bts_changed', %s)", (json.dumps(summary),))
+    except (ValueError, psycopg2.Error) as e:
+        print(f"Import przerwany: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+        if f is not sys.stdin:
+            f.close()
+
+    print(f"{'Symulacja' if args.dry_run else 'Import'}: {staged} wierszy (COPY {t_copy:.1f} s), "
+          f"nowe {inserted}, zmienione {updated}, usunięte {deleted}, ostatni change_id {last_change}, "
+          f"razem {time.perf_counter() - t0:.1f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# rematch_bts.py - ponowne dopasowanie telemetry.related_bts_id po zmianie tabeli bts
+#
+# Uruchomienie: python rematch_bts.py --since 2025-06-01 [--workers 4] [--chunk 50000] [--hours 22-6]
+#               python rematch_bts.py --changes-after 1234   (zmiany zapisane przez import_bts.py w bts_changes)
+#               python rematch_bts.py --all            (pełne uzupełnienie, np. wierszy sprzed fa-worker z dopasowaniem)
+# Zmienne PG* jak dla app.py. Dopasowanie tymi samymi regułami co match_bts (indeks BTS ładowany raz na proces).
+#
+# Pomiary, na które mogła wpłynąć zmiana, wybierane są po kluczach stacji z bts.updated_at >= since:
+# eNB (enbi), btsid (GSM: cell_id / 10, UMTS: CID / 10) oraz dotychczasowe dopasowanie do zmienionej
+# albo usuniętej stacji. Tabela telemetry przechodzona jest zakresami id (--chunk) w puli procesów;
+# zapisywane są tylko zmienione wartości (UPDATE ... FROM unnest), każdy zakres w osobnej transakcji.
+# Postęp (najwyższe id, do którego wszystkie zakresy są gotowe) zapisywany jest w rollup_state,
+# więc przerwane zadanie uruchomione ponownie z tymi samymi argumentami kontynuuje od znacznika (--reset od nowa).
+# Poza oknem --hours (czas lokalny, domyślnie REMATCH_HOURS) zadanie czeka, zamiast skanować tabelę w szczycie.
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+
+import psycopg2
+
+from app import BTS_COLUMNS, DB, HOST, PORT, PWD, SSLM, USER, BtsSnapshot, match_bts
+
+REMATCH_HOURS = os.getenv("REMATCH_HOURS", "22-6")
+
+# Kolumny wiersza pomiaru i ich indeksy w kolejności MATCH_KEYS (enb, cellId, networkType, lac, latitude, longitude)
+SQL_CHUNK = """
+SELECT id, enb, cell_id, network_type, lac,
+  ST_Y(position::geometry), ST_X(position::geometry), related_bts_id
+FROM telemetry
+WHERE id >= %(lo)s AND id < %(hi)s
+"""
+ROW_KEYS = (1, 2, 3, 4, 5, 6)
+
+# Zawężenie do pomiarów, których dopasowanie mogła zmienić aktualizacja stacji (nadzbiór - dokładnie liczy match_bts)
+SQL_AFFECTED = """
+  AND (enb = ANY(%(enbi)s)
+    OR (cell_id / 10)::text = ANY(%(btsid)s)
+    OR (mod(cell_id, 65536) / 10)::text = ANY(%(btsid)s)
+    OR related_bts_id = ANY(%(ids)s)
+    OR (related_bts_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM bts b WHERE b.id = telemetry.related_bts_id)))
+"""
+
+SQL_UPDATE = """
+UPDATE telemetry t SET related_bts_id = u.bts_id
+FROM unnest(%s::bigint[], %s::bigint[]) AS u(id, bts_id)
+WHERE t.id = u.id AND t.related_bts_id IS DISTINCT FROM u.bts_id
+"""
+
+# Stan procesu roboczego: połączenie, indeks BTS i klucze zmienionych stacji
+_worker = {}
+
+
+def connect():
+    return psycopg2.connect(host=HOST, dbname=DB, user=USER, password=PWD, port=PORT, sslmode=SSLM)
+
+
+def load_snapshot(cur) -> BtsSnapshot:
+    """Indeks BTS jak w BtsIndex, w kolejności id - remisy odległości rozstrzygane tak jak w fa-worker i match=db"""
+    cur.execute(f"SELECT {BTS_COLUMNS} FROM bts WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY id")
+    return BtsSnapshot(cur.fetchall(), version=1)
+
+
+def changed_keys(cur, since: date) -> dict:
+    """Klucze reguł dopasowania stacji zmienionych od since"""
+    cur.execute("""
+        SELECT COALESCE(array_agg(DISTINCT enbi) FILTER (WHERE enbi IS NOT NULL), '{}'),
+               COALESCE(array_agg(DISTINCT btsid) FILTER (WHERE btsid IS NOT NULL), '{}'),
+               COALESCE(array_agg(id), '{}')
+        FROM bts WHERE updated_at >= %s
+    """, (since,))
+    enbi, btsid, ids = cur.fetchone()
+    return {"enbi": enbi, "btsid": btsid, "ids": ids}
+
+
+def logged_keys(cur, after: int) -> dict:
+    """Klucze stacji z dziennika bts_changes (import_bts.py) po change_id after - także sprzed zmiany i usuniętych"""
+    cur.execute("""
+        SELECT COALESCE(array_agg(DISTINCT k.enbi) FILTER (WHERE k.enbi IS NOT NULL), '{}'),
+               COALESCE(array_agg(DISTINCT k.btsid) FILTER (WHERE k.btsid IS NOT NULL), '{}'),
+               COALESCE(array_agg(DISTINCT c.bts_id), '{}')
+        FROM bts_changes c
+        CROSS JOIN LATERAL (VALUES (c.enbi, c.btsid), (c.old_enbi, c.old_btsid)) k(enbi, btsid)
+        WHERE c.change_id > %s
+    """, (after,))
+    enbi, btsid, ids = cur.fetchone()
+    return {"enbi": enbi, "btsid": btsid, "ids": ids}
+
+
+def init_worker(keys: dict | None):
+    conn = connect()
+    with conn.cursor() as cur:
+        _worker.update(conn=conn, snap=load_snapshot(cur), keys=keys)
+    conn.commit()
+
+
+def rematch_chunk(lo: int, hi: int) -> tuple:
+    """Dopasowanie zakresu id [lo, hi); zwraca (lo, hi, przeczytane, zmienione, sekundy)"""
+    t0 = time.perf_counter()
+    conn, snap, keys = _worker["conn"], _worker["snap"], _worker["keys"]
+    sql, params = SQL_CHUNK, {"lo": lo, "hi": hi}
+    if keys is not None:
+        sql += SQL_AFFECTED
+        params.update(keys)
+
+    with conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        ids, bts_ids = [], []
+        for r, pos in zip(rows, match_bts(rows, snap, ROW_KEYS).tolist()):
+            bts_id = snap.rows[pos][0] if pos >= 0 else None
+            if bts_id != r[7]:
+                ids.append(r[0])
+                bts_ids.append(bts_id)
+        updated = 0
+        if ids:
+            cur.execute(SQL_UPDATE, (ids, bts_ids))
+            updated = cur.rowcount
+    return lo, hi, len(rows), updated, time.perf_counter() - t0
+
+
+def parse_hours(value: str):
+    """Okno "22-6" -> (22, 6); "0-24" = bez ograniczeń"""
+    start, end = (int(v) for v in value.split("-"))
+    if not (0 <= start <= 24 and 0 <= end <= 24):
+        raise argparse.ArgumentTypeError(f"invalid hours window: {value}")
+    return start, end
+
+
+def in_window(hours) -> bool:
+    start, end = hours
+    if (start, end) == (0, 24) or start == end:
+        return True
+    h = datetime.now().hour
+    return start <= h < end if start < end else (h >= start or h < end)
+
+
+def save_marker(cur, name: str, last_id: int):
+    cur.execute("""
+        INSERT INTO rollup_state (name, last_id, updated_at) VALUES (%s, %s, now())
+        ON CONFLICT (name) DO UPDATE SET last_id = EXCLUDED.last_id, updated_at = EXCLUDED.updated_at
+    """, (name, last_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ponowne dopasowanie telemetry.related_bts_id")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--since", type=date.fromisoformat, help="stacje z bts.updated_at >= data (YYYY-MM-DD)")
+    mode.add_argument("--changes-after", type=int, metavar="CHANGE_ID",
+                      help="stacje z dziennika bts_changes o change_id > CHANGE_ID (import_bts.py)")
+    mode.add_argument("--all", action="store_true", help="wszystkie pomiary")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--chunk", type=int, default=50000, help="rozmiar zakresu id")
+    parser.add_argument("--hours", type=parse_hours, default=parse_hours(REMATCH_HOURS),
+                        help="okno pracy w czasie lokalnym, np. 22-6; 0-24 bez ograniczeń")
+    parser.add_argument("--reset", action="store_true", help="zacznij od początku zamiast od znacznika")
+    args = parser.parse_args()
+
+    if args.since:
+        marker = f"bts_rematch:{args.since.isoformat()}"
+    elif args.changes_after is not None:
+        marker = f"bts_rematch:change>{args.changes_after}"
+    else:
+        marker = "bts_rematch:all"
+    conn = connect()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        keys = None
+        if args.since:
+            keys = changed_keys(cur, args.since)
+        elif args.changes_after is not None:
+            keys = logged_keys(cur, args.changes_after)
+        if keys is not None and not keys["ids"]:
+            print("Brak zmienionych stacji")
+            return
+        if args.reset:
+            cur.execute("DELETE FROM rollup_state WHERE name = %s", (marker,))
+        cur.execute("SELECT last_id FROM rollup_state WHERE name = %s", (marker,))
+        row = cur.fetchone()
+        cur.execute("SELECT min(id), max(id) FROM telemetry")
+        min_id, max_id = cur.fetchone()
+
+    if max_id is None:
+        print("Tabela telemetry jest pusta")
+        return
+    start = max(min_id, row[0] + 1 if row else min_id)
+    ranges = [(lo, min(lo + args.chunk, max_id + 1)) for lo in range(start, max_id + 1, args.chunk)]
+    if keys is not None:
+        print(f"Zmienione stacje: {len(keys['ids'])}, eNB: {len(keys['enbi'])}, btsid: {len(keys['btsid'])}")
+    print(f"Zakresy: {len(ranges)} po {args.chunk} id, od id {start} do {max_id} ({args.workers} procesów)")
+
+    done, marker_id = set(), start - 1
+    scanned = updated = 0
+    t0 = time.perf_counter()
+    pending = deque(ranges)
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(keys,)) as pool, conn.cursor() as cur:
+        futures = set()
+        while pending or futures:
+            # Nowe zakresy tylko w oknie pracy; rozpoczęte kończą się normalnie
+            if not futures and not in_window(args.hours):
+                print(f"Poza oknem {args.hours[0]}-{args.hours[1]}, czekam...", flush=True)
+                time.sleep(60)
+                continue
+            while pending and len(futures) < args.workers * 2 and in_window(args.hours):
+                futures.add(pool.submit(rematch_chunk, *pending.popleft()))
+            if not futures:
+                continue
+
+            fut = next(as_completed(futures))
+            futures.remove(fut)
+            lo, hi, n, u, secs = fut.result()
+            scanned += n
+            updated += u
+            done.add(lo)
+            # Znacznik przesuwa się tylko po ciągłym prefiksie gotowych zakresów
+            while marker_id + 1 in done:
+                done.remove(marker_id + 1)
+                marker_id = min(marker_id + args.chunk, max_id)
+            save_marker(cur, marker, marker_id)
+
+            elapsed = time.perf_counter() - t0
+            progress = (marker_id - start + 1) / (max_id - start + 1)
+            eta = elapsed / progress - elapsed if progress > 0 else float("nan")
+            print(f"[{progress:6.1%}] id {lo}-{hi - 1}: {n} pomiarów, {u} zmian, {secs:.1f} s | "
+                  f"razem {scanned} ({scanned / elapsed:,.0f}/s), zmian {updated}, ETA {eta / 60:.1f} min",
+                  flush=True)
+
+    print(f"Gotowe: {scanned} pomiarów, {updated} zmian w {time.perf_counter() - t0:.1f} s")
+    conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
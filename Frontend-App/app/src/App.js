@@ -7,6 +7,24 @@ import Stats from './components/Stats/Stats';
 
 const API_BASE = '';
 
+// Odpowiedź /api/telemetry-with-bts?shape=rows: nazwy pól raz w json.fields, wiersze jako tablice,
+// każda stacja BTS raz w json.bts, a json.btsRefs[i] to id stacji dopasowanej do wiersza i.
+// Odtwarza punkty w dotychczasowym formacie (position, relatedBts - wspólny obiekt stacji).
+const telemetryFromRows = (json) => {
+  const fields = json.fields || [];
+  const refs = json.btsRefs || [];
+  const btsById = new Map((json.bts || []).map(b => [b.id, b]));
+  return (json.rows || []).map((row, i) => {
+    const point = {};
+    fields.forEach((name, k) => { point[name] = row[k]; });
+    point.position = [point.longitude, point.latitude];
+    if (refs[i] != null) {
+      point.relatedBts = btsById.get(refs[i]);
+    }
+    return point;
+  });
+};
+
 function App() {
   // Stan danych
   const [data, setData] = useState([]);
@@ -41,7 +59,7 @@ const [filters, setFilters] = useState({
     speedtest: false
   },
   // Pola dla wizualizacji
-  telemetryVisualization: 'points', // 'points' | 'heatmap' | 'hexagons' | 'bars'
+  telemetryVisualization: 'points', // 'points' | 'heatmap' | 'coverage' | 'hexagons' | 'bars'
   speedtestVisualization: 'points',  // 'points' | 'heatmap' | 'bars'
   speedtestBarType: 'download',       // 'download' | 'upload' | 'ping'
   is3DMode: false                     // tryb 3D
@@ -108,7 +126,7 @@ useEffect(() => {
       try {
         setLoading(true);
         
-        let url = `${API_BASE}/api/telemetry-with-bts?limit=100000`;
+        let url = `${API_BASE}/api/telemetry-with-bts?limit=100000&shape=rows`;
         
         if (filters.dateRange.start) {
           url += `&start_date=${filters.dateRange.start}`;
@@ -121,6 +139,7 @@ useEffect(() => {
         
         const response = await fetch(url);
         const json = await response.json();
+        json.items = telemetryFromRows(json);
         
         setData(json.items || []);
         
@@ -205,7 +224,7 @@ useEffect(() => {
       setError(null);
       
       // Buduj URL z parametrami
-let url = `${API_BASE}/api/telemetry-with-bts?limit=100000&minutes=525600`;      
+let url = `${API_BASE}/api/telemetry-with-bts?limit=100000&minutes=129600&shape=rows`;      
       // Dodaj filtr dat jeśli ustawiony
       if (filters.dateRange.start) {
         url += `&start_date=${filters.dateRange.start}`;
@@ -227,6 +246,7 @@ let url = `${API_BASE}/api/telemetry-with-bts?limit=100000&minutes=525600`;
       }
       
       const json = await response.json();
+      json.items = telemetryFromRows(json);
       
       console.log('Pobrano:', json.items?.length || 0, 'punktów');
       
@@ -734,6 +754,7 @@ const animatedData = useMemo(() => {
   telemetryVisualization={filters.telemetryVisualization || 'points'}
   speedtestVisualization={filters.speedtestVisualization || 'points'}
   speedtestBarType={filters.speedtestBarType || 'download'}
+  coverageOperator={filters.operators.length === 1 ? filters.operators[0] : ''}
   is3DMode={filters.is3DMode || false}
 />
               <Stats 
@@ -2,7 +2,8 @@ import React, { useState, useMemo, useEffect } from 'react';
 import Map from 'react-map-gl';
 import DeckGL from '@deck.gl/react';
 import { HeatmapLayer, HexagonLayer } from '@deck.gl/aggregation-layers';
-import { ScatterplotLayer, IconLayer, LineLayer, TextLayer, ColumnLayer } from '@deck.gl/layers';
+import { ScatterplotLayer, IconLayer, LineLayer, TextLayer, ColumnLayer, BitmapLayer } from '@deck.gl/layers';
+import { TileLayer } from 'deck.gl';
 import './MapView.css';
 import { getMapStyleUrl } from '../../utils/mapStyles';
 import antennaIcon from '../../assets/antenna-svgrepo-com.svg';
@@ -25,6 +26,7 @@ function MapView({
   telemetryVisualization = 'points',
   speedtestVisualization = 'points',
   speedtestBarType = 'download',
+  coverageOperator = '',
   is3DMode = false
 }) {
   const [viewState, setViewState] = useState(INITIAL_VIEW_STATE);
@@ -192,6 +194,32 @@ const telemetryHeatmapLayer = useMemo(() => {
   });
 }, [data, visibleLayers.telemetry, telemetryVisualization]);
 
+// ===== TELEMETRIA ZASIĘG (kafle rastrowe z backendu) =====
+const telemetryCoverageLayer = useMemo(() => {
+  if (!visibleLayers.telemetry || telemetryVisualization !== 'coverage') return null;
+
+  const query = coverageOperator ? `?operator=${encodeURIComponent(coverageOperator)}` : '';
+  return new TileLayer({
+    id: `telemetry-coverage-layer-${coverageOperator}`,
+    data: `/api/heatmap/signal/{z}/{x}/{y}.png${query}`,
+    minZoom: 5,
+    maxZoom: 15,
+    tileSize: 256,
+    // 204 = brak pomiarów w kaflu
+    getTileData: ({ url, signal }) =>
+      fetch(url, { signal }).then(r => (r.status === 200 ? r.blob().then(createImageBitmap) : null)),
+    renderSubLayers: props => {
+      if (!props.data) return null;
+      const { bbox: { west, south, east, north } } = props.tile;
+      return new BitmapLayer(props, {
+        data: null,
+        image: props.data,
+        bounds: [west, south, east, north]
+      });
+    }
+  });
+}, [visibleLayers.telemetry, telemetryVisualization, coverageOperator]);
+
 // ===== TELEMETRIA HEXAGONY =====
 const telemetryHexagonLayer = useMemo(() => {
   if (!visibleLayers.telemetry || telemetryVisualization !== 'hexagons') return null;
@@ -437,6 +465,7 @@ const layers = [
   telemetryVisualization === 'points' && pointsGlowLayer,
   telemetryVisualization === 'points' && pointsCoreLayer,
   telemetryVisualization === 'heatmap' && telemetryHeatmapLayer,
+  telemetryVisualization === 'coverage' && telemetryCoverageLayer,
   telemetryVisualization === 'hexagons' && telemetryHexagonLayer,
   telemetryVisualization === 'bars' && telemetryBarsLayer,
   // Speedtest - warunkowe warstwy
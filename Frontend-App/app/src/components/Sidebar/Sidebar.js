@@ -741,6 +741,18 @@ function Sidebar({
                         <span>Heatmapa</span>
                       </button>
 
+                      <button
+                        className={`viz-button ${filters.telemetryVisualization === 'coverage' ? 'active' : ''}`}
+                        onClick={() => handleTelemetryVisualizationChange('coverage')}
+                        title="Zasięg (ostatnie 30 dni, wszystkie pomiary)"
+                      >
+                        <svg width="18" height="18" viewBox="0 0 24 24" fill="none" stroke="currentColor" strokeWidth="2">
+                          <rect x="3" y="3" width="18" height="18" rx="2"/>
+                          <path d="M3 15l5-5 4 4 3-3 6 6"/>
+                        </svg>
+                        <span>Zasięg</span>
+                      </button>
+
                       <button
                         className={`viz-button ${filters.telemetryVisualization === 'hexagons' ? 'active' : ''}`}
                         onClick={() => handleTelemetryVisualizationChange('hexagons')}
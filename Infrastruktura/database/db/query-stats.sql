@@ -0,0 +1,34 @@
+-- Czas planowania vs wykonania zapytań backendu (pg_stat_statements)
+-- Wymaga pg_stat_statements.track_planning = on (postgres.tf), inaczej kolumny *_plan_time są zerowe.
+--
+-- Pomiar przed/po zmianie (np. PREPARED_MAX=0 vs domyślnie w backendzie):
+--   1. SELECT pg_stat_statements_reset();
+--   2. kilka minut zwykłego ruchu na dashboardzie
+--   3. poniższe zapytanie
+-- Zapytania przygotowane (EXECUTE q_...) są liczone pod tekstem z PREPARE; plans < calls oznacza,
+-- że część wykonań użyła zapamiętanego planu ogólnego zamiast planowania od nowa.
+
+SELECT
+    left(regexp_replace(query, '\s+', ' ', 'g'), 120) AS query,
+    calls,
+    plans,
+    round(total_plan_time::numeric, 1) AS plan_ms,
+    round(mean_plan_time::numeric, 3) AS plan_ms_avg,
+    round(total_exec_time::numeric, 1) AS exec_ms,
+    round(mean_exec_time::numeric, 3) AS exec_ms_avg,
+    round((100 * total_plan_time / NULLIF(total_plan_time + total_exec_time, 0))::numeric, 1) AS plan_pct
+FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+  AND calls > 10
+ORDER BY total_plan_time DESC
+LIMIT 30;
+
+-- Suma dla całej bazy: udział planowania w czasie zapytań
+SELECT
+    sum(calls) AS calls,
+    sum(plans) AS plans,
+    round(sum(total_plan_time)::numeric, 1) AS plan_ms,
+    round(sum(total_exec_time)::numeric, 1) AS exec_ms,
+    round((100 * sum(total_plan_time) / NULLIF(sum(total_plan_time + total_exec_time), 0))::numeric, 1) AS plan_pct
+FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database());
@@ -37,55 +37,536 @@ CREATE TABLE IF NOT EXISTS public.bts (
 CREATE INDEX IF NOT EXISTS bts_ecid_idx ON public.bts(ecid);
 CREATE INDEX IF NOT EXISTS bts_operator_enbi_idx ON public.bts(operator, enbi);
 
+-- Dopasowanie BTS po stronie bazy (/api/telemetry-with-bts?match=db): punkt stacji liczony z lat/lon,
+-- GIST pod sortowanie KNN (<->) i ST_DWithin, btree pod klucze reguł LTE (enbi), UMTS (rnc, btsid) i GSM (btsid).
+ALTER TABLE public.bts
+    ADD COLUMN IF NOT EXISTS geog GEOGRAPHY(Point, 4326)
+        GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(lon::float8, lat::float8), 4326)::geography) STORED;
+CREATE INDEX IF NOT EXISTS bts_geog_idx ON public.bts USING GIST (geog);
+CREATE INDEX IF NOT EXISTS bts_enbi_idx ON public.bts(enbi) WHERE geog IS NOT NULL;
+CREATE INDEX IF NOT EXISTS bts_rnc_btsid_idx ON public.bts(rnc, btsid) WHERE geog IS NOT NULL;
+CREATE INDEX IF NOT EXISTS bts_btsid_idx ON public.bts(btsid) WHERE geog IS NOT NULL;
 
-CREATE TABLE IF NOT EXISTS public.telemetry (
-    id BIGSERIAL PRIMARY KEY,
-    operator TEXT NOT NULL,
-    network_type TEXT NOT NULL,
-    signal SMALLINT NOT NULL,
-    position GEOGRAPHY(Point, 4326) NOT NULL,
-    send_time TIMESTAMPTZ NOT NULL,
-    received_at TIMESTAMPTZ DEFAULT now() NOT NULL,
-    short_code TEXT NOT NULL,
-    rat TEXT,
-    nr_mode TEXT,
-    band TEXT,
-    arfcn INTEGER,
-    rsrp INTEGER,
-    rsrq INTEGER,
-    sinr INTEGER,
-    rssi INTEGER,
-    timing_advance INTEGER,
-    pci INTEGER,
-    eci BIGINT,
-    nci BIGINT,
-    cell_id BIGINT,
-    enb INTEGER,
-    sector_id INTEGER,
-    tac INTEGER,
+-- Dziennik zmian tabeli bts zapisywany przez import_bts.py (w tej samej transakcji co zmiany, po imporcie NOTIFY bts_changed).
+-- op: I - nowa stacja, U - zmieniona, D - usunięta; klucze dopasowania przed (old_*) i po zmianie, żeby odbiorcy
+-- (indeks BTS backendu, ponowne dopasowanie telemetrii) mogli unieważnić tylko dotknięte wpisy.
+CREATE TABLE IF NOT EXISTS public.bts_changes (
+    change_id BIGSERIAL PRIMARY KEY,
+    changed_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+    op CHAR(1) NOT NULL CHECK (op IN ('I', 'U', 'D')),
+    bts_id BIGINT NOT NULL,
+    operator TEXT,
+    enbi INTEGER,
+    rnc INTEGER,
+    btsid TEXT,
     lac INTEGER,
-    operator_norm4 TEXT,
-    CONSTRAINT telemetry_short_code_fk FOREIGN KEY (short_code) REFERENCES public.viewer(short_code),
-    CONSTRAINT chk_operator_norm4 CHECK (operator_norm4 = ANY (ARRAY['Orange'::text, 'Play'::text, 'Plus'::text, 'T-Mobile'::text, 'Unknown'::text])),
-    CONSTRAINT telemetry_signal_check CHECK (signal >= -150 AND signal <= 0)
+    old_enbi INTEGER,
+    old_rnc INTEGER,
+    old_btsid TEXT,
+    old_lac INTEGER
 );
+CREATE INDEX IF NOT EXISTS bts_changes_changed_at_idx ON public.bts_changes(changed_at);
+
+
+-- telemetry i speed_test partycjonowane miesięcznie po send_time (partycje <tabela>_pRRRR_MM w UTC, utrzymywane
+-- przez maintain_partitions()); <tabela>_default przyjmuje pomiary spoza utworzonych partycji (np. zły zegar telefonu).
+-- Klucz główny musi zawierać klucz partycjonowania, więc to (id, send_time); id nadal nadaje jedna sekwencja.
+
+CREATE SCHEMA IF NOT EXISTS archive;
+
+-- Tworzy partycję miesiąca (for_month - dowolny dzień miesiąca, granice o północy UTC) i zwraca jej nazwę,
+-- NULL gdy już istnieje. Wiersze z tego zakresu leżące w partycji domyślnej są do niej przenoszone
+-- (inaczej PostgreSQL odmówiłby utworzenia partycji).
+CREATE OR REPLACE FUNCTION public.create_month_partition(parent TEXT, for_month DATE)
+RETURNS TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_month DATE := date_trunc('month', for_month)::date;
+    v_name TEXT := parent || '_p' || to_char(for_month, 'YYYY_MM');
+    v_lo TIMESTAMPTZ := v_month::timestamp AT TIME ZONE 'UTC';
+    v_hi TIMESTAMPTZ := (v_month + interval '1 month')::date::timestamp AT TIME ZONE 'UTC';
+    v_moved BOOLEAN;
+BEGIN
+    IF to_regclass('public.' || v_name) IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM public.%I WHERE send_time >= $1 AND send_time < $2)', parent || '_default')
+        INTO v_moved USING v_lo, v_hi;
+    IF v_moved THEN
+        EXECUTE format('CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name, parent);
+        EXECUTE format('WITH moved AS (DELETE FROM public.%I WHERE send_time >= $1 AND send_time < $2 RETURNING *) '
+                       'INSERT INTO public.%I SELECT * FROM moved', parent || '_default', v_name) USING v_lo, v_hi;
+        EXECUTE format('ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)', parent, v_name, v_lo, v_hi);
+    ELSE
+        EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)', v_name, parent, v_lo, v_hi);
+    END IF;
+    RETURN v_name;
+END;
+$$;
+
+-- Utrzymanie partycji telemetry i speed_test (wątek backendu, rollup_loop): partycje bieżącego miesiąca
+-- i months_ahead kolejnych; przy retention_months > 0 partycje starsze niż tyle pełnych miesięcy przed bieżącym
+-- są odłączane i przenoszone do schematu archive (archive = true) albo usuwane. Agregaty godzinowe zostają.
+-- Zwraca wykonane działania; nic, gdy utrzymanie trwa w innej sesji.
+CREATE OR REPLACE FUNCTION public.maintain_partitions(months_ahead INT DEFAULT 3, retention_months INT DEFAULT 0, archive BOOLEAN DEFAULT true)
+RETURNS TABLE (action TEXT, partition_name TEXT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_month DATE := date_trunc('month', now() AT TIME ZONE 'UTC')::date;
+    v_cut DATE := (v_month - make_interval(months => retention_months))::date;
+    t TEXT;
+    p RECORD;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('public.maintain_partitions')) THEN
+        RETURN;
+    END IF;
+
+    FOREACH t IN ARRAY ARRAY['telemetry', 'speed_test'] LOOP
+        FOR i IN 0..months_ahead LOOP
+            partition_name := public.create_month_partition(t, (v_month + make_interval(months => i))::date);
+            IF partition_name IS NOT NULL THEN
+                action := 'created';
+                RETURN NEXT;
+            END IF;
+        END LOOP;
+
+        CONTINUE WHEN retention_months <= 0;
+        FOR p IN
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = ('public.' || t)::regclass AND c.relname ~ ('^' || t || '_p[0-9]{4}_[0-9]{2}$')
+              AND to_date(right(c.relname, 7), 'YYYY_MM') < v_cut
+        LOOP
+            EXECUTE format('ALTER TABLE public.%I DETACH PARTITION public.%I', t, p.relname);
+            IF archive THEN
+                EXECUTE format('ALTER TABLE public.%I SET SCHEMA archive', p.relname);
+                action := 'archived';
+            ELSE
+                EXECUTE format('DROP TABLE public.%I', p.relname);
+                action := 'dropped';
+            END IF;
+            partition_name := p.relname;
+            RETURN NEXT;
+        END LOOP;
+    END LOOP;
+END;
+$$;
+
+-- Tabele partycjonowane i przeniesienie baz sprzed partycjonowania - w jednym bloku (jednej transakcji), więc przy
+-- błędzie kopiowania stara tabela zostaje pod swoją nazwą. Stara tabela odkładana jako <tabela>_unpartitioned
+-- (indeksy z przyrostkiem, sekwencja przechodzi na nową tabelę), potem partycje dla miesięcy ze starymi danymi,
+-- przeniesienie wierszy (wspólne kolumny, id bez zmian; geohash liczony, gdy stara tabela go nie miała)
+-- i usunięcie starej tabeli. <tabela>_unpartitioned z wcześniejszego, przerwanego wdrożenia też jest przenoszona.
+DO $$
+DECLARE
+    t TEXT;
+    idx RECORD;
+    v_old TEXT;
+    v_cols TEXT;
+    v_exprs TEXT;
+    v_from DATE;
+    v_to DATE;
+    v_rows BIGINT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['telemetry', 'speed_test'] LOOP
+        IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('public.' || t) AND relkind = 'r') THEN
+            EXECUTE format('ALTER SEQUENCE public.%I OWNED BY NONE', t || '_id_seq');
+            EXECUTE format('ALTER TABLE public.%I RENAME TO %I', t, t || '_unpartitioned');
+            FOR idx IN
+                SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indrelid = to_regclass('public.' || t || '_unpartitioned')
+            LOOP
+                EXECUTE format('ALTER INDEX public.%I RENAME TO %I', idx.relname, left(idx.relname, 49) || '_unpartitioned');
+            END LOOP;
+        END IF;
+    END LOOP;
+
+    CREATE SEQUENCE IF NOT EXISTS public.telemetry_id_seq;
+    CREATE TABLE IF NOT EXISTS public.telemetry (
+        id BIGINT NOT NULL DEFAULT nextval('public.telemetry_id_seq'),
+        operator TEXT NOT NULL,
+        network_type TEXT NOT NULL,
+        signal SMALLINT NOT NULL,
+        position GEOGRAPHY(Point, 4326) NOT NULL,
+        send_time TIMESTAMPTZ NOT NULL,
+        received_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+        short_code TEXT NOT NULL,
+        rat TEXT,
+        nr_mode TEXT,
+        band TEXT,
+        arfcn INTEGER,
+        rsrp INTEGER,
+        rsrq INTEGER,
+        sinr INTEGER,
+        rssi INTEGER,
+        timing_advance INTEGER,
+        pci INTEGER,
+        eci BIGINT,
+        nci BIGINT,
+        cell_id BIGINT,
+        enb INTEGER,
+        sector_id INTEGER,
+        tac INTEGER,
+        lac INTEGER,
+        operator_norm4 TEXT,
+        geohash5 TEXT COLLATE "C",
+        geohash6 TEXT COLLATE "C",
+        geohash7 TEXT COLLATE "C",
+        related_bts_id BIGINT,
+        PRIMARY KEY (id, send_time),
+        CONSTRAINT telemetry_short_code_fk FOREIGN KEY (short_code) REFERENCES public.viewer(short_code),
+        CONSTRAINT chk_operator_norm4 CHECK (operator_norm4 = ANY (ARRAY['Orange'::text, 'Play'::text, 'Plus'::text, 'T-Mobile'::text, 'Unknown'::text])),
+        CONSTRAINT telemetry_signal_check CHECK (signal >= -150 AND signal <= 0)
+    ) PARTITION BY RANGE (send_time);
+    ALTER SEQUENCE public.telemetry_id_seq OWNED BY public.telemetry.id;
+    CREATE TABLE IF NOT EXISTS public.telemetry_default PARTITION OF public.telemetry DEFAULT;
+
+    CREATE SEQUENCE IF NOT EXISTS public.speed_test_id_seq;
+    CREATE TABLE IF NOT EXISTS public.speed_test (
+        id BIGINT NOT NULL DEFAULT nextval('public.speed_test_id_seq'),
+        short_code TEXT NOT NULL,
+        latency_ms BIGINT NOT NULL,
+        jitter_ms BIGINT NOT NULL,
+        download_mbps DOUBLE PRECISION NOT NULL,
+        upload_mbps DOUBLE PRECISION NOT NULL,
+        send_time TIMESTAMPTZ NOT NULL,
+        received_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+        position GEOGRAPHY(Point, 4326),
+        operator TEXT,
+        geohash5 TEXT COLLATE "C",
+        geohash6 TEXT COLLATE "C",
+        geohash7 TEXT COLLATE "C",
+        PRIMARY KEY (id, send_time),
+        CONSTRAINT speed_test_short_code_fk FOREIGN KEY (short_code) REFERENCES public.viewer(short_code)
+    ) PARTITION BY RANGE (send_time);
+    ALTER SEQUENCE public.speed_test_id_seq OWNED BY public.speed_test.id;
+    CREATE TABLE IF NOT EXISTS public.speed_test_default PARTITION OF public.speed_test DEFAULT;
+
+    PERFORM public.maintain_partitions();
+    FOREACH t IN ARRAY ARRAY['telemetry', 'speed_test'] LOOP
+        v_old := t || '_unpartitioned';
+        CONTINUE WHEN to_regclass('public.' || v_old) IS NULL;
+
+        EXECUTE format('SELECT min(send_time AT TIME ZONE ''UTC'')::date, max(send_time AT TIME ZONE ''UTC'')::date FROM public.%I', v_old)
+            INTO v_from, v_to;
+        WHILE v_from <= v_to LOOP
+            PERFORM public.create_month_partition(t, v_from);
+            v_from := (date_trunc('month', v_from) + interval '1 month')::date;
+        END LOOP;
+
+        SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum),
+               string_agg(CASE WHEN o.attname IS NOT NULL THEN quote_ident(a.attname)
+                               ELSE format('left(ST_GeoHash(position::geometry, 7), %s)', right(a.attname, 1)) END,
+                          ', ' ORDER BY a.attnum)
+        INTO v_cols, v_exprs
+        FROM pg_attribute a
+        LEFT JOIN pg_attribute o ON o.attrelid = ('public.' || v_old)::regclass AND o.attname = a.attname
+                                AND o.attnum > 0 AND NOT o.attisdropped
+        WHERE a.attrelid = ('public.' || t)::regclass AND a.attnum > 0 AND NOT a.attisdropped
+          AND (o.attname IS NOT NULL OR a.attname IN ('geohash5', 'geohash6', 'geohash7'));
+        EXECUTE format('INSERT INTO public.%I (%s) SELECT %s FROM public.%I', t, v_cols, v_exprs, v_old);
+        GET DIAGNOSTICS v_rows = ROW_COUNT;
+        RAISE NOTICE '%: przeniesiono % wierszy do tabeli partycjonowanej', t, v_rows;
+        EXECUTE format('DROP TABLE public.%I', v_old);
+    END LOOP;
+END;
+$$;
 
 CREATE INDEX IF NOT EXISTS telemetry_position_gix ON public.telemetry USING GIST (position);
 CREATE INDEX IF NOT EXISTS telemetry_short_code_send_time_idx ON public.telemetry(short_code, send_time);
 CREATE INDEX IF NOT EXISTS telemetry_operator_enb_idx ON public.telemetry(operator, enb);
+CREATE INDEX IF NOT EXISTS telemetry_send_time_id_idx ON public.telemetry(send_time DESC, id DESC);
+-- Tryb przyrostowy API: stronicowanie po (received_at, id)
+DROP INDEX IF EXISTS public.telemetry_received_at_idx;
+CREATE INDEX IF NOT EXISTS telemetry_received_at_id_idx ON public.telemetry(received_at, id);
+-- BRIN na czasie pomiaru: zakresy send_time (agregacje, eksport, heatmapa) bez skanu całej partycji, indeks
+-- rzędu kilkudziesięciu kB na partycję. B-tree (send_time DESC, id DESC) zostaje pod stronicowanie po kluczu.
+CREATE INDEX IF NOT EXISTS telemetry_send_time_brin ON public.telemetry USING BRIN (send_time) WITH (pages_per_range = 32);
 
-CREATE TABLE IF NOT EXISTS public.speed_test (
-    id BIGSERIAL PRIMARY KEY,
-    short_code TEXT NOT NULL,
-    latency_ms BIGINT NOT NULL,
-    jitter_ms BIGINT NOT NULL,
-    download_mbps DOUBLE PRECISION NOT NULL,
-    upload_mbps DOUBLE PRECISION NOT NULL,
-    send_time TIMESTAMPTZ NOT NULL,
-    received_at TIMESTAMPTZ DEFAULT now() NOT NULL,
-    position GEOGRAPHY(Point, 4326),
-    operator TEXT,
-    CONSTRAINT speed_test_short_code_fk FOREIGN KEY (short_code) REFERENCES public.viewer(short_code)
-);
 CREATE INDEX IF NOT EXISTS speed_test_position_gix ON public.speed_test USING GIST (position);
-CREATE INDEX IF NOT EXISTS speed_test_short_code_send_time_idx ON public.speed_test(short_code, send_time);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS speed_test_short_code_send_time_idx ON public.speed_test(short_code, send_time);
+CREATE INDEX IF NOT EXISTS speed_test_send_time_id_idx ON public.speed_test(send_time DESC, id DESC);
+-- Tryb przyrostowy API: stronicowanie po (received_at, id)
+DROP INDEX IF EXISTS public.speed_test_received_at_idx;
+CREATE INDEX IF NOT EXISTS speed_test_received_at_id_idx ON public.speed_test(received_at, id);
+CREATE INDEX IF NOT EXISTS speed_test_send_time_brin ON public.speed_test USING BRIN (send_time) WITH (pages_per_range = 32);
+
+-- Komórki geohash liczone przy zapisie (fa-worker, _normalize_row): 5 ~4.9 km, 6 ~1.2 km, 7 ~150 m.
+-- Agregacje po komórkach to GROUP BY po indeksie B-tree zamiast ST_* dla każdego wiersza;
+-- COLLATE "C" - kolejność indeksu zgodna z krzywą geohash i obsługa LIKE 'prefiks%' (komórka z podkomórkami).
+-- Bazy sprzed zmiany: geohash starych wierszy liczony ST_GeoHash (ten sam algorytm co w fa-worker) jednorazowo,
+-- przy przenoszeniu do tabel partycjonowanych (blok wyżej).
+ALTER TABLE public.telemetry
+    ADD COLUMN IF NOT EXISTS geohash5 TEXT COLLATE "C",
+    ADD COLUMN IF NOT EXISTS geohash6 TEXT COLLATE "C",
+    ADD COLUMN IF NOT EXISTS geohash7 TEXT COLLATE "C";
+ALTER TABLE public.speed_test
+    ADD COLUMN IF NOT EXISTS geohash5 TEXT COLLATE "C",
+    ADD COLUMN IF NOT EXISTS geohash6 TEXT COLLATE "C",
+    ADD COLUMN IF NOT EXISTS geohash7 TEXT COLLATE "C";
+
+CREATE INDEX IF NOT EXISTS telemetry_geohash5_idx ON public.telemetry(geohash5);
+CREATE INDEX IF NOT EXISTS telemetry_geohash6_idx ON public.telemetry(geohash6);
+CREATE INDEX IF NOT EXISTS telemetry_geohash7_idx ON public.telemetry(geohash7);
+CREATE INDEX IF NOT EXISTS speed_test_geohash5_idx ON public.speed_test(geohash5);
+CREATE INDEX IF NOT EXISTS speed_test_geohash6_idx ON public.speed_test(geohash6);
+CREATE INDEX IF NOT EXISTS speed_test_geohash7_idx ON public.speed_test(geohash7);
+
+-- Stacja BTS dopasowana przy zapisie (fa-worker, _match_bts - reguły jak match_bts w app.py); NULL = brak dopasowania.
+-- Bez klucza obcego: rejestr bts jest ładowany zewnętrznie, a usunięta stacja daje po prostu brak złączenia.
+ALTER TABLE public.telemetry ADD COLUMN IF NOT EXISTS related_bts_id BIGINT;
+CREATE INDEX IF NOT EXISTS telemetry_related_bts_id_idx ON public.telemetry(related_bts_id) WHERE related_bts_id IS NOT NULL;
+
+
+-- Agregaty godzinowe dla /api/stats: godzina × operator × technologia × komórka siatki 0.01° (~1.1 × 0.7 km)
+-- Utrzymywane przyrostowo przez refresh_rollups() (wątek backendu), surowe tabele nie są skanowane przy odczycie
+CREATE TABLE IF NOT EXISTS public.telemetry_rollup_hourly (
+    hour TIMESTAMPTZ NOT NULL,
+    operator TEXT NOT NULL,
+    network_type TEXT NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    n BIGINT NOT NULL,
+    signal_sum BIGINT NOT NULL,
+    signal_min SMALLINT NOT NULL,
+    signal_max SMALLINT NOT NULL,
+    rsrp_n BIGINT NOT NULL,
+    rsrp_sum BIGINT NOT NULL,
+    rsrp_min INTEGER,
+    rsrp_max INTEGER,
+    sinr_n BIGINT NOT NULL,
+    sinr_sum BIGINT NOT NULL,
+    sinr_min INTEGER,
+    sinr_max INTEGER,
+    PRIMARY KEY (hour, operator, network_type, cell_x, cell_y)
+);
+
+CREATE TABLE IF NOT EXISTS public.speed_test_rollup_hourly (
+    hour TIMESTAMPTZ NOT NULL,
+    operator TEXT NOT NULL,
+    cell_x INTEGER,
+    cell_y INTEGER,
+    n BIGINT NOT NULL,
+    download_sum DOUBLE PRECISION NOT NULL,
+    upload_sum DOUBLE PRECISION NOT NULL,
+    latency_sum BIGINT NOT NULL,
+    jitter_sum BIGINT NOT NULL,
+    CONSTRAINT speed_test_rollup_hourly_key UNIQUE NULLS NOT DISTINCT (hour, operator, cell_x, cell_y)
+);
+
+-- Znacznik postępu: ostatnie id surowej tabeli ujęte w agregatach
+CREATE TABLE IF NOT EXISTS public.rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ
+);
+INSERT INTO public.rollup_state (name) VALUES ('telemetry'), ('speed_test') ON CONFLICT DO NOTHING;
+
+-- Dolicza do agregatów porcję nowych wierszy (najwyżej batch_size wierszy na tabelę) i zwraca liczbę ujętych pomiarów,
+-- -1 gdy odświeżanie trwa w innej sesji. Porcja kończy się przed pierwszym wierszem młodszym niż min_age,
+-- żeby transakcje zapisu zatwierdzane w innej kolejności niż przydzielone id nie zostały przeskoczone przez znacznik.
+CREATE OR REPLACE FUNCTION public.refresh_rollups(min_age INTERVAL DEFAULT interval '1 minute', batch_size BIGINT DEFAULT 200000)
+RETURNS BIGINT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_lo BIGINT;
+    v_hi BIGINT;
+    v_young BIGINT;
+    v_rows BIGINT;
+    v_total BIGINT := 0;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('public.refresh_rollups')) THEN
+        RETURN -1;
+    END IF;
+
+    -- telemetry
+    SELECT last_id INTO v_lo FROM public.rollup_state WHERE name = 'telemetry' FOR UPDATE;
+    SELECT min(id) INTO v_young FROM public.telemetry WHERE id > v_lo AND received_at >= now() - min_age;
+    SELECT max(id) INTO v_hi FROM (
+        SELECT id FROM public.telemetry
+        WHERE id > v_lo AND (v_young IS NULL OR id < v_young)
+        ORDER BY id LIMIT batch_size
+    ) s;
+    IF v_hi IS NOT NULL THEN
+        WITH agg AS (
+            SELECT date_trunc('hour', send_time) AS hour,
+                   COALESCE(operator_norm4, operator) AS operator,
+                   network_type,
+                   floor(ST_X(position::geometry) * 100)::int AS cell_x,
+                   floor(ST_Y(position::geometry) * 100)::int AS cell_y,
+                   count(*) AS n,
+                   sum(signal) AS signal_sum, min(signal) AS signal_min, max(signal) AS signal_max,
+                   count(rsrp) AS rsrp_n, COALESCE(sum(rsrp), 0) AS rsrp_sum, min(rsrp) AS rsrp_min, max(rsrp) AS rsrp_max,
+                   count(sinr) AS sinr_n, COALESCE(sum(sinr), 0) AS sinr_sum, min(sinr) AS sinr_min, max(sinr) AS sinr_max
+            FROM public.telemetry
+            WHERE id > v_lo AND id <= v_hi
+            GROUP BY 1, 2, 3, 4, 5
+        ), up AS (
+            INSERT INTO public.telemetry_rollup_hourly AS r
+            SELECT * FROM agg
+            ON CONFLICT (hour, operator, network_type, cell_x, cell_y) DO UPDATE SET
+                n = r.n + EXCLUDED.n,
+                signal_sum = r.signal_sum + EXCLUDED.signal_sum,
+                signal_min = LEAST(r.signal_min, EXCLUDED.signal_min),
+                signal_max = GREATEST(r.signal_max, EXCLUDED.signal_max),
+                rsrp_n = r.rsrp_n + EXCLUDED.rsrp_n,
+                rsrp_sum = r.rsrp_sum + EXCLUDED.rsrp_sum,
+                rsrp_min = LEAST(r.rsrp_min, EXCLUDED.rsrp_min),
+                rsrp_max = GREATEST(r.rsrp_max, EXCLUDED.rsrp_max),
+                sinr_n = r.sinr_n + EXCLUDED.sinr_n,
+                sinr_sum = r.sinr_sum + EXCLUDED.sinr_sum,
+                sinr_min = LEAST(r.sinr_min, EXCLUDED.sinr_min),
+                sinr_max = GREATEST(r.sinr_max, EXCLUDED.sinr_max)
+        )
+        SELECT COALESCE(sum(agg.n), 0) INTO v_rows FROM agg;
+        UPDATE public.rollup_state SET last_id = v_hi, updated_at = now() WHERE name = 'telemetry';
+        v_total := v_total + v_rows;
+    END IF;
+
+    -- speed_test
+    SELECT last_id INTO v_lo FROM public.rollup_state WHERE name = 'speed_test' FOR UPDATE;
+    SELECT min(id) INTO v_young FROM public.speed_test WHERE id > v_lo AND received_at >= now() - min_age;
+    SELECT max(id) INTO v_hi FROM (
+        SELECT id FROM public.speed_test
+        WHERE id > v_lo AND (v_young IS NULL OR id < v_young)
+        ORDER BY id LIMIT batch_size
+    ) s;
+    IF v_hi IS NOT NULL THEN
+        WITH agg AS (
+            SELECT date_trunc('hour', send_time) AS hour,
+                   COALESCE(operator, 'Nieznany') AS operator,
+                   floor(ST_X(position::geometry) * 100)::int AS cell_x,
+                   floor(ST_Y(position::geometry) * 100)::int AS cell_y,
+                   count(*) AS n,
+                   sum(download_mbps) AS download_sum,
+                   sum(upload_mbps) AS upload_sum,
+                   sum(latency_ms) AS latency_sum,
+                   sum(jitter_ms) AS jitter_sum
+            FROM public.speed_test
+            WHERE id > v_lo AND id <= v_hi
+            GROUP BY 1, 2, 3, 4
+        ), up AS (
+            INSERT INTO public.speed_test_rollup_hourly AS r
+            SELECT * FROM agg
+            ON CONFLICT ON CONSTRAINT speed_test_rollup_hourly_key DO UPDATE SET
+                n = r.n + EXCLUDED.n,
+                download_sum = r.download_sum + EXCLUDED.download_sum,
+                upload_sum = r.upload_sum + EXCLUDED.upload_sum,
+                latency_sum = r.latency_sum + EXCLUDED.latency_sum,
+                jitter_sum = r.jitter_sum + EXCLUDED.jitter_sum
+        )
+        SELECT COALESCE(sum(agg.n), 0) INTO v_rows FROM agg;
+        UPDATE public.rollup_state SET last_id = v_hi, updated_at = now() WHERE name = 'speed_test';
+        v_total := v_total + v_rows;
+    END IF;
+
+    RETURN v_total;
+END;
+$$;
+
+
+-- Kafle heatmapy zasięgu (/api/heatmap): interpolacja ST_InterpolateRaster (postgis_raster), PNG albo GeoTIFF float32.
+-- Klucz: operator ('' = wszyscy), metryka, format, z/x/y oraz okno dni [end_day - days + 1, end_day].
+-- tile = NULL: w kaflu nie było pomiarów (też buforowane, żeby puste obszary nie były liczone ponownie).
+-- Czas życia: kafle z end_day starszym niż keep_days dni (HEATMAP_CACHE_DAYS w backendzie, domyślnie 7) usuwa
+-- evict_heatmap_tiles() - domyślny end_day to dziś, więc bez tego każdy dzień dokładałby nowy komplet kafli.
+CREATE TABLE IF NOT EXISTS public.heatmap_tile_cache (
+    operator TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    format TEXT NOT NULL,
+    z SMALLINT NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    end_day DATE NOT NULL,
+    days SMALLINT NOT NULL,
+    tile BYTEA,
+    points INTEGER NOT NULL,
+    generated_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+    PRIMARY KEY (operator, metric, format, z, x, y, end_day, days)
+);
+CREATE INDEX IF NOT EXISTS heatmap_tile_cache_zxy_idx ON public.heatmap_tile_cache(z, x, y);
+CREATE INDEX IF NOT EXISTS heatmap_tile_cache_end_day_idx ON public.heatmap_tile_cache(end_day);
+
+INSERT INTO public.rollup_state (name) VALUES ('heatmap') ON CONFLICT DO NOTHING;
+
+-- Usuwa z heatmap_tile_cache kafle, na które wpływają nowe pomiary (kafel pomiaru na każdym buforowanym zoomie,
+-- z marginesem 1/16 kafla = promień interpolacji, dla operatora pomiaru i '' oraz okien obejmujących jego dzień).
+-- Kolejne zapytanie o kafel renderuje go od nowa. Zwraca liczbę usuniętych kafli, -1 gdy działa w innej sesji.
+CREATE OR REPLACE FUNCTION public.invalidate_heatmap_tiles(min_age INTERVAL DEFAULT interval '1 minute', batch_size BIGINT DEFAULT 200000)
+RETURNS BIGINT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_lo BIGINT;
+    v_hi BIGINT;
+    v_young BIGINT;
+    v_deleted BIGINT := 0;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('public.invalidate_heatmap_tiles')) THEN
+        RETURN -1;
+    END IF;
+
+    SELECT last_id INTO v_lo FROM public.rollup_state WHERE name = 'heatmap' FOR UPDATE;
+    SELECT min(id) INTO v_young FROM public.telemetry WHERE id > v_lo AND received_at >= now() - min_age;
+
+    -- Pusty bufor: nie ma czego unieważniać, znacznik przeskakuje od razu na koniec
+    IF NOT EXISTS (SELECT 1 FROM public.heatmap_tile_cache) THEN
+        SELECT max(id) INTO v_hi FROM public.telemetry WHERE id > v_lo AND (v_young IS NULL OR id < v_young);
+        IF v_hi IS NOT NULL THEN
+            UPDATE public.rollup_state SET last_id = v_hi, updated_at = now() WHERE name = 'heatmap';
+        END IF;
+        RETURN 0;
+    END IF;
+
+    SELECT max(id) INTO v_hi FROM (
+        SELECT id FROM public.telemetry
+        WHERE id > v_lo AND (v_young IS NULL OR id < v_young)
+        ORDER BY id LIMIT batch_size
+    ) s;
+    IF v_hi IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    WITH new AS (
+        -- współrzędne kafla Web Mercator w ułamkach (dla z = 0)
+        SELECT operator, day, (lon + 180) / 360 AS fx, (1 - ln(tan(radians(lat)) + 1 / cos(radians(lat))) / pi()) / 2 AS fy
+        FROM (
+            SELECT DISTINCT operator,
+                   send_time::date AS day,
+                   ST_X(position::geometry) AS lon,
+                   LEAST(GREATEST(ST_Y(position::geometry), -85.0511), 85.0511) AS lat
+            FROM public.telemetry
+            WHERE id > v_lo AND id <= v_hi
+        ) p
+    ), touched AS (
+        SELECT DISTINCT n.operator, n.day, zs.z,
+               floor(n.fx * (1 << zs.z) - 0.0625)::int AS x0, floor(n.fx * (1 << zs.z) + 0.0625)::int AS x1,
+               floor(n.fy * (1 << zs.z) - 0.0625)::int AS y0, floor(n.fy * (1 << zs.z) + 0.0625)::int AS y1
+        FROM new n CROSS JOIN (SELECT DISTINCT z FROM public.heatmap_tile_cache) zs
+    )
+    DELETE FROM public.heatmap_tile_cache c
+    USING touched t
+    WHERE c.z = t.z
+      AND c.x BETWEEN t.x0 AND t.x1
+      AND c.y BETWEEN t.y0 AND t.y1
+      AND c.operator IN (t.operator, '')
+      AND t.day BETWEEN c.end_day - c.days + 1 AND c.end_day;
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+    UPDATE public.rollup_state SET last_id = v_hi, updated_at = now() WHERE name = 'heatmap';
+    RETURN v_deleted;
+END;
+$$;
+
+-- Usuwa z heatmap_tile_cache kafle okien kończących się ponad keep_days dni temu (wątek backendu, rollup_loop).
+-- Zapytanie o taki kafel renderuje go od nowa. Zwraca liczbę usuniętych kafli.
+CREATE OR REPLACE FUNCTION public.evict_heatmap_tiles(keep_days INT DEFAULT 7)
+RETURNS BIGINT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_deleted BIGINT;
+BEGIN
+    DELETE FROM public.heatmap_tile_cache WHERE end_day < current_date - keep_days;
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+    RETURN v_deleted;
+END;
+$$;
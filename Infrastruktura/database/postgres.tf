@@ -25,6 +25,13 @@ resource "azurerm_postgresql_flexible_server_database" "db" {
   charset   = "UTF8"
 }
 
+# Czas planowania w pg_stat_statements (db/query-stats.sql)
+resource "azurerm_postgresql_flexible_server_configuration" "track_planning" {
+  name      = "pg_stat_statements.track_planning"
+  server_id = azurerm_postgresql_flexible_server.pg.id
+  value     = "on"
+}
+
 resource "azurerm_postgresql_flexible_server_firewall_rule" "azure_services" {
   name             = var.firewall_rule_name
   server_id        = azurerm_postgresql_flexible_server.pg.id
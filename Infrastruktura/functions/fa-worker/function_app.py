@@ -1,4 +1,4 @@
-import json, os, logging, traceback
+import json, os, logging, traceback, math, time
 from typing import List, Tuple, Any
 from datetime import datetime, timezone
 import azure.functions as func
@@ -12,6 +12,19 @@ log.setLevel(logging.INFO)
 PG_CONN = os.getenv("PG_CONN")
 BATCH_SIZE = 500
 
+# geohash komórki pomiaru w kilku rozdzielczościach (5: ~4.9 km, 6: ~1.2 km, 7: ~150 m),
+# zgodny z ST_GeoHash z PostGIS - agregacje przestrzenne jako GROUP BY po indeksowanej kolumnie
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISIONS = (5, 6, 7)
+
+# dopasowanie BTS przy zapisie (related_bts_id): te same reguły i próg odległości co match_bts w backendzie,
+# rejestr bts trzymany w pamięci procesu i sprawdzany co BTS_CACHE_TTL sekund
+MATCH_MAX_KM = float(os.getenv("MATCH_MAX_KM", "16.7"))
+BTS_CACHE_TTL = int(os.getenv("BTS_CACHE_TTL", "600"))
+EARTH_RADIUS_KM = 6371.0088
+
+_bts = {"checked": 0.0, "version": None, "by_enb": {}, "by_umts": {}, "by_gsm": {}}
+
 # maskowanie poufnych danych w logach
 def _mask(s: str | None, keep: int = 6) -> str:
     if not s: return "<EMPTY>"
@@ -42,6 +55,83 @@ def _to_int_or_none(v):
         return int(v)
     except (TypeError, ValueError): return None
 
+def _geohash(lat: float, lon: float, precision: int = 7) -> str:
+    lat_lo, lat_hi, lon_lo, lon_hi = -90.0, 90.0, -180.0, 180.0
+    out, ch, bit, even = [], 0, 0, True
+    while len(out) < precision:
+        # bity na przemian: długość (parzyste) i szerokość geograficzna
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid: ch, lon_lo = ch * 2 + 1, mid
+            else: ch, lon_hi = ch * 2, mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid: ch, lat_lo = ch * 2 + 1, mid
+            else: ch, lat_hi = ch * 2, mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            out.append(GEOHASH_BASE32[ch])
+            ch, bit = 0, 0
+    return "".join(out)
+
+# geohash5/6/7 jako prefiksy najdokładniejszego; None bez pozycji
+def _geohash_cells(lat: float | None, lon: float | None) -> dict:
+    gh = _geohash(lat, lon, max(GEOHASH_PRECISIONS)) if lat is not None and lon is not None else None
+    return {f"geohash{p}": gh[:p] if gh else None for p in GEOHASH_PRECISIONS}
+
+# słowniki kandydatów (enbi, (rnc, btsid), btsid) -> [(id, lat, lon, lac)], przeładowywane gdy zmieni się tabela bts;
+# ostatni change_id z bts_changes wykrywa zmiany z import_bts.py, które nie przesuwają updated_at
+def _bts_lookup(cur) -> dict:
+    now = time.monotonic()
+    if now - _bts["checked"] < BTS_CACHE_TTL: return _bts
+    cur.execute("SELECT count(*), max(id), max(updated_at), "
+                "(SELECT COALESCE(max(change_id), 0) FROM bts_changes) FROM bts")
+    version = cur.fetchone()
+    if version != _bts["version"]:
+        by_enb, by_umts, by_gsm = {}, {}, {}
+        cur.execute("SELECT id, lat::float8, lon::float8, COALESCE(lac, 0), enbi, rnc, btsid FROM bts "
+                    "WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY id")
+        for bts_id, lat, lon, lac, enbi, rnc, btsid in cur.fetchall():
+            cand = (bts_id, lat, lon, lac)
+            if enbi is not None: by_enb.setdefault(enbi, []).append(cand)
+            if rnc is not None and btsid is not None: by_umts.setdefault((rnc, btsid), []).append(cand)
+            if btsid is not None: by_gsm.setdefault(btsid, []).append(cand)
+        _bts.update(version=version, by_enb=by_enb, by_umts=by_umts, by_gsm=by_gsm)
+        log.info("[BTS] wczytano rejestr: %s stacji", version[0])
+    _bts["checked"] = now
+    return _bts
+
+def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+# najbliższy kandydat w promieniu MATCH_MAX_KM; odpada przy różnych znanych LAC, remis -> mniejsze id
+def _nearest_bts(lat: float, lon: float, lac: int | None, candidates) -> int | None:
+    best, best_dist = None, MATCH_MAX_KM
+    for bts_id, b_lat, b_lon, b_lac in candidates:
+        if lac and b_lac and lac != b_lac: continue
+        dist = _haversine_km(lat, lon, b_lat, b_lon)
+        if dist < best_dist: best, best_dist = bts_id, dist
+    return best
+
+# reguły jak match_bts w app.py: LTE po eNB (bez dalszych reguł, gdy eNB jest w rejestrze),
+# UMTS cell_id = RNC * 65536 + CID -> btsid = CID // 10, GSM btsid = cell_id // 10 (gdy UMTS nic nie dał)
+def _match_bts(r: dict, lookup: dict) -> int | None:
+    lat, lon, lac, enb, cell = r["lat"], r["lon"], r["lac"], r["enb"], r["cell_id"]
+    if enb and enb in lookup["by_enb"]:
+        return _nearest_bts(lat, lon, lac, lookup["by_enb"][enb])
+    if cell is None: return None
+    nt = r["network_type"].lower()
+    best = None
+    if "3g" in nt:
+        rnc = cell // 65536
+        best = _nearest_bts(lat, lon, lac, lookup["by_umts"].get((rnc, str((cell - rnc * 65536) // 10)), ()))
+    if best is None and ("gsm" in nt or "2g" in nt):
+        best = _nearest_bts(lat, lon, lac, lookup["by_gsm"].get(str(cell // 10), ()))
+    return best
+
 # oczyszczanie tekstu z nadmiarowych znaków i spacji
 def _norm_text(s: str | None) -> str:
     if not s: return ""
@@ -130,6 +220,7 @@ def _normalize_row(raw: dict) -> Tuple[dict | None, str | None]:
             "sector_id": _to_int_or_none(raw.get("sector_id") or raw.get("sectorId")),
             "tac": _to_int_or_none(raw.get("tac")),
             "lac": _to_int_or_none(raw.get("lac")),
+            **_geohash_cells(lat, lon),
         }, None
     except Exception as e: return None, f"normalize_error: {e}"
 
@@ -147,6 +238,9 @@ def _normalize_speedtest(raw: dict) -> Tuple[dict | None, str | None]:
             except: return None, "sentTime must be ISO-8601"
         else: dt = datetime.now(timezone.utc)
 
+        lat = float(lat) if lat is not None else None
+        lon = float(lon) if lon is not None else None
+
         return {
             "short_code": short_code,
             "latency_ms": _to_int_or_none(raw.get("latencyMs")),
@@ -155,9 +249,10 @@ def _normalize_speedtest(raw: dict) -> Tuple[dict | None, str | None]:
             "upload_mbps": raw.get("uploadMbps"),
             "send_time": _iso_utc(dt),
             "received_at": _iso_utc(datetime.now(timezone.utc)),
-            "lat": float(lat) if lat is not None else None,
-            "lon": float(lon) if lon is not None else None,
+            "lat": lat,
+            "lon": lon,
             "operator": (raw.get("operator") or "").strip() or None,
+            **_geohash_cells(lat, lon),
         }, None
     except Exception as e: return None, f"normalize_speedtest_error: {e}"
 
@@ -185,33 +280,42 @@ def worker(messages: List[func.ServiceBusMessage]):
     if not tel_ready and not speed_ready: return
 
     # szablony SQL z obsługą typu Point (geografia)
-    sql_tel = """INSERT INTO telemetry (operator, operator_norm4, network_type, signal, position, send_time, short_code, rat, nr_mode, band, arfcn, rsrp, rsrq, sinr, rssi, timing_advance, pci, eci, nci, cell_id, enb, sector_id, tac, lac) 
+    sql_tel = """INSERT INTO telemetry (operator, operator_norm4, network_type, signal, position, send_time, short_code, rat, nr_mode, band, arfcn, rsrp, rsrq, sinr, rssi, timing_advance, pci, eci, nci, cell_id, enb, sector_id, tac, lac, geohash5, geohash6, geohash7, related_bts_id) 
                  VALUES ({})"""
     
     # konwersja lat/lon na natywny punkt geograficzny PostGIS
-    tel_row_sql = "(%s,%s,%s,%s, ST_SetSRID(ST_MakePoint(%s,%s),4326)::geography, %s::timestamptz, %s,%s,%s,%s,%s, %s,%s,%s,%s,%s, %s,%s,%s,%s,%s, %s,%s,%s)"
+    tel_row_sql = "(%s,%s,%s,%s, ST_SetSRID(ST_MakePoint(%s,%s),4326)::geography, %s::timestamptz, %s,%s,%s,%s,%s, %s,%s,%s,%s,%s, %s,%s,%s,%s,%s, %s,%s,%s, %s,%s,%s, %s)"
 
-    sql_speed = """INSERT INTO speed_test (short_code, latency_ms, jitter_ms, download_mbps, upload_mbps, send_time, position, operator) 
+    sql_speed = """INSERT INTO speed_test (short_code, latency_ms, jitter_ms, download_mbps, upload_mbps, send_time, position, operator, geohash5, geohash6, geohash7) 
                    VALUES ({})"""
     
-    speed_row_sql = "(%s,%s,%s,%s,%s, %s::timestamptz, CASE WHEN %s IS NOT NULL THEN ST_SetSRID(ST_MakePoint(%s,%s),4326)::geography ELSE NULL END, %s)"
+    speed_row_sql = "(%s,%s,%s,%s,%s, %s::timestamptz, CASE WHEN %s IS NOT NULL THEN ST_SetSRID(ST_MakePoint(%s,%s),4326)::geography ELSE NULL END, %s, %s,%s,%s)"
 
     try:
         # otwarcie połączenia i transakcji do bazy danych
         with psycopg.connect(PG_CONN, autocommit=False) as conn:
             with conn.cursor() as cur:
+                # dopasowanie BTS raz przy zapisie; błąd rejestru nie blokuje zapisu (related_bts_id = NULL)
+                if tel_ready:
+                    try:
+                        lookup = _bts_lookup(cur)
+                        for r in tel_ready: r["related_bts_id"] = _match_bts(r, lookup)
+                    except Exception as e:
+                        log.warning("[BTS] dopasowanie pominięte: %s", str(e))
+                        conn.rollback()
+
                 # masowy zapis danych telemetrycznych
                 for chunk in _chunks(tel_ready, BATCH_SIZE):
                     vals = []
                     for r in chunk:
-                        vals.extend([r["operator"], r["operator_norm4"], r["network_type"], r["signal"], r["lon"], r["lat"], r["send_time"], r["short_code"], r["rat"], r["nr_mode"], r["band"], r["arfcn"], r["rsrp"], r["rsrq"], r["sinr"], r["rssi"], r["timing_advance"], r["pci"], r["eci"], r["nci"], r["cell_id"], r["enb"], r["sector_id"], r["tac"], r["lac"]])
+                        vals.extend([r["operator"], r["operator_norm4"], r["network_type"], r["signal"], r["lon"], r["lat"], r["send_time"], r["short_code"], r["rat"], r["nr_mode"], r["band"], r["arfcn"], r["rsrp"], r["rsrq"], r["sinr"], r["rssi"], r["timing_advance"], r["pci"], r["eci"], r["nci"], r["cell_id"], r["enb"], r["sector_id"], r["tac"], r["lac"], r["geohash5"], r["geohash6"], r["geohash7"], r.get("related_bts_id")])
                     cur.execute(sql_tel.format(",".join([tel_row_sql] * len(chunk))), vals)
 
                 # masowy zapis wyników speedtestów
                 for chunk in _chunks(speed_ready, BATCH_SIZE):
                     vals = []
                     for r in chunk:
-                        vals.extend([r["short_code"], r["latency_ms"], r["jitter_ms"], r["download_mbps"], r["upload_mbps"], r["send_time"], r["lon"], r["lon"], r["lat"], r["operator"]])
+                        vals.extend([r["short_code"], r["latency_ms"], r["jitter_ms"], r["download_mbps"], r["upload_mbps"], r["send_time"], r["lon"], r["lon"], r["lat"], r["operator"], r["geohash5"], r["geohash6"], r["geohash7"]])
                     cur.execute(sql_speed.format(",".join([speed_row_sql] * len(chunk))), vals)
             
             # zatwierdzenie wszystkich zmian w jednej transakcji